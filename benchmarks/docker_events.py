@@ -0,0 +1,119 @@
+"""
+Benchmark event enrichment by replaying a recorded burst of docker events.
+
+The burst is the event log of a mass restart of 200 containers (kill, die,
+stop, start and restart for each), replayed against a fake docker backend
+that charges a fixed cost per API call. Enrichment that re-lists the whole
+host per event is compared with the targeted, id cached enrichment.
+
+Usage: python benchmarks/docker_events.py [api call cost in ms]
+"""
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import mock
+import dork.docker as docker
+
+CONTAINERS = 200
+IMAGES = 50
+
+
+def record_burst():
+    """
+    :rtype: list[str]
+    """
+    lines = []
+    for action in ['kill', 'die', 'stop', 'start', 'restart']:
+        for i in range(CONTAINERS):
+            lines.append(json.dumps({
+                'Type': 'container',
+                'Action': action,
+                'Actor': {'ID': '%064x' % i, 'Attributes': {
+                    'name': 'project.instance%s.abc' % i,
+                    'image': 'project/abc',
+                }},
+                'time': 1433152800 + i,
+            }) + '\n')
+    return lines
+
+
+class FakeBackend:
+    def __init__(self, cost):
+        self.cost = cost
+        self.calls = 0
+        self.containers_data = dict(('%064x' % i, {
+            'Id': '%064x' % i,
+            'Name': '/project.instance%s.abc' % i,
+            'State': {'Running': True},
+        }) for i in range(CONTAINERS))
+        self.images_data = dict(('%064x' % (1000 + i), {
+            'Id': '%064x' % (1000 + i),
+            'RepoTags': ['project/%s' % i],
+        }) for i in range(IMAGES))
+
+    def call(self, count=1):
+        self.calls += count
+        time.sleep(self.cost * count)
+
+    def containers(self):
+        # One listing call plus one inspect call per container.
+        self.call(1 + len(self.containers_data))
+        return sorted(self.containers_data.values(), key=lambda c: c['Id'])
+
+    def images(self, dangling=False):
+        self.call(1 + len(self.images_data))
+        return sorted(self.images_data.values(), key=lambda i: i['Id'])
+
+    def inspect_container(self, reference):
+        self.call()
+        return self.containers_data.get(reference)
+
+    def inspect_image(self, reference):
+        self.call()
+        return self.images_data.get(reference)
+
+
+def relisting_enrichment(event):
+    """The enrichment before targeted lookups: re-list everything."""
+    for c in docker.containers(True):
+        if c.id == event.id:
+            event.container = c
+    for i in docker.images(True):
+        if i.id == event.id:
+            event.image = i
+    return event
+
+
+def replay(lines, enrich, cost):
+    backend = FakeBackend(cost)
+    with mock.patch('dork.docker._backend', return_value=backend):
+        docker.containers(True)
+        docker.images(True)
+        backend.calls = 0
+        start = time.time()
+        for data in docker._json_lines(lines):
+            event = docker.Event(data)
+            docker._apply_event(event)
+            assert enrich(event).container
+        elapsed = time.time() - start
+    return elapsed, backend.calls
+
+
+def main():
+    cost = float(sys.argv[1]) / 1000 if len(sys.argv) > 1 else 0.00005
+    lines = record_burst()
+    print('Replaying %s events against %s containers and %s images, '
+          '%.2f ms per API call.' % (len(lines), CONTAINERS, IMAGES, cost * 1000))
+    for name, enrich in [('re-listing', relisting_enrichment),
+                         ('targeted', docker.__event_object)]:
+        elapsed, calls = replay(lines, enrich, cost)
+        print('%12s: %8.3fs, %7d API calls, %8.1f events/s' % (
+            name, elapsed, calls, len(lines) / elapsed))
+
+
+if __name__ == '__main__':
+    main()
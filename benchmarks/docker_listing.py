@@ -0,0 +1,155 @@
+"""
+Benchmark container listing against a simulated docker host.
+
+Every "docker" subprocess is replaced by a fake that sleeps for a fixed
+process spawn cost, so the numbers show how listing time grows with the
+number of containers when inspecting one object per process compared to
+batched inspection.
+
+The Engine API backend is measured the same way, with every request
+sleeping for a round trip: inspecting each listed container with its own
+request, compared to building the records from the listing.
+
+Usage: python benchmarks/docker_listing.py [spawn cost in ms] [round trip in ms]
+"""
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import mock
+import dork.docker as docker
+
+
+def fake_host(count, spawn_cost):
+    """
+    Build a fake check_output for a docker host with [count] containers.
+    """
+    objects = dict(('%064x' % i, {
+        'Id': '%064x' % i,
+        'Image': 'abc',
+        'Name': '/project.instance%s.%040x' % (i, i),
+        'Created': '2015-05-07T14:51:42.041847+02:00',
+        'State': {'Running': True, 'StartedAt': '', 'FinishedAt': ''},
+        'NetworkSettings': {'IPAddress': '172.17.0.1', 'Ports': {}},
+        'HostConfig': {'Binds': ['/var/source/project:/var/source']},
+    }) for i in range(count))
+
+    calls = []
+
+    def check_output(cmd, *args, **kwargs):
+        calls.append(cmd)
+        time.sleep(spawn_cost)
+        if cmd[1] == 'ps':
+            return '\n'.join(sorted(objects)) + '\n'
+        if cmd[1] == 'inspect':
+            ids = [c for c in cmd[2:] if not c.startswith('--')]
+            return json.dumps([objects[i] for i in ids])
+        return ''
+
+    return check_output, calls
+
+
+def fake_engine(count, round_trip):
+    """
+    Build a fake request method for an Engine API with [count] containers.
+    """
+    summaries = [{
+        'Id': '%064x' % i,
+        'Names': ['/project.instance%s.%040x' % (i, i)],
+        'ImageID': 'abc',
+        'Created': 1431003102,
+        'State': 'running',
+        'Labels': {},
+        'Ports': [],
+        'NetworkSettings': {
+            'Networks': {'bridge': {'IPAddress': '172.17.0.1'}}},
+        'Mounts': [{'Type': 'bind', 'Source': '/var/source/project',
+                    'Destination': '/var/source'}],
+    } for i in range(count)]
+    objects = dict((s['Id'], docker._container_record(s)) for s in summaries)
+
+    calls = []
+
+    def request(pool, method, path, *args, **kwargs):
+        calls.append(path)
+        time.sleep(round_trip)
+        if path == 'containers/json':
+            return json.dumps(summaries)
+        return json.dumps(objects[path.split('/')[1]])
+
+    return request, calls
+
+
+def per_object_listing():
+    """The listing strategy before batching: one inspect per container."""
+    result = []
+    for cid in docker.check_output(['docker', 'ps', '-aq']).splitlines():
+        data = json.loads(docker.check_output(['docker', 'inspect', cid]))
+        result.append(docker.Container(data[0]))
+    return result
+
+
+def batched_listing():
+    return docker.containers(True)
+
+
+def per_request_listing():
+    """The API listing before records were built from it."""
+    backend = docker._backend()
+    pool = getattr(backend, '_ApiBackend__pool')
+    result = []
+    for summary in json.loads(pool.request('GET', 'containers/json')):
+        data = pool.request('GET', 'containers/%s/json' % summary['Id'])
+        result.append(docker.Container(json.loads(data)))
+    return result
+
+
+def measure(listing, count, spawn_cost):
+    check_output, calls = fake_host(count, spawn_cost)
+    with mock.patch('dork.docker._backend', return_value=docker.CliBackend()):
+        with mock.patch('dork.docker.check_output', check_output):
+            start = time.time()
+            result = listing()
+            elapsed = time.time() - start
+    assert len(result) == count
+    return elapsed, len(calls)
+
+
+def measure_api(listing, count, round_trip):
+    request, calls = fake_engine(count, round_trip)
+    backend = docker.ApiBackend('unix:///var/run/docker.sock')
+    with mock.patch('dork.docker._backend', return_value=backend):
+        with mock.patch('dork.docker._ConnectionPool.request', request):
+            start = time.time()
+            result = listing()
+            elapsed = time.time() - start
+    assert len(result) == count
+    return elapsed, len(calls)
+
+
+def main():
+    spawn_cost = float(sys.argv[1]) / 1000 if len(sys.argv) > 1 else 0.01
+    round_trip = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.001
+    print('Simulated process spawn cost: %.0f ms' % (spawn_cost * 1000))
+    print('%10s %18s %18s' % ('containers', 'per object', 'batched'))
+    for count in [10, 50, 100, 300, 600]:
+        single, single_calls = measure(per_object_listing, count, spawn_cost)
+        batch, batch_calls = measure(batched_listing, count, spawn_cost)
+        print('%10d %9.3fs (%4d) %9.3fs (%4d)' % (
+            count, single, single_calls, batch, batch_calls))
+
+    print('Simulated API round trip: %.0f ms' % (round_trip * 1000))
+    print('%10s %18s %18s' % ('containers', 'per request', 'listing'))
+    for count in [10, 50, 100, 300, 600]:
+        single, single_calls = measure_api(
+            per_request_listing, count, round_trip)
+        listed, listed_calls = measure_api(batched_listing, count, round_trip)
+        print('%10d %9.3fs (%4d) %9.3fs (%4d)' % (
+            count, single, single_calls, listed, listed_calls))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""
+Measure the memory footprint of Container and Image objects.
+
+Compares the full inspect data the objects used to hold with the compact
+records they keep now, for a realistic "docker inspect" result.
+
+Usage: python benchmarks/docker_memory.py [number of containers]
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import dork.docker as docker
+
+
+def inspect_data(i):
+    """
+    A realistic container as returned by "docker inspect".
+
+    :rtype: dict
+    """
+    cid = '%064x' % i
+    name = '/project.instance%s.%040x' % (i, i)
+    return {
+        'Id': cid,
+        'Created': '2015-05-07T14:51:42.041847+02:00',
+        'Path': '/usr/bin/supervisord',
+        'Args': [],
+        'State': {
+            'Status': 'running', 'Running': True, 'Paused': False,
+            'Restarting': False, 'OOMKilled': False, 'Dead': False,
+            'Pid': 4242 + i, 'ExitCode': 0, 'Error': '',
+            'StartedAt': '2015-06-01T10:00:00.123456789Z',
+            'FinishedAt': '0001-01-01T00:00:00Z',
+        },
+        'Image': 'sha256:%064x' % (i + 1),
+        'ResolvConfPath': '/var/lib/docker/containers/%s/resolv.conf' % cid,
+        'HostnamePath': '/var/lib/docker/containers/%s/hostname' % cid,
+        'HostsPath': '/var/lib/docker/containers/%s/hosts' % cid,
+        'LogPath': '/var/lib/docker/containers/%s/%s-json.log' % (cid, cid),
+        'Name': name,
+        'RestartCount': 0,
+        'Driver': 'overlay2',
+        'MountLabel': '',
+        'ProcessLabel': '',
+        'AppArmorProfile': 'docker-default',
+        'HostConfig': {
+            'Binds': [
+                '/var/source/project/instance%s:/var/source' % i,
+                '/var/build/project/instance%s:/var/build' % i,
+                '/var/log/dork/project/instance%s:/var/log/dork' % i,
+                '/var/data/project:/var/data',
+            ],
+            'NetworkMode': 'default', 'PortBindings': {},
+            'RestartPolicy': {'Name': 'no', 'MaximumRetryCount': 0},
+            'PublishAllPorts': True, 'Privileged': False,
+            'CpuShares': 0, 'Memory': 0, 'ShmSize': 67108864,
+        },
+        'GraphDriver': {'Name': 'overlay2', 'Data': {
+            'LowerDir': '/var/lib/docker/overlay2/%s-init/diff' % cid,
+            'MergedDir': '/var/lib/docker/overlay2/%s/merged' % cid,
+            'UpperDir': '/var/lib/docker/overlay2/%s/diff' % cid,
+            'WorkDir': '/var/lib/docker/overlay2/%s/work' % cid,
+        }},
+        'Mounts': [{
+            'Type': 'bind', 'Source': source, 'Destination': target,
+            'Mode': '', 'RW': True, 'Propagation': 'rprivate',
+        } for source, target in [
+            ('/var/source/project/instance%s' % i, '/var/source'),
+            ('/var/build/project/instance%s' % i, '/var/build'),
+            ('/var/log/dork/project/instance%s' % i, '/var/log/dork'),
+            ('/var/data/project', '/var/data'),
+        ]],
+        'Config': {
+            'Hostname': 'instance%s.project.dork' % i,
+            'Domainname': '', 'User': '', 'Tty': False,
+            'ExposedPorts': {'22/tcp': {}, '80/tcp': {}, '3306/tcp': {}},
+            'Env': ['PATH=/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin',
+                    'DEBIAN_FRONTEND=noninteractive', 'HOME=/root'],
+            'Cmd': ['/usr/bin/supervisord'],
+            'Image': 'project/%040x' % i,
+            'Volumes': None, 'WorkingDir': '', 'Entrypoint': None,
+            'Labels': {},
+        },
+        'NetworkSettings': {
+            'Bridge': '', 'SandboxID': '%064x' % (i + 2),
+            'HairpinMode': False,
+            'Ports': {
+                '22/tcp': [{'HostIp': '0.0.0.0', 'HostPort': '32768'}],
+                '80/tcp': [{'HostIp': '0.0.0.0', 'HostPort': '32769'}],
+                '3306/tcp': [{'HostIp': '0.0.0.0', 'HostPort': '32770'}],
+            },
+            'Gateway': '172.17.0.1', 'IPAddress': '172.17.0.%s' % (i % 250 + 2),
+            'IPPrefixLen': 16, 'MacAddress': '02:42:ac:11:00:02',
+            'Networks': {'bridge': {
+                'NetworkID': '%064x' % (i + 3), 'EndpointID': '%064x' % (i + 4),
+                'Gateway': '172.17.0.1', 'IPAddress': '172.17.0.2',
+                'IPPrefixLen': 16, 'MacAddress': '02:42:ac:11:00:02',
+            }},
+        },
+    }
+
+
+def deep_size(obj, seen=None):
+    """
+    Approximate the memory used by an object and everything it references.
+
+    :rtype: int
+    """
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            size += deep_size(key, seen) + deep_size(value, seen)
+    elif isinstance(obj, (list, tuple, set)):
+        for item in obj:
+            size += deep_size(item, seen)
+    else:
+        for cls in type(obj).__mro__:
+            for slot in getattr(cls, '__slots__', ()):
+                if slot.startswith('__'):
+                    slot = '_%s%s' % (cls.__name__, slot)
+                if hasattr(obj, slot):
+                    size += deep_size(getattr(obj, slot), seen)
+    return size
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    raw = [inspect_data(i) for i in range(count)]
+    records = [docker.Container(data) for data in raw]
+
+    raw_size = sum(deep_size(data) for data in raw)
+    record_size = sum(deep_size(record) for record in records)
+    print('%d containers' % count)
+    print('  inspect data: %8d bytes per container, %6.1f KiB total' % (
+        raw_size / count, raw_size / 1024.0))
+    print('  records:      %8d bytes per container, %6.1f KiB total' % (
+        record_size / count, record_size / 1024.0))
+
+    image_data = {'Id': 'sha256:%064x' % 1,
+                  'RepoTags': ['project/%040x:latest' % 1],
+                  'Created': '2015-05-07T14:51:42.041847+02:00'}
+    print('  image record: %8d bytes' % deep_size(docker.Image(image_data)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Benchmark squashing a container: a temporary tar file compared to
+streaming the export directly into the import.
+
+Docker is replaced by a generated export stream and a "cat" process
+consuming the import, so the numbers show the cost of the transfer itself.
+Every strategy runs in its own process to record its peak memory use.
+
+Usage: python benchmarks/docker_squash.py [container size in MiB]
+"""
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import mock
+import dork.docker as docker
+
+
+class FakeBackend(docker.CliBackend):
+    """Exports [size] bytes and imports into a "cat" process."""
+
+    def __init__(self, size):
+        self.size = size
+        self.peak_disk = 0
+
+    def export(self, cid):
+        block = os.urandom(docker._block_size)
+        remaining = self.size
+        while remaining > 0:
+            yield block[:remaining]
+            remaining -= len(block)
+
+    def import_image(self, blocks, name, labels):
+        with mock.patch('dork.docker.Popen', self.__cat):
+            docker.CliBackend.import_image(self, blocks, name, labels)
+
+    @staticmethod
+    def __cat(cmd, **kwargs):
+        return subprocess.Popen(['cat'], **kwargs)
+
+
+def tempfile_squash(backend):
+    """The strategy before streaming: export to disk, then import."""
+    temp = tempfile.NamedTemporaryFile(delete=False)
+    with temp:
+        for block in backend.export('1'):
+            temp.write(block)
+    backend.peak_disk = os.path.getsize(temp.name)
+
+    def blocks():
+        with open(temp.name, 'rb') as f:
+            for block in iter(lambda: f.read(docker._block_size), ''):
+                yield block
+    backend.import_image(blocks(), 'project/hash', {})
+    os.unlink(temp.name)
+
+
+def streaming_squash(backend):
+    backend.import_image(backend.export('1'), 'project/hash', {})
+
+
+def run(strategy, size):
+    backend = FakeBackend(size)
+    start = time.time()
+    with mock.patch('dork.docker._image_refresh'):
+        strategy(backend)
+    elapsed = time.time() - start
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print('%s %s %s' % (elapsed, peak_memory, backend.peak_disk))
+
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == '--run':
+        strategy = globals()[sys.argv[2]]
+        return run(strategy, int(sys.argv[3]))
+
+    mib = int(sys.argv[1]) if len(sys.argv) > 1 else 512
+    print('Container size: %d MiB' % mib)
+    print('%18s %10s %10s %14s %14s' % (
+        'strategy', 'time', 'MiB/s', 'peak memory', 'peak disk'))
+    for strategy in ['tempfile_squash', 'streaming_squash']:
+        output = subprocess.check_output([
+            sys.executable, __file__, '--run', strategy, str(mib << 20)])
+        elapsed, memory, disk = output.split()
+        print('%18s %9.2fs %10.1f %10d KiB %10d MiB' % (
+            strategy, float(elapsed), mib / float(elapsed), int(memory),
+            int(disk) >> 20))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""
+Benchmark ancestry queries on a synthetic repository: one
+"git merge-base --is-ancestor" process per query compared to the in-memory
+commit graph.
+
+The repository is generated with "git fast-import": a main line with
+branches forking off and merging back, like a project with many feature
+branches.
+
+Usage: python benchmarks/git_ancestry.py [commits] [branches] [queries]
+"""
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import dork.git as git
+
+
+def build_repository(directory, commits, branches):
+    """
+    Generate [commits] commits, spread over a main line and [branches]
+    branches that fork off and merge back into it.
+
+    :rtype: list[str]
+    """
+    subprocess.check_call(['git', 'init', '-q', directory])
+    stream = []
+    mark = 0
+    heads = {}
+    for i in range(commits):
+        mark += 1
+        branch = 'master' if i % 3 == 0 else 'branch%d' % (i % branches)
+        parent = heads.get(branch) or heads.get('master')
+        stream.append('commit refs/heads/%s\nmark :%d\n'
+                      'committer Dork <dork@example.com> %d +0000\n'
+                      'data 0\n' % (branch, mark, 1400000000 + i))
+        if parent:
+            stream.append('from :%d\n' % parent)
+        # Merge a branch back into master every now and then.
+        merged = heads.get('branch%d' % (i // 3 % branches))
+        if branch == 'master' and i % 30 == 0 and merged:
+            stream.append('merge :%d\n' % merged)
+        heads[branch] = mark
+        stream.append('\n')
+    process = subprocess.Popen(['git', 'fast-import', '--quiet'],
+                               cwd=directory, stdin=subprocess.PIPE)
+    process.communicate(''.join(stream))
+    return subprocess.check_output(
+        ['git', 'rev-list', '--all'], cwd=directory).split()
+
+
+def merge_base(directory, pairs):
+    for ancestor, descendant in pairs:
+        subprocess.call(
+            ['git', 'merge-base', '--is-ancestor', ancestor, descendant],
+            cwd=directory, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+def commit_graph(directory, pairs):
+    graph = git.CommitGraph.load(directory)
+    for ancestor, descendant in pairs:
+        graph.is_ancestor(ancestor, descendant)
+
+
+def measure(strategy, directory, pairs):
+    start = time.time()
+    strategy(directory, pairs)
+    return time.time() - start
+
+
+def main():
+    commits = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    branches = int(sys.argv[2]) if len(sys.argv) > 2 else 80
+    queries = int(sys.argv[3]) if len(sys.argv) > 3 else 500
+    directory = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        hashes = build_repository(directory, commits, branches)
+        print('Generated %d commits on %d branches in %.1fs.' % (
+            len(hashes), branches, time.time() - start))
+
+        random.seed(42)
+        pairs = [(random.choice(hashes), random.choice(hashes))
+                 for _ in range(queries)]
+        single = measure(merge_base, directory, pairs)
+        graph = measure(commit_graph, directory, pairs)
+        many = measure(commit_graph, directory, pairs * 20)
+        print('%d queries' % queries)
+        print('  merge-base:   %8.3fs' % single)
+        print('  commit graph: %8.3fs (including loading the graph)' % graph)
+        print('  commit graph: %8.3fs for %d queries' % (many, queries * 20))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Benchmark loading the metadata of many roles: parsing every meta file
+with the pure Python YAML loader, with the libyaml loader, and reading
+the parsed metadata from the persistent cache.
+
+Usage: python benchmarks/role_metadata.py [roles]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import mock
+import yaml
+import dork.config as config
+import dork.matcher as matcher
+
+
+def build_roles(directory, count):
+    """
+    Write [count] roles with dependencies, services, triggers and settings.
+    """
+    for i in range(count):
+        meta = os.path.join(directory, 'role%d' % i, 'meta')
+        os.makedirs(meta)
+        with open(os.path.join(meta, 'main.yml'), 'w') as f:
+            f.write(yaml.safe_dump({
+                'galaxy_info': {'author': 'dork', 'license': 'MIT',
+                                'platforms': [{'name': 'Ubuntu',
+                                               'versions': ['trusty']}]},
+                'dependencies': ['role%d' % j for j in range(max(0, i - 3), i)],
+            }, default_flow_style=False))
+        with open(os.path.join(meta, 'dork.yml'), 'w') as f:
+            f.write(yaml.safe_dump({
+                'services': {'service%d' % i: 8000 + i},
+                'build_triggers': {'trigger%d' % i: ['**/*.ext%d' % i,
+                                                     {'*.info': 'core = %d' % i}]},
+                'update_triggers': [{'**/*.ext%d' % i: ['tag%d' % i]}],
+                'settings': dict(('setting%d' % j, j) for j in range(10)),
+            }, default_flow_style=False))
+
+
+def load(directory, memory=True, persistent=True):
+    if not memory:
+        getattr(matcher, '__metadata').clear()
+        getattr(matcher, '__listings').clear()
+    if not persistent:
+        getattr(matcher, '__compiled').clear()
+    start = time.time()
+    roles = getattr(matcher, '_role_metadata')(directory)
+    return time.time() - start, roles
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    directory = tempfile.mkdtemp()
+    state = tempfile.mkdtemp()
+    try:
+        build_roles(directory, count)
+        with mock.patch.object(config.config, 'state_directory', state):
+            print('%d roles' % count)
+            with mock.patch.object(matcher, '_yaml_loader', yaml.SafeLoader):
+                python, expected = load(directory, False, False)
+            libyaml, roles = load(directory, False, False)
+            assert roles == expected
+            persistent, roles = load(directory, False)
+            assert roles == expected
+            memory, roles = load(directory)
+            assert roles == expected
+            print('  cold, pure python YAML: %8.3fs' % python)
+            print('  cold, libyaml:          %8.3fs' % libyaml)
+            print('  warm, persistent cache: %8.3fs' % persistent)
+            print('  warm, in memory:        %8.3fs' % memory)
+            getattr(matcher, '__compiled').close()
+    finally:
+        shutil.rmtree(directory)
+        shutil.rmtree(state)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Benchmark build trigger evaluation on a synthetic working tree: one glob
+walk per pattern, like every role did before, compared to the batch
+matcher testing all patterns of all roles against one file index.
+
+The tree resembles a PHP project with vendored dependencies, and the
+patterns are typical build triggers of [roles] roles.
+
+Usage: python benchmarks/role_triggers.py [files] [roles]
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import dork.git as git
+from dork.matcher import PatternMatcher
+
+
+def build_tree(directory, files):
+    """
+    Create [files] files spread over nested module and vendor directories.
+    """
+    subprocess.check_call(['git', 'init', '-q', directory])
+    extensions = ['php', 'inc', 'module', 'js', 'css', 'twig', 'yml', 'info']
+    for i in range(files):
+        folder = os.path.join(
+            directory, ['modules', 'vendor', 'themes'][i % 3],
+            'package%d' % (i % 50), 'src%d' % (i % 7))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        name = 'file%d.%s' % (i, extensions[i % len(extensions)])
+        with open(os.path.join(folder, name), 'w') as f:
+            f.write('core = 7.x\n')
+    with open(os.path.join(directory, 'index.php'), 'w') as f:
+        f.write('<?php\n')
+
+
+def trigger_patterns(roles):
+    """
+    Three build trigger patterns per role, the way role metadata uses them.
+
+    :rtype: list[str]
+    """
+    patterns = []
+    for i in range(roles):
+        patterns += [
+            'role%d.json' % i,
+            '**/*.role%d' % i,
+            'modules/package%d/*/*.info' % (i % 60),
+        ]
+    patterns += ['index.php', '*.php', '**/*.module']
+    return patterns
+
+
+def per_pattern(repository, patterns):
+    """The evaluation strategy before the file index: a walk per pattern."""
+    result = {}
+    for pattern in patterns:
+        path = '%s/%s' % (repository.directory, pattern)
+        if '*' in pattern:
+            result[pattern] = len(git.gitless_globber.glob(path)) > 0
+        else:
+            result[pattern] = os.path.exists(path)
+    return result
+
+
+def batched(repository, patterns):
+    getattr(git, '__file_indexes').clear()
+    matcher = PatternMatcher(repository)
+    for pattern in patterns:
+        matcher.add(pattern)
+    return dict((pattern, matcher.matches(pattern)) for pattern in patterns)
+
+
+def measure(strategy, repository, patterns):
+    start = time.time()
+    result = strategy(repository, patterns)
+    return time.time() - start, result
+
+
+def main():
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    roles = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+    directory = tempfile.mkdtemp()
+    try:
+        build_tree(directory, files)
+        repository = git.Repository(directory)
+        patterns = trigger_patterns(roles)
+        print('%d files, %d roles, %d patterns' % (files, roles, len(patterns)))
+        single, expected = measure(per_pattern, repository, patterns)
+        batch, result = measure(batched, repository, patterns)
+        assert result == expected
+        print('  per pattern walks: %8.3fs' % single)
+        print('  file index:        %8.3fs' % batch)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
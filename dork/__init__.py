@@ -4,6 +4,7 @@ import config
 from terminaltables import AsciiTable
 from dork import Dork, Mode, State, Status
 from git import Commit
+from matcher import rebuild
 import json
 
 
@@ -29,6 +30,15 @@ def main():
         """)
     parser.set_defaults(logging='warn')
 
+    # Cache statistics argument
+    parser.add_argument(
+        '--cache-stats',
+        action='store_true',
+        help="""
+        Print cache usage statistics when the command finishes, or on
+        SIGUSR1 while serving.
+        """)
+
     subparsers = parser.add_subparsers(help="command help")
 
     # ======================================================================
@@ -301,6 +311,37 @@ def main():
 
     cmd_commit.set_defaults(func=func_commit)
     # ======================================================================
+    # migrate command
+    # ======================================================================
+    cmd_migrate = subparsers.add_parser(
+        'migrate',
+        help="""
+        Label images created by older versions of dork.
+        """)
+
+    def func_migrate(params):
+        for d in Dork.scan(os.path.abspath(params.directory)):
+            if not d.migrate():
+                return -1
+
+    cmd_migrate.set_defaults(func=func_migrate)
+    # ======================================================================
+    # roles command
+    # ======================================================================
+    cmd_roles = subparsers.add_parser(
+        'roles',
+        help="""
+        Rebuild the role metadata cache.
+        """)
+
+    def func_roles(params):
+        directories = list(config.config.ansible_roles_path)
+        for d in Dork.scan(os.path.abspath(params.directory)):
+            directories.append(d.repository.directory + '/.dork')
+        print("Cached metadata of %s roles." % rebuild(directories))
+
+    cmd_roles.set_defaults(func=func_roles)
+    # ======================================================================
     # squash command
     # ======================================================================
     cmd_squash = subparsers.add_parser(
@@ -386,7 +427,10 @@ def main():
             killsignal.on_completed()
         signal.signal(signal.SIGTERM, kill)
 
-        eventstream = docker.events(killsignal)
+        eventstream = docker.events(killsignal, {
+            'type': ['container'],
+            'event': ['start', 'stop', 'die', 'rename', 'destroy'],
+        })
 
         services.dns.server(config.config, eventstream, killsignal)
         services.proxy.server(config.config, eventstream, killsignal)
@@ -415,7 +459,28 @@ def main():
 
     # parse arguments and execute 'func'
     args = parser.parse_args()
-    return args.func(args)
+    if not args.cache_stats:
+        return args.func(args)
+
+    import signal
+    signal.signal(signal.SIGUSR1, lambda signum, frame: print_cache_stats())
+    try:
+        return args.func(args)
+    finally:
+        print_cache_stats()
+
+
+def print_cache_stats():
+    """Print usage statistics of all caches to stderr."""
+    import sys
+    import cache
+    rows = [['Cache', 'Entries', 'Capacity', 'Hits', 'Misses', 'Evictions']]
+    for stats in cache.statistics():
+        rows.append([str(value) for value in stats])
+    table = AsciiTable(rows)
+    table.outer_border = False
+    table.inner_column_border = False
+    sys.stderr.write("\n" + table.table + "\n")
 
 if __name__ == '__main__':
     main()
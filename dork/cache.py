@@ -0,0 +1,282 @@
+"""
+Caches for results that are expensive to compute.
+"""
+import config
+from collections import OrderedDict
+import atexit
+import json
+import sqlite3
+import state
+import threading
+import time
+
+# All caches, for reporting statistics.
+__caches = []
+
+
+def statistics():
+    """
+    Usage counters of all caches.
+
+    :return: Name, entries, capacity, hits, misses and evictions per cache.
+    :rtype: list[(str, int, int, int, int, int)]
+    """
+    return [cache.statistics() for cache in __caches]
+
+
+def _register(cache):
+    __caches.append(cache)
+
+
+class LRUCache:
+    """
+    An in-memory cache holding at most [capacity] entries. The least
+    recently used entries are evicted first.
+    """
+
+    __missing = object()
+
+    def __init__(self, name, capacity=None):
+        """
+        :param str name: Identifies the cache in statistics and
+            configuration.
+        :param int capacity: Default maximum number of entries, instead of
+            [Config.memory_cache_capacity]. "memory_cache_<name>" still
+            overrides it.
+        """
+        self.__name = name
+        self.__default = capacity
+        self.__capacity = None
+        self.__entries = OrderedDict()
+        self.__lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        _register(self)
+
+    @property
+    def capacity(self):
+        """:rtype: int"""
+        if self.__capacity is None:
+            self.__capacity = config.config.memory_cache_capacity(
+                self.__name, self.__default)
+        return self.__capacity
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __contains__(self, key):
+        return key in self.__entries
+
+    def get(self, key, default=None):
+        """
+        Retrieve an entry and mark it as recently used.
+        """
+        with self.__lock:
+            value = self.__entries.pop(key, self.__missing)
+            if value is self.__missing:
+                self.misses += 1
+                return default
+            self.__entries[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self.__lock:
+            self.__entries.pop(key, None)
+            self.__entries[key] = value
+            while len(self.__entries) > self.capacity:
+                self.__entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self.__lock:
+            return self.__entries.pop(key, default)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
+    def statistics(self):
+        """:rtype: (str, int, int, int, int, int)"""
+        return (self.__name, len(self.__entries), self.capacity,
+                self.hits, self.misses, self.evictions)
+
+
+class PersistentCache:
+    """
+    A key value cache shared between dork processes, stored in a SQLite
+    database in the state directory. Values have to be JSON serializable and
+    not None.
+
+    Once the cache holds more than [capacity] entries, the least recently
+    used ones are evicted.
+    """
+
+    # Eviction is checked every [check_interval] writes.
+    check_interval = 100
+
+    __schema = [
+        'CREATE TABLE IF NOT EXISTS entries (cache TEXT, key TEXT, '
+        'value TEXT NOT NULL, used REAL NOT NULL, PRIMARY KEY (cache, key))',
+        'CREATE INDEX IF NOT EXISTS entries_used ON entries (cache, used)',
+    ]
+
+    def __init__(self, name, capacity=None):
+        """
+        :param str name: Separates caches within the database.
+        :param int capacity: Maximum number of entries, defaults to
+            [Config.cache_capacity].
+        """
+        self.__name = name
+        self.__capacity = capacity
+        self.__connection = None
+        self.__failed = False
+        self.__lock = threading.RLock()
+        self.__used = set()
+        self.__writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        atexit.register(self.flush)
+        _register(self)
+
+    @property
+    def capacity(self):
+        """:rtype: int"""
+        return self.__capacity or config.config.cache_capacity
+
+    def __db(self):
+        """
+        The cache database, or None if it can't be opened. Dork keeps
+        working without a persistent cache.
+
+        :rtype: sqlite3.Connection
+        """
+        if self.__connection is None and not self.__failed:
+            try:
+                self.__connection = state.connect('cache.db', self.__schema)
+            except (sqlite3.Error, OSError):
+                self.__failed = True
+        return self.__connection
+
+    def get(self, key):
+        """
+        :type key: str
+        :return: The cached value or None.
+        """
+        with self.__lock:
+            db = self.__db()
+            if db is None:
+                return None
+            try:
+                row = db.execute(
+                    'SELECT value FROM entries WHERE cache = ? AND key = ?',
+                    (self.__name, key)).fetchone()
+            except sqlite3.Error:
+                # Locked or broken, behave like an empty cache.
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.__used.add(key)
+            return json.loads(row[0])
+
+    def set(self, key, value):
+        """
+        :type key: str
+        """
+        with self.__lock:
+            db = self.__db()
+            if db is None:
+                return
+            try:
+                with db:
+                    db.execute(
+                        'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                        (self.__name, key, json.dumps(value), time.time()))
+            except sqlite3.Error:
+                return
+            self.__writes += 1
+            if self.__writes % self.check_interval == 0:
+                self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries beyond [capacity], and some
+        more to leave room for new ones.
+        """
+        with self.__lock:
+            db = self.__db()
+            if db is None:
+                return
+            self.flush()
+            try:
+                with db:
+                    count = db.execute(
+                        'SELECT COUNT(*) FROM entries WHERE cache = ?',
+                        (self.__name,)).fetchone()[0]
+                    if count > self.capacity:
+                        self.evictions += db.execute(
+                            'DELETE FROM entries WHERE rowid IN (SELECT rowid '
+                            'FROM entries WHERE cache = ? ORDER BY used, rowid LIMIT ?)',
+                            (self.__name, count - self.capacity * 9 // 10)).rowcount
+            except sqlite3.Error:
+                pass
+
+    def flush(self):
+        """
+        Record which entries have been used, in one transaction instead of
+        one per lookup.
+        """
+        with self.__lock:
+            if not self.__used or self.__connection is None:
+                return
+            now = time.time()
+            try:
+                with self.__connection:
+                    self.__connection.executemany(
+                        'UPDATE entries SET used = ? WHERE cache = ? AND key = ?',
+                        [(now, self.__name, key) for key in self.__used])
+            except sqlite3.Error:
+                pass
+            self.__used.clear()
+
+    def clear(self):
+        """
+        Remove all entries.
+        """
+        with self.__lock:
+            db = self.__db()
+            if db is None:
+                return
+            try:
+                with db:
+                    db.execute('DELETE FROM entries WHERE cache = ?',
+                               (self.__name,))
+            except sqlite3.Error:
+                pass
+            self.__used.clear()
+
+    def statistics(self):
+        """:rtype: (str, int, int, int, int, int)"""
+        db = self.__db() if self.__connection is not None else None
+        try:
+            entries = db.execute('SELECT COUNT(*) FROM entries WHERE cache = ?',
+                                 (self.__name,)).fetchone()[0] if db else 0
+        except sqlite3.Error:
+            entries = 0
+        return ('%s (persistent)' % self.__name, entries, self.capacity,
+                self.hits, self.misses, self.evictions)
+
+    def close(self):
+        """
+        Close the database, it's reopened on the next access.
+        """
+        with self.__lock:
+            if self.__connection is not None:
+                self.flush()
+                self.__connection.close()
+            self.__connection = None
+            self.__failed = False
@@ -57,6 +57,37 @@ class Config:
         return self.get_value('ansible_roles_path',
                               '/etc/ansible/roles:/opt/roles').split(':')
 
+    @property
+    def scan_depth(self):
+        """
+        How many directory levels deep repositories are searched.
+
+        :rtype: int
+        """
+        return int(self.get_value('scan_depth', 8))
+
+    @property
+    def scan_exclude(self):
+        """
+        Glob patterns of directory names that are never searched for
+        repositories.
+
+        :rtype: list[str]
+        """
+        return self.get_value(
+            'scan_exclude', 'node_modules:vendor:bower_components').split(':')
+
+    @property
+    def trigger_files(self):
+        """
+        Which files build trigger patterns are matched against: "all" files
+        in the working tree, or only the files "tracked" by git. Patterns
+        for data:/ always use the filesystem.
+
+        :rtype: str
+        """
+        return self.get_value('trigger_files', 'all')
+
     @property
     def host_source_directory(self):
         """
@@ -133,6 +164,37 @@ class Config:
         """
         return self.get_value('dork_data_directory', '/var/data')
 
+    @property
+    def state_directory(self):
+        """
+        Directory for dork's own state, like container hashes and caches.
+        Shared by everyone using dork on the host.
+
+        :rtype: str
+        """
+        return self.get_value('state_directory', '/var/lib/dork')
+
+    @property
+    def cache_capacity(self):
+        """
+        Maximum number of entries in each persistent cache.
+
+        :rtype: int
+        """
+        return int(self.get_value('cache_capacity', 100000))
+
+    def memory_cache_capacity(self, name, default=None):
+        """
+        Maximum number of entries in the in-memory cache [name]. Configured
+        per cache as "memory_cache_<name>". Otherwise the cache's own
+        [default] applies, or "memory_cache_capacity" for all of them.
+
+        :rtype: int
+        """
+        if default is None:
+            default = self.get_value('memory_cache_capacity', 10000)
+        return int(self.get_value('memory_cache_%s' % name, default))
+
     @property
     def docker_address(self):
         """
@@ -142,6 +204,27 @@ class Config:
         """
         return self.get_value('docker_address', '$DOCKER_HOST')
 
+    @property
+    def docker_backend(self):
+        """
+        How to talk to docker. "api" uses the Engine API at
+        [docker_address] or the local socket, "cli" runs the docker command
+        line client.
+
+        :rtype: str
+        """
+        return self.get_value('docker_backend', 'api')
+
+    @property
+    def docker_name_fallback(self):
+        """
+        Also match containers and images by name, for objects created
+        before dork labelled them. "yes" or "no".
+
+        :rtype: str
+        """
+        return self.get_value('docker_name_fallback', 'yes')
+
     @property
     def max_containers(self):
         """
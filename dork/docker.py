@@ -2,72 +2,150 @@
 Simple API to docker.
 """
 
-import requests
 from git import Repository
 from config import config
-from subprocess import check_output, call, Popen, PIPE
+import state
+from subprocess import check_output, call, Popen, PIPE, CalledProcessError
 from dateutil.parser import parse as parse_date
+from dateutil.tz import tzutc, tzoffset
+from datetime import datetime
+from urlparse import urlparse
+from collections import OrderedDict
+import httplib
+import itertools
 import json
 import os
+import Queue
+import socket
+import urllib
 import rx
 import rx.subjects
 import threading
+import time
 import re
 from rx import Observable
 
 
-def __eventstream(stream, killsignal):
-    process = Popen('docker events', stdout=PIPE, shell=True)
-    killsignal.subscribe(lambda v: process.kill())
-    for line in iter(process.stdout.readline, ''):
-        stream.on_next(line)
-
-eventpattern = re.compile('(.*?) (.*):.*?([a-z]*)$')
-
-
-def __parseevent(line):
-    return {
-        'timestamp': eventpattern.match(line).group(1),
-        'id': eventpattern.match(line).group(2),
-        'event': eventpattern.match(line).group(3),
-    }
+def __eventstream(stream, killsignal, filters):
+    source = _backend().events(filters)
+    killsignal.subscribe(lambda v: source.close())
+    for data in _json_lines(source):
+        event = Event(data)
+        _apply_event(event)
+        stream.on_next(__event_object(event))
 
 
 def __event_object(event):
-    for c in containers(True):
-        if c.id == event['id']:
-            event['container'] = c
-    for i in images(True):
-        if i.id == event['id']:
-            event['image'] = i
+    if event.action in ['destroy', 'delete']:
+        # The object is gone, there is nothing to attach.
+        return event
+    if event.type == 'image':
+        event.image = _image_lookup(event.id)
+    elif event.type == 'container':
+        event.container = _container_lookup(event.id)
     return event
 
 
 _docker_events = None
 
 
-def events(killsignal):
+def events(killsignal, filters=None):
     """
+    Stream docker events. The first call starts reading the event stream,
+    with [filters] applied by docker itself.
+
+    :param dict[str,list[str]] filters: Docker event filters, e.g.
+        {'type': ['container'], 'event': ['start', 'stop']}
     :rtype: Observable
     """
     global _docker_events
     if not _docker_events:
         _docker_events = rx.subjects.Subject()
-        thread = threading.Thread(target=__eventstream, args=(_docker_events, killsignal))
+        thread = threading.Thread(target=__eventstream, args=(
+            _docker_events, killsignal, filters or {}))
         thread.start()
-    return _docker_events.map(__parseevent).map(__event_object)
+    return _docker_events
+
+
+class Event:
+    """
+    A docker event with the container or image it is about attached.
+    """
+    def __init__(self, data):
+        """
+        :param dict data: The event message returned by the Docker API.
+        """
+        actor = data.get('Actor') or {}
+        # Old engines only send "status", "id" and "from".
+        self.type = data.get('Type', 'container')
+        # Exec and health events carry details after a colon.
+        self.action = (data.get('Action') or data.get('status') or '').split(':')[0]
+        self.id = actor.get('ID') or data.get('id')
+        self.attributes = actor.get('Attributes') or {}
+        self.name = self.attributes.get('name')
+        self.time = data.get('time')
+        self.container = None
+        self.image = None
+
+    def __str__(self):
+        return '%s %s %s' % (self.type, self.action, self.name or self.id)
 
 
-class Container:
+class Container(object):
     """
     Class representing a container, providing the necessary information and
     operations.
+
+    Only the fields dork uses are extracted from the inspect data, which is
+    not kept around.
     """
+    __slots__ = ('__id', '__image', '__name', '__labelled', '__project',
+                 '__instance', '__hash', '__running', '__address', '__binds',
+                 '__ports', '__created', '__started', '__finished',
+                 '__timed')
+
     def __init__(self, data):
         """
         :param dict data: dict data: The dataset returned by the Docker API.
         """
-        self.__data = data
+        status = data.get('State') or {}
+        network = data.get('NetworkSettings') or {}
+        host_config = data.get('HostConfig') or {}
+
+        self.__id = data.get('Id')
+        self.__image = data.get('Image')
+        self.__name = data['Name']
+        # Identity is read from labels. Containers created before dork
+        # labelled them are named "project.instance.hash". The hash moves
+        # on with updates, which is tracked in dork's state.
+        labels = (data.get('Config') or {}).get('Labels') or {}
+        segments = self.__name.strip('/').split('.')
+        self.__labelled = LABEL_PROJECT in labels
+        self.__project = labels.get(LABEL_PROJECT, segments[0])
+        self.__instance = labels.get(
+            LABEL_INSTANCE, segments[1] if len(segments) > 1 else None)
+        self.__hash = state.container_hash(self.__id) or labels.get(
+            LABEL_HASH, segments[2] if len(segments) > 2 else None)
+        self.__running = status.get('Running', False)
+        self.__address = network.get('IPAddress')
+
+        # Map container directories to host directories.
+        self.__binds = {}
+        for bind in host_config.get('Binds') or []:
+            parts = bind.split(':')
+            self.__binds[parts[1]] = parts[0]
+
+        # Map exposed ports to the first host port they are published on.
+        self.__ports = {}
+        for port, bindings in (network.get('Ports') or {}).iteritems():
+            if bindings:
+                self.__ports[port] = bindings[0]['HostPort']
+
+        self.__created = _parse_time(data.get('Created'))
+        self.__started = _parse_time(status.get('StartedAt'))
+        self.__finished = _parse_time(status.get('FinishedAt'))
+        # Listings of the Engine API don't contain the times.
+        self.__timed = 'StartedAt' in status
 
     def __str__(self):
         return self.name
@@ -77,14 +155,29 @@ class Container:
         return containers(clear)
 
     @classmethod
-    def create(cls, name, image, volumes, hostname):
-        return create(name, image, volumes, hostname)
+    def registry(cls, clear=False, project=None):
+        return container_registry(clear, project)
 
-    def export(self, filename):
+    @classmethod
+    def create(cls, name, image, volumes, hostname, labels=None):
+        return create(name, image, volumes, hostname, labels)
+
+    def export(self, filename, progress=None):
         """
         Export container to a file.
         """
-        call('docker export %s > %s' % (self.id, filename), shell=True, stdout=open(os.devnull, 'w'))
+        with open(filename, 'wb') as f:
+            for block in _transfer(_backend().export(self.id), progress):
+                f.write(block)
+
+    def squash(self, name, labels=None, progress=None):
+        """
+        Stream the containers filesystem into a new single layer image.
+
+        :param callable progress: Called with the bytes transferred and
+            the seconds passed, every few seconds.
+        """
+        _container_squash(self.id, name, labels, progress)
 
     @property
     def id(self):
@@ -93,7 +186,7 @@ class Container:
 
         :rtype: str
         """
-        return self.__data['Id']
+        return self.__id
 
     @property
     def image(self):
@@ -102,7 +195,7 @@ class Container:
 
         :rtype: str
         """
-        return self.__data['Image']
+        return self.__image
 
     @property
     def name(self):
@@ -111,7 +204,16 @@ class Container:
 
         :rtype: str
         """
-        return self.__data['Name']
+        return self.__name
+
+    @property
+    def labelled(self):
+        """
+        Check if the container carries dork's identity labels.
+
+        :rtype: bool
+        """
+        return self.__labelled
 
     @property
     def project(self):
@@ -120,7 +222,7 @@ class Container:
 
         :rtype: str
         """
-        return self.name.split('.')[0].strip('/')
+        return self.__project
 
     @property
     def instance(self):
@@ -129,16 +231,17 @@ class Container:
 
         :rtype: str
         """
-        return self.name.split('.')[1]
+        return self.__instance
 
     @property
     def hash(self):
         """
-        The containers git hash. Second segment of [Container.name].
+        The commit the container was last updated to. Defaults to the
+        commit it has been created from.
 
         :rtype: str
         """
-        return self.name.split('.')[2]
+        return self.__hash
 
     @property
     def domain(self):
@@ -159,7 +262,7 @@ class Container:
 
         :rtype: bool
         """
-        return self.__data['State']['Running']
+        return self.__running
 
     @property
     def address(self):
@@ -169,7 +272,7 @@ class Container:
         :rtype: str
         """
         if self.running:
-            return self.__data['NetworkSettings']['IPAddress']
+            return self.__address
         else:
             return None
 
@@ -181,13 +284,7 @@ class Container:
 
         :rtype: str
         """
-        directory = None
-        for bind in self.__data['HostConfig']['Binds']:
-            host = bind.split(':')[0]
-            container = bind.split(':')[1]
-            if container == config.dork_source_directory:
-                directory = host
-        return directory
+        return self.__binds.get(config.dork_source_directory)
 
     @property
     def repository(self):
@@ -206,13 +303,7 @@ class Container:
 
         :rtype: str
         """
-        directory = None
-        for bind in self.__data['HostConfig']['Binds']:
-            host = bind.split(':')[0]
-            container = bind.split(':')[1]
-            if container == config.dork_build_directory:
-                directory = host
-        return directory
+        return self.__binds.get(config.dork_build_directory)
 
     @property
     def logs(self):
@@ -222,13 +313,7 @@ class Container:
 
         :rtype: str
         """
-        directory = None
-        for bind in self.__data['HostConfig']['Binds']:
-            host = bind.split(':')[0]
-            container = bind.split(':')[1]
-            if container == config.dork_log_directory:
-                directory = host
-        return directory
+        return self.__binds.get(config.dork_log_directory)
 
     @property
     def accessible(self):
@@ -241,13 +326,14 @@ class Container:
     @property
     def time_created(self):
         """:rtype: datetime"""
-        return parse_date(self.__data['Created'])
+        return self.__created
 
     @property
     def time_started(self):
         """:rtype: datetime"""
         if self.running:
-            return parse_date(self.__data['State']['StartedAt'])
+            self.__load_times()
+            return self.__started
         else:
             return None
 
@@ -257,10 +343,23 @@ class Container:
         if self.running:
             return None
         else:
-            return parse_date(self.__data['State']['FinishedAt'])
+            self.__load_times()
+            return self.__finished
+
+    def __load_times(self):
+        """
+        Inspect the container for the start and stop times, if they were
+        not part of the data it was created from.
+        """
+        if self.__timed:
+            return
+        status = (_backend().inspect_container(self.__id) or {}).get('State') or {}
+        self.__started = _parse_time(status.get('StartedAt'))
+        self.__finished = _parse_time(status.get('FinishedAt'))
+        self.__timed = True
 
     def hostPort(self, port):
-        return self.__data['NetworkSettings']['Ports']['80/tcp'][0]['HostPort'] if '80/tcp' in self.__data['NetworkSettings']['Ports'] else None
+        return self.__ports.get('%s/tcp' % port)
 
     def start(self):
         _container_start(self.id)
@@ -274,57 +373,114 @@ class Container:
     def rename(self, name):
         _container_rename(self.id, name)
 
-    def commit(self, repo):
-        _container_commit(self.id, repo)
+    def commit(self, repo, labels=None):
+        _container_commit(self.id, repo, labels)
+
+    def set_hash(self, commit_hash):
+        """
+        Record that the container has been updated to [commit_hash], without
+        touching the container itself.
+        """
+        _container_set_hash(self.id, commit_hash)
 
     def execute(self, command):
         _container_execute(self.id, command)
 
 
-class Image:
+class Image(object):
+    """
+    Class representing a tagged image. Like [Container], only the fields
+    dork uses are kept.
+    """
+    __slots__ = ('__id', '__tags', '__labelled', '__project', '__hash',
+                 '__created')
+
     def __init__(self, data):
-        self.__data = data
+        self.__id = data['Id']
+        self.__tags = data['RepoTags'] or []
+        # Identity is read from labels. Images committed before dork
+        # labelled them are named "project/hash".
+        labels = (data.get('Config') or {}).get('Labels') or {}
+        segments = self.name.split('/') if self.__tags else []
+        self.__labelled = LABEL_PROJECT in labels
+        self.__project = labels.get(
+            LABEL_PROJECT, segments[0] if segments else None)
+        self.__hash = labels.get(
+            LABEL_HASH, segments[1] if len(segments) > 1 else None)
+        self.__created = _parse_time(data.get('Created'))
 
     def __str__(self):
-        return self.name
+        return self.name or self.id
 
     @classmethod
     def list(cls, clear=False):
         return images(clear)
 
     @classmethod
-    def fromFile(cls, file, name):
-        call('cat %s | docker import - %s' % (file, name), shell=True, stdout=open(os.devnull, 'w'))
-        images(True)
+    def registry(cls, clear=False, project=None):
+        return image_registry(clear, project)
+
+    @classmethod
+    def fromFile(cls, file, name, labels=None, progress=None):
+        def blocks():
+            with open(file, 'rb') as f:
+                for block in iter(lambda: f.read(_block_size), ''):
+                    yield block
+        _backend().import_image(
+            _transfer(blocks(), progress), name, labels or {})
+        _image_refresh(name)
 
     @classmethod
     def dangling(cls):
         return _dangling_images()
 
+    def relabel(self, labels):
+        """
+        Re-commit the image under its name, carrying [labels].
+
+        :type labels: dict[str,str]
+        """
+        _image_relabel(self.id, self.name, labels)
+
     @property
     def id(self):
         """:rtype: str"""
-        return self.__data['Id']
+        return self.__id
 
     @property
     def name(self):
         """:rtype: str"""
-        return self.__data['RepoTags'][0].split(':')[0]
+        return self.__tags[0].split(':')[0] if self.__tags else None
+
+    @property
+    def tags(self):
+        """:rtype: list[str]"""
+        return self.__tags
+
+    @property
+    def labelled(self):
+        """:rtype: bool"""
+        return self.__labelled
 
     @property
     def project(self):
         """:rtype: str"""
-        return self.name.split('/')[0]
+        return self.__project
+
+    @property
+    def instance(self):
+        """Images are shared by all instances of a project."""
+        return None
 
     @property
     def hash(self):
         """:rtype: str"""
-        return self.name.split('/')[1]
+        return self.__hash
 
     @property
     def time_created(self):
         """:rtype: datetime"""
-        return parse_date(self.__data['Created'])
+        return self.__created
 
     def delete(self):
         _image_remove(self.id)
@@ -340,89 +496,1006 @@ class BaseImage:
 # ======================================================================
 # PUBLIC METHODS
 # ======================================================================
+# Containers and images are listed once and afterwards patched in place by
+# dork's own operations and the docker event stream.
+__cache_lock = threading.RLock()
+
+# Labels identifying the objects dork creates.
+LABEL_PROJECT = 'dork.project'
+LABEL_INSTANCE = 'dork.instance'
+LABEL_HASH = 'dork.hash'
+
+
+def labels(project, instance=None, commit_hash=None):
+    """
+    Build the identifying labels for a container or image.
+
+    :rtype: dict[str,str]
+    """
+    result = {LABEL_PROJECT: project}
+    if instance is not None:
+        result[LABEL_INSTANCE] = instance
+    if commit_hash is not None:
+        result[LABEL_HASH] = commit_hash
+    return result
+
+
 __containers = None
+# Either True if all containers are loaded, or the set of loaded projects.
+__container_scope = None
+def container_registry(clear=False, project=None):
+    """
+    Containers, indexed. If [project] is given, only this projects
+    containers are guaranteed to be loaded. Pass [clear] to force a resync
+    with docker.
+
+    :rtype: Registry
+    """
+    global __containers, __container_scope
+    with __cache_lock:
+        if __containers is None or clear:
+            __containers, __container_scope = Registry(), set()
+        if __container_scope is True:
+            return __containers
+        if project is None:
+            __containers = Registry(
+                Container(data) for data in _backend().containers())
+            __container_scope = True
+        elif project not in __container_scope:
+            filters = __project_filters(
+                project, 'name', '^/%s\\.' % re.escape(project))
+            for data in _backend().containers(filters):
+                __containers.add(Container(data))
+            __container_scope.add(project)
+        return __containers
+
+
 def containers(clear=False):
-    global __containers
-    if __containers is None or clear:
-        __containers = []
-        for cid in check_output(['docker', 'ps', '-aq']).splitlines():
-            data = json.loads(check_output(['docker', 'inspect', cid]))
-            __containers.append(Container(data[0]))
-    return __containers
+    """
+    List all containers. Pass [clear] to force a full resync with docker.
+
+    :rtype: list[Container]
+    """
+    with __cache_lock:
+        return container_registry(clear).list()
 
 
 __images = None
+# Either True if all images are loaded, or the set of loaded projects.
+__image_scope = None
+def image_registry(clear=False, project=None):
+    """
+    Tagged images, indexed. If [project] is given, only this projects images
+    are guaranteed to be loaded. Pass [clear] to force a resync with docker.
+
+    :rtype: Registry
+    """
+    global __images, __image_scope
+    with __cache_lock:
+        if __images is None or clear:
+            __images, __image_scope = Registry(), set()
+        if __image_scope is True:
+            return __images
+        if project is None:
+            __images = Registry(
+                Image(data) for data in _backend().images()
+                if data['RepoTags'])
+            __image_scope = True
+        elif project not in __image_scope:
+            filters = __project_filters(
+                project, 'reference', '%s/*' % project)
+            for data in _backend().images(filters=filters):
+                if data['RepoTags']:
+                    __images.add(Image(data))
+            __image_scope.add(project)
+        return __images
+
+
 def images(clear=False):
-    global __images
-    if __images is None or clear:
-        __images = []
-        for i in check_output(['docker', 'images', '-q']).splitlines():
-            data = json.loads(check_output(['docker', 'inspect', i]))
-            if (data[0]['RepoTags']):
-                __images.append(Image(data[0]))
-    return __images
+    """
+    List all tagged images. Pass [clear] to force a full resync with docker.
+
+    :rtype: list[Image]
+    """
+    with __cache_lock:
+        return image_registry(clear).list()
 
 
-def create(name, image, volumes, hostname):
-    """:type volumes: dict"""
-    cmd = ['docker', 'create', '--name=%s' % name, '-h', hostname, '-P']
-    for host in volumes:
-        cmd.append('-v')
-        cmd.append("%s:%s" % (host, volumes[host]))
+def __project_filters(project, legacy_filter, legacy_pattern):
+    """
+    Docker filters matching a projects objects: by label, and by name for
+    objects created before dork labelled them.
+
+    :rtype: list[dict[str,list[str]]]
+    """
+    filters = [{'label': ['%s=%s' % (LABEL_PROJECT, project)]}]
+    if config.docker_name_fallback == 'yes':
+        filters.append({legacy_filter: [legacy_pattern]})
+    return filters
 
-    cmd.append(image)
-    cmd.append('/usr/bin/supervisord')
-    check_output(cmd)
-    containers(True)
+
+def create(name, image, volumes, hostname, labels=None):
+    """
+    :type volumes: dict
+    :type labels: dict[str,str]
+    """
+    _backend().create(name, image, volumes, hostname, labels or {})
+    _container_refresh(name)
 
 
 def _dangling_images():
-    image_ids = check_output([
-        'docker', 'images', '-q', '-f', 'dangling=true'
-    ]).splitlines()
-    for iid in image_ids:
-        yield Image(json.loads(check_output(['docker', 'inspect', iid]))[0])
+    for data in _backend().images(dangling=True):
+        yield Image(data)
 
 
 # ======================================================================
 # PROTECTED METHODS
 # ======================================================================
 def _container_start(cid):
-    check_output(['docker', 'start', cid])
-    containers(True)
+    _backend().start(cid)
+    _container_refresh(cid)
 
 
 def _container_stop(cid):
-    check_output(['docker', 'stop', cid])
-    containers(True)
+    _backend().stop(cid)
+    _container_refresh(cid)
 
 
 def _container_remove(cid):
-    check_output(['docker', 'rm', cid])
-    containers(True)
+    _backend().remove(cid)
+    _container_refresh(cid)
+    state.forget_container(cid)
+
+
+def _label_changes(labels):
+    """
+    Dockerfile instructions setting [labels] on a committed or imported
+    image.
+
+    :rtype: list[str]
+    """
+    if not labels:
+        return []
+    return ['LABEL ' + ' '.join([
+        '%s=%s' % (key, json.dumps(value))
+        for key, value in sorted(labels.items())])]
+
+
+def _container_squash(cid, name, labels=None, progress=None):
+    backend = _backend()
+    blocks = _transfer(backend.export(cid), progress)
+    backend.import_image(blocks, name, labels or {})
+    _image_refresh(name)
+
+
+def _container_set_hash(cid, commit_hash):
+    state.set_container_hash(cid, commit_hash)
+    _container_refresh(cid)
 
 
 def _container_rename(cid, name):
-    check_output(['docker', 'rename', cid, name])
-    containers(True)
+    _backend().rename(cid, name)
+    _container_refresh(cid)
 
 
-def _container_commit(cid, repo):
-    check_output(['docker', 'commit', cid, repo])
-    images(True)
+def _container_commit(cid, repo, labels=None):
+    _backend().commit(cid, repo, labels or {})
+    _image_refresh(repo)
 
 
 def _container_accessible(address):
     return call(['ssh', '-F', os.path.expanduser('~/.ssh/config'), address, '/bin/true']) == 0
 
 def _container_execute(id, command):
-    check_output(['docker', 'exec', id, command])
+    _backend().execute(id, command)
 
 
 
 def _image_remove(iid):
-    call(['docker', 'rmi', iid])
-    images(True)
+    _backend().remove_image(iid)
+    _image_refresh(iid)
+
+
+def _image_relabel(iid, name, labels):
+    """
+    Labels of an image can't be changed, so the image is committed again
+    through a temporary container that is never started.
+    """
+    backend = _backend()
+    temp = 'dork-relabel-%s' % iid.split(':')[-1][:12]
+    backend.create(temp, iid, {}, temp, labels)
+    try:
+        backend.commit(temp, name, labels)
+    finally:
+        backend.remove(temp)
+    _image_refresh(name)
+
+
+def _container_refresh(reference):
+    """
+    Re-inspect a single container and patch it into the container cache,
+    or drop it if it does not exist any more.
+
+    :param str reference: The containers id or name.
+    """
+    with __cache_lock:
+        if __containers is None:
+            return
+        data = _backend().inspect_container(reference)
+        if data is None:
+            __containers.remove(reference)
+        else:
+            __containers.add(Container(data))
+
+
+def _container_lookup(reference):
+    """
+    Retrieve a container from the cache, inspecting only this container if
+    it is not cached yet.
+
+    :param str reference: The containers id or name.
+    :rtype: Container
+    """
+    with __cache_lock:
+        container = container_registry().find(reference)
+        if container is None:
+            _container_refresh(reference)
+            container = __containers.find(reference)
+        return container
+
+
+def _image_lookup(reference):
+    """
+    Retrieve an image from the cache, inspecting only this image if it is
+    not cached yet.
+
+    :param str reference: The images id or name.
+    :rtype: Image
+    """
+    with __cache_lock:
+        image = image_registry().find(reference)
+        if image is None:
+            _image_refresh(reference)
+            image = __images.find(reference)
+        return image
+
+
+def _image_refresh(reference):
+    """
+    Re-inspect a single image and patch it into the image cache, or drop it
+    if it does not exist any more. Cached images that carried one of its
+    tags are re-inspected too, since they just lost it.
+
+    :param str reference: The images id or name.
+    """
+    with __cache_lock:
+        if __images is None:
+            return
+        data = _backend().inspect_image(reference)
+        if data is None:
+            __images.remove(reference)
+            return
+
+        tags = set(data['RepoTags'] or [])
+        for image in __images.list():
+            if image.id != data['Id'] and tags.intersection(image.tags):
+                previous = _backend().inspect_image(image.id)
+                if previous and previous['RepoTags']:
+                    __images.add(Image(previous))
+                else:
+                    __images.remove(image.id)
+
+        if tags:
+            __images.add(Image(data))
+        else:
+            __images.remove(data['Id'])
+
+
+# Docker events that change a containers or images inspect data.
+_container_events = ['create', 'start', 'stop', 'die', 'kill', 'restart',
+                     'rename', 'pause', 'unpause', 'update', 'destroy']
+_image_events = ['delete', 'import', 'pull', 'load', 'tag', 'untag']
+
+
+def _apply_event(event):
+    """
+    Patch the container and image caches according to a docker event.
+
+    :type event: Event
+    """
+    if event.type == 'container' and event.action in _container_events:
+        _container_refresh(event.id)
+    elif event.type == 'image' and event.action in _image_events:
+        _image_refresh(event.id)
+
+
+# Docker's RFC 3339 timestamps, with up to nanosecond precision.
+_time_pattern = re.compile(
+    r'^(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.(\d+))?'
+    r'(?:(Z)|([+-])(\d\d):(\d\d))$')
+
+
+def _parse_time(value):
+    """
+    Parse a docker timestamp. Much faster than dateutil for the format
+    docker uses, which matters since every listed object is parsed.
+
+    :param value: Timestamp, or seconds since the epoch as used in
+        listings of the Engine API.
+    :rtype: datetime
+    """
+    if not value:
+        return None
+    if isinstance(value, (int, long)):
+        return datetime.fromtimestamp(value, tzutc())
+    match = _time_pattern.match(value)
+    if not match:
+        return parse_date(value)
+    (year, month, day, hour, minute, second, fraction,
+     utc, sign, offset_hours, offset_minutes) = match.groups()
+    if utc:
+        timezone = tzutc()
+    else:
+        offset = int(offset_hours) * 3600 + int(offset_minutes) * 60
+        timezone = tzoffset(None, -offset if sign == '-' else offset)
+    return datetime(int(year), int(month), int(day), int(hour), int(minute),
+                    int(second), int((fraction or '0')[:6].ljust(6, '0')),
+                    timezone)
+
+
+def _container_record(summary):
+    """
+    Shape a container listed by the Engine API like its inspect data, as
+    far as [Container] uses it. The start and stop times are not listed
+    and left out.
+
+    :type summary: dict
+    :rtype: dict
+    """
+    # Links add names like "/other/alias", the containers own name has a
+    # single slash.
+    names = summary.get('Names') or []
+    name = next((n for n in names if n.count('/') == 1),
+                names[0] if names else '')
+    networks = (summary.get('NetworkSettings') or {}).get('Networks') or {}
+    network = networks.get('bridge') or (networks.values() or [{}])[0]
+    ports = {}
+    for port in summary.get('Ports') or []:
+        if port.get('PublicPort'):
+            key = '%s/%s' % (port['PrivatePort'], port['Type'])
+            ports.setdefault(key, []).append({
+                'HostIp': port.get('IP', ''),
+                'HostPort': str(port['PublicPort'])})
+    return {
+        'Id': summary['Id'],
+        'Image': summary.get('ImageID'),
+        'Name': name,
+        'Created': summary.get('Created'),
+        'State': {'Running': summary.get('State') == 'running'},
+        'Config': {'Labels': summary.get('Labels') or {}},
+        'NetworkSettings': {
+            'IPAddress': network.get('IPAddress'),
+            'Ports': ports,
+        },
+        'HostConfig': {'Binds': [
+            '%s:%s' % (mount['Source'], mount['Destination'])
+            for mount in summary.get('Mounts') or []
+            if mount.get('Type', 'bind') == 'bind']},
+    }
+
+
+def _image_record(summary):
+    """
+    Shape an image listed by the Engine API like its inspect data, as far
+    as [Image] uses it.
+
+    :type summary: dict
+    :rtype: dict
+    """
+    return {
+        'Id': summary['Id'],
+        # Older engines list untagged images as "<none>:<none>".
+        'RepoTags': [tag for tag in summary.get('RepoTags') or []
+                     if tag != '<none>:<none>'],
+        'Created': summary.get('Created'),
+        'Config': {'Labels': summary.get('Labels') or {}},
+    }
+
+
+def _split_tag(image):
+    """
+    Split an image reference into repository and tag. Registry addresses
+    can contain a port, only a colon after the last slash separates the
+    tag.
+
+    :type image: str
+    :rtype: (str, str)
+    """
+    repository, separator, tag = image.rpartition(':')
+    if not separator or '/' in tag:
+        return image, 'latest'
+    return repository, tag
+
+
+# Size of the blocks streamed between export and import. Only one block is
+# held in memory at a time.
+_block_size = 1 << 20
+
+
+def _transfer(blocks, progress=None, interval=5):
+    """
+    Pass through a stream of blocks, reporting the bytes transferred and
+    the seconds passed to [progress] every [interval] seconds and at the end.
+
+    :type blocks: collections.Iterable[str]
+    :rtype: collections.Iterable[str]
+    """
+    start = reported = time.time()
+    transferred = 0
+    for block in blocks:
+        transferred += len(block)
+        yield block
+        now = time.time()
+        if progress and now - reported >= interval:
+            progress(transferred, now - start)
+            reported = now
+    if progress:
+        progress(transferred, time.time() - start)
+
+
+def _json_lines(stream):
+    """
+    Decode a stream of newline separated JSON documents.
+
+    :param stream: Iterable of data blocks.
+    :rtype: collections.Iterable[dict]
+    """
+    buffered = ''
+    for block in stream:
+        buffered += block
+        while '\n' in buffered:
+            line, buffered = buffered.split('\n', 1)
+            if line.strip():
+                yield json.loads(line)
+
+
+def _check_progress(text):
+    """
+    Raise a [DockerException] for an error in a JSON progress stream. The
+    engine reports failed pulls and imports there, the response status is
+    200 anyway.
+
+    :param str text: The response body.
+    """
+    try:
+        messages = list(_json_lines([text + '\n']))
+    except ValueError:
+        return
+    for message in messages:
+        if isinstance(message, dict) and message.get('error'):
+            raise DockerException(message['error'], 0)
+
+
+__backend = None
+def _backend():
+    """
+    The backend used to talk to docker, selected by the "docker_backend"
+    setting. Falls back to the command line client if the Engine API
+    socket is not available, or if the address is secured with TLS: the
+    client certificates from DOCKER_CERT_PATH are only used by the docker
+    command line client.
+
+    :rtype: ApiBackend|CliBackend
+    """
+    global __backend
+    if __backend is None:
+        address = _engine_address()
+        if address.startswith('unix://'):
+            available = os.path.exists(address[len('unix://'):])
+        else:
+            available = not (address.startswith('https://') or
+                             os.environ.get('DOCKER_TLS_VERIFY') or
+                             os.environ.get('DOCKER_TLS'))
+        if config.docker_backend == 'api' and available:
+            __backend = ApiBackend(address)
+        else:
+            __backend = CliBackend()
+    return __backend
+
+
+def _engine_address():
+    """
+    The Engine API address, defaulting to the local unix socket if
+    [docker_address] is not set.
+
+    :rtype: str
+    """
+    address = config.docker_address
+    if not address or address.startswith('$'):
+        address = 'unix:///var/run/docker.sock'
+    return address
+
+
+# ======================================================================
+# REGISTRY
+# ======================================================================
+_versions = itertools.count(1)
+
+
+class Registry:
+    """
+    Containers or images, indexed by id, project, project instance and
+    commit hash.
+    """
+    def __init__(self, objects=()):
+        """
+        :type objects: collections.Iterable[Container|Image]
+        """
+        self.__objects = OrderedDict()
+        self.__projects = {}
+        self.__instances = {}
+        self.__hashes = {}
+        # Changes on every change, to invalidate derived results. Unique
+        # across registries, so a rebuilt registry never reuses a version.
+        self.version = next(_versions)
+        for obj in objects:
+            self.add(obj)
+
+    def __len__(self):
+        return len(self.__objects)
+
+    def __iter__(self):
+        return iter(self.list())
+
+    def __contains__(self, oid):
+        return oid in self.__objects
+
+    def list(self):
+        """:rtype: list[Container|Image]"""
+        return self.__objects.values()
+
+    def get(self, oid):
+        """
+        Retrieve an object by its full id.
+
+        :rtype: Container|Image
+        """
+        return self.__objects.get(oid)
+
+    def find(self, reference):
+        """
+        Retrieve an object by id, id prefix or name, like docker does.
+
+        :rtype: Container|Image
+        """
+        if reference in self.__objects:
+            return self.__objects[reference]
+        for oid, obj in self.__objects.iteritems():
+            if oid.startswith(reference) or str(obj).strip('/') == reference:
+                return obj
+        return None
+
+    def project(self, project):
+        """
+        All objects belonging to a project.
+
+        :rtype: list[Container|Image]
+        """
+        return self.__bucket(self.__projects, project)
+
+    def instance(self, project, instance):
+        """
+        All objects belonging to one instance of a project.
+
+        :rtype: list[Container]
+        """
+        return self.__bucket(self.__instances, (project, instance))
+
+    def hash(self, commit_hash):
+        """
+        All objects built from a commit.
+
+        :rtype: list[Container|Image]
+        """
+        return self.__bucket(self.__hashes, commit_hash)
+
+    def add(self, obj):
+        """
+        Add an object, replacing a previous version with the same id.
+
+        :type obj: Container|Image
+        """
+        if obj.id in self.__objects:
+            self.remove(obj.id)
+        self.__objects[obj.id] = obj
+        for index, key in self.__keys(obj):
+            index.setdefault(key, OrderedDict())[obj.id] = obj
+        self.version = next(_versions)
+
+    def remove(self, reference):
+        """
+        Remove an object by id, id prefix or name, if it exists.
+
+        :type reference: str
+        """
+        obj = self.find(reference)
+        if obj is None:
+            return
+        del self.__objects[obj.id]
+        for index, key in self.__keys(obj):
+            del index[key][obj.id]
+            if not index[key]:
+                del index[key]
+        self.version = next(_versions)
+
+    def __keys(self, obj):
+        keys = [(self.__projects, obj.project), (self.__hashes, obj.hash)]
+        if obj.instance is not None:
+            keys.append((self.__instances, (obj.project, obj.instance)))
+        return keys
+
+    @staticmethod
+    def __bucket(index, key):
+        return index[key].values() if key in index else []
+
+
+# ======================================================================
+# BACKENDS
+# ======================================================================
+class CliBackend:
+    """
+    Talks to docker by running the docker command line client.
+    """
+
+    # Maximum number of object ids passed to a single "docker inspect"
+    # call, to stay well below the kernels argument size limit.
+    inspect_batch_size = 200
+
+    def containers(self, filters=None):
+        """
+        :param list[dict[str,list[str]]] filters: Alternative docker
+            filters, containers matching any of them are returned.
+        :rtype: list[dict]
+        """
+        ids = []
+        for cmd in self.__filtered(['docker', 'ps', '-aq'], filters):
+            ids += check_output(cmd).splitlines()
+        return self.inspect(ids, 'container')
+
+    def images(self, dangling=False, filters=None):
+        """
+        :param list[dict[str,list[str]]] filters: Alternative docker
+            filters, images matching any of them are returned.
+        :rtype: list[dict]
+        """
+        cmd = ['docker', 'images', '-q']
+        if dangling:
+            cmd += ['-f', 'dangling=true']
+        ids = []
+        for filtered in self.__filtered(cmd, filters):
+            ids += check_output(filtered).splitlines()
+        return self.inspect(ids, 'image')
+
+    @staticmethod
+    def __filtered(cmd, filters):
+        """
+        One command per set of filters.
+
+        :rtype: list[list[str]]
+        """
+        if not filters:
+            return [cmd]
+        commands = []
+        for alternative in filters:
+            filtered = list(cmd)
+            for key, values in sorted(alternative.items()):
+                for value in values:
+                    filtered += ['--filter', '%s=%s' % (key, value)]
+            commands.append(filtered)
+        return commands
+
+    def inspect_container(self, reference):
+        """:rtype: dict"""
+        result = self.inspect([reference], 'container')
+        return result[0] if result else None
+
+    def inspect_image(self, reference):
+        """:rtype: dict"""
+        result = self.inspect([reference], 'image')
+        return result[0] if result else None
+
+    def inspect(self, ids, kind):
+        """
+        Inspect multiple docker objects with as few "docker inspect" calls
+        as possible.
+
+        :param list[str] ids: Container or image ids.
+        :param str kind: The object type, either "container" or "image".
+        :rtype: list[dict]
+        """
+        # Images are listed once per tag, inspect every id only once.
+        unique = []
+        seen = set()
+        for oid in ids:
+            if oid not in seen:
+                seen.add(oid)
+                unique.append(oid)
+
+        result = []
+        for offset in range(0, len(unique), self.inspect_batch_size):
+            cmd = ['docker', 'inspect', '--type=%s' % kind]
+            cmd += unique[offset:offset + self.inspect_batch_size]
+            try:
+                output = check_output(cmd)
+            except CalledProcessError as exc:
+                # Objects removed since they were listed make docker exit
+                # with an error, but the remaining ones are still printed.
+                output = exc.output
+            if output.strip():
+                result += json.loads(output)
+        return result
+
+    def create(self, name, image, volumes, hostname, labels):
+        cmd = ['docker', 'create', '--name=%s' % name, '-h', hostname, '-P']
+        for host in volumes:
+            cmd.append('-v')
+            cmd.append("%s:%s" % (host, volumes[host]))
+        for key, value in sorted(labels.items()):
+            cmd.append('--label')
+            cmd.append("%s=%s" % (key, value))
+
+        cmd.append(image)
+        cmd.append('/usr/bin/supervisord')
+        check_output(cmd)
+
+    def start(self, cid):
+        check_output(['docker', 'start', cid])
+
+    def stop(self, cid):
+        check_output(['docker', 'stop', cid])
+
+    def remove(self, cid):
+        check_output(['docker', 'rm', cid])
+
+    def rename(self, cid, name):
+        check_output(['docker', 'rename', cid, name])
+
+    def commit(self, cid, repo, labels):
+        cmd = ['docker', 'commit']
+        for change in _label_changes(labels):
+            cmd += ['--change', change]
+        check_output(cmd + [cid, repo])
+
+    def execute(self, cid, command):
+        check_output(['docker', 'exec', cid, command])
+
+    def remove_image(self, iid):
+        call(['docker', 'rmi', iid])
+
+    def export(self, cid):
+        """
+        Stream a containers filesystem as a tar archive.
+
+        :rtype: collections.Iterable[str]
+        """
+        cmd = ['docker', 'export', cid]
+        process = Popen(cmd, stdout=PIPE)
+        try:
+            for block in iter(lambda: process.stdout.read(_block_size), ''):
+                yield block
+        except BaseException:
+            process.kill()
+            process.wait()
+            raise
+        if process.wait() != 0:
+            raise CalledProcessError(process.returncode, cmd)
+
+    def import_image(self, blocks, name, labels):
+        """
+        Create an image from a stream of tar archive blocks.
+
+        :type blocks: collections.Iterable[str]
+        """
+        cmd = ['docker', 'import']
+        for change in _label_changes(labels):
+            cmd += ['--change', change]
+        cmd += ['-', name]
+        process = Popen(cmd, stdin=PIPE, stdout=open(os.devnull, 'w'))
+        try:
+            for block in blocks:
+                process.stdin.write(block)
+        except BaseException:
+            # Never let docker import a truncated archive.
+            process.kill()
+            process.wait()
+            raise
+        process.stdin.close()
+        if process.wait() != 0:
+            raise CalledProcessError(process.returncode, cmd)
+
+    def events(self, filters):
+        """
+        :type filters: dict[str,list[str]]
+        :rtype: _ProcessStream
+        """
+        cmd = ['docker', 'events', '--format', '{{json .}}']
+        for key, values in sorted(filters.items()):
+            for value in values:
+                cmd += ['--filter', '%s=%s' % (key, value)]
+        return _ProcessStream(Popen(cmd, stdout=PIPE))
+
+
+class ApiBackend:
+    """
+    Talks to the Docker Engine API, reusing keep-alive connections.
+    """
+
+    def __init__(self, address):
+        """
+        :param str address: unix://, tcp:// or http:// address.
+        """
+        self.__pool = _ConnectionPool(address)
+
+    def containers(self, filters=None):
+        """
+        The API has no batch inspect like "docker inspect a b c", so the
+        records are built from the listing itself, one request per set of
+        filters. It lacks the start and stop times, [Container] inspects
+        for those only when they are asked for.
+
+        :param list[dict[str,list[str]]] filters: Alternative docker
+            filters, containers matching any of them are returned.
+        :rtype: list[dict]
+        """
+        return [_container_record(summary) for summary in
+                self.__list('containers/json', {'all': 1}, filters)]
+
+    def images(self, dangling=False, filters=None):
+        """
+        Records built from the listing, like [ApiBackend.containers].
+
+        :param list[dict[str,list[str]]] filters: Alternative docker
+            filters, images matching any of them are returned.
+        :rtype: list[dict]
+        """
+        if dangling:
+            filters = [dict(f, dangling=['true']) for f in filters or [{}]]
+        return [_image_record(summary) for summary in
+                self.__list('images/json', {}, filters)]
+
+    def __list(self, path, query, filters):
+        """
+        List the objects matching any of the alternative filters.
+
+        :rtype: list[dict]
+        """
+        objects = OrderedDict()
+        for alternative in filters or [None]:
+            if alternative:
+                query = dict(query, filters=json.dumps(alternative))
+            for obj in self.__get(path, query):
+                objects[obj['Id']] = obj
+        return objects.values()
+
+    def inspect_container(self, reference):
+        """:rtype: dict"""
+        try:
+            return self.__get('containers/%s/json' % reference)
+        except DockerException as exc:
+            if exc.code == 404:
+                return None
+            raise
+
+    def inspect_image(self, reference):
+        """:rtype: dict"""
+        try:
+            return self.__get('images/%s/json' % reference)
+        except DockerException as exc:
+            if exc.code == 404:
+                return None
+            raise
+
+    def create(self, name, image, volumes, hostname, labels):
+        data = {
+            'Image': image,
+            'Hostname': hostname,
+            'Labels': labels,
+            'Cmd': ['/usr/bin/supervisord'],
+            'HostConfig': {
+                'Binds': ["%s:%s" % (host, volumes[host]) for host in volumes],
+                'PublishAllPorts': True,
+            },
+        }
+        try:
+            self.__post('containers/create', {'name': name}, data, (201,))
+        except DockerException as exc:
+            if exc.code != 404:
+                raise
+            # Like "docker create", pull missing images first.
+            repository, tag = _split_tag(image)
+            _check_progress(self.__post('images/create', {
+                'fromImage': repository, 'tag': tag or 'latest'}))
+            self.__post('containers/create', {'name': name}, data, (201,))
+
+    def start(self, cid):
+        self.__post('containers/%s/start' % cid, codes=(204, 304))
+
+    def stop(self, cid):
+        self.__post('containers/%s/stop' % cid, codes=(204, 304))
+
+    def remove(self, cid):
+        self.__delete('containers/%s' % cid, codes=(204,))
+
+    def rename(self, cid, name):
+        self.__post('containers/%s/rename' % cid, {'name': name}, codes=(204,))
+
+    def commit(self, cid, repo, labels):
+        self.__post('commit', {'container': cid, 'repo': repo},
+                    {'Labels': labels} if labels else (), codes=(201,))
+
+    def execute(self, cid, command):
+        execution = json.loads(self.__post(
+            'containers/%s/exec' % cid, data={
+                'Cmd': [command],
+                'AttachStdout': True,
+                'AttachStderr': True,
+            }, codes=(201,)))
+        output = self.__post('exec/%s/start' % execution['Id'],
+                             data={'Detach': False, 'Tty': False})
+        result = self.__get('exec/%s/json' % execution['Id'])
+        if result['ExitCode'] != 0:
+            raise DockerException(output, result['ExitCode'])
+
+    def remove_image(self, iid):
+        # Images still in use are kept, just like "docker rmi" would.
+        self.__delete('images/%s' % iid, codes=(200, 404, 409))
+
+    def export(self, cid):
+        """
+        Stream a containers filesystem as a tar archive.
+
+        :rtype: collections.Iterable[str]
+        """
+        stream = self.__pool.stream('GET', 'containers/%s/export' % cid)
+        for block in stream:
+            yield block
+        if not stream.complete:
+            raise DockerException('Export of %s interrupted.' % cid, 0)
+
+    def import_image(self, blocks, name, labels):
+        """
+        Create an image from a stream of tar archive blocks.
+
+        :type blocks: collections.Iterable[str]
+        """
+        repo, _, tag = name.partition(':')
+        query = [('fromSrc', '-'), ('repo', repo), ('tag', tag or 'latest')]
+        query += [('changes', change) for change in _label_changes(labels)]
+        _check_progress(
+            self.__pool.upload('POST', 'images/create', query, blocks))
+
+    def events(self, filters):
+        """
+        :type filters: dict[str,list[str]]
+        :rtype: _ResponseStream
+        """
+        return self.__pool.stream(
+            'GET', 'events', {'filters': json.dumps(filters)})
+
+    def __get(self, path, query=(), codes=(200,)):
+        """
+        :param str path:
+        :param dict[str,str] query:
+        :param list[int] codes:
+        :return: json
+        """
+        return json.loads(self.__pool.request('GET', path, query, codes=codes))
+
+    def __post(self, path, query=(), data=(), codes=(200,)):
+        return self.__pool.request('POST', path, query, data, codes)
+
+    def __delete(self, path, query=(), codes=(200,)):
+        return self.__pool.request('DELETE', path, query, codes=codes)
 
 
 # ======================================================================
@@ -434,45 +1507,216 @@ class DockerException(Exception):
         self.code = code
 
 
-def __get(path, query=(), codes=(200,)):
+class _UnixHTTPConnection(httplib.HTTPConnection):
     """
-    :param str path:
-    :param dict[str,str] query:
-    :param list[int] codes:
-    :return: json
+    HTTP connection over a unix domain socket.
     """
 
-    result = requests.get(
-        "%s/%s" % (config.docker_address, path),
-        params=query)
+    def __init__(self, path):
+        httplib.HTTPConnection.__init__(self, 'localhost')
+        self.__path = path
 
-    if result.status_code in codes:
-        return result.json()
-    else:
-        raise DockerException(result.status_code, result.text)
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.__path)
 
 
-def __post(path, query=(), data=(), codes=(200,)):
+class _ConnectionPool:
+    """
+    A thread safe pool of keep-alive connections to the Docker Engine API.
+    """
 
-    if data:
-        result = requests.post(
-            "%s/%s" % (config.docker_address, path),
-            params=query, json=data)
-    else:
-        result = requests.post(
-            "%s/%s" % (config.docker_address, path),
-            params=query)
+    def __init__(self, address, size=4):
+        """
+        :param str address: unix://, tcp:// or http:// address.
+        :param int size: Maximum number of idle connections kept open.
+        """
+        url = urlparse(address)
+        self.__scheme = url.scheme
+        self.__location = url.path if url.scheme == 'unix' else url.netloc
+        self.__idle = Queue.LifoQueue(size)
+
+    def connect(self):
+        """
+        Open a new connection to the engine.
+
+        :rtype: httplib.HTTPConnection
+        """
+        if self.__scheme == 'unix':
+            return _UnixHTTPConnection(self.__location)
+        else:
+            return httplib.HTTPConnection(self.__location)
+
+    def request(self, method, path, query=(), data=(), codes=(200,)):
+        """
+        Send a request and return the response body. Raises a
+        [DockerException] if the status code is not in [codes].
+
+        :rtype: str
+        """
+        url = '/' + path
+        if query:
+            url += '?' + urllib.urlencode(query)
+        body = json.dumps(data) if data else None
+        headers = {'Content-Type': 'application/json'} if data else {}
+
+        try:
+            connection = self.__idle.get_nowait()
+            reused = True
+        except Queue.Empty:
+            connection = self.connect()
+            reused = False
+
+        try:
+            connection.request(method, url, body, headers)
+            response = connection.getresponse()
+        except (httplib.HTTPException, socket.error):
+            connection.close()
+            if not reused:
+                raise
+            # The engine closed the idle connection, retry on a fresh one.
+            connection = self.connect()
+            connection.request(method, url, body, headers)
+            response = connection.getresponse()
+
+        text = response.read()
+        if response.will_close:
+            connection.close()
+        else:
+            try:
+                self.__idle.put_nowait(connection)
+            except Queue.Full:
+                connection.close()
 
-    if result.status_code not in codes:
-        raise DockerException(result.status_code, result.text)
-    return result.text
+        if response.status not in codes:
+            raise DockerException(text, response.status)
+        return text
 
+    def upload(self, method, path, query, blocks, codes=(200,)):
+        """
+        Send a request with a chunked body from an iterable of blocks on a
+        dedicated connection and return the response body.
+
+        :rtype: str
+        """
+        url = '/' + path
+        if query:
+            url += '?' + urllib.urlencode(query)
+        connection = self.connect()
+        try:
+            connection.putrequest(method, url)
+            connection.putheader('Content-Type', 'application/x-tar')
+            connection.putheader('Transfer-Encoding', 'chunked')
+            connection.endheaders()
+            for block in blocks:
+                if block:
+                    connection.send('%x\r\n%s\r\n' % (len(block), block))
+            connection.send('0\r\n\r\n')
+            response = connection.getresponse()
+            text = response.read()
+        finally:
+            connection.close()
+        if response.status not in codes:
+            raise DockerException(text, response.status)
+        return text
+
+    def stream(self, method, path, query=(), codes=(200,)):
+        """
+        Send a request on a dedicated connection and return the streaming
+        response body.
 
-def __delete(path, query=(), codes=(200,)):
+        :rtype: _ResponseStream
+        """
+        url = '/' + path
+        if query:
+            url += '?' + urllib.urlencode(query)
+        connection = self.connect()
+        connection.request(method, url)
+        response = connection.getresponse()
+        if response.status not in codes:
+            text = response.read()
+            connection.close()
+            raise DockerException(text, response.status)
+        return _ResponseStream(connection, response)
+
+
+class _ResponseStream:
+    """
+    The body of a streaming HTTP response, as an iterable of data blocks.
+    """
+
+    block_size = 65536
+
+    def __init__(self, connection, response):
+        """
+        :type connection: httplib.HTTPConnection
+        :type response: httplib.HTTPResponse
+        """
+        self.__connection = connection
+        self.__response = response
+        # Whether the whole body has been read, as opposed to a stream that
+        # has been closed or broke off.
+        self.complete = False
+
+    def __iter__(self):
+        try:
+            if self.__response.chunked:
+                # Read chunks as they arrive instead of waiting for a full
+                # block, which would stall streams like "events".
+                fp = self.__response.fp
+                while True:
+                    line = fp.readline()
+                    if not line:
+                        break
+                    size = int(line.split(';')[0], 16)
+                    if size == 0:
+                        self.complete = True
+                        break
+                    while size > 0:
+                        data = fp.read(min(size, self.block_size))
+                        if not data:
+                            return
+                        size -= len(data)
+                        yield data
+                    fp.readline()
+            else:
+                while True:
+                    data = self.__response.read(self.block_size)
+                    if not data:
+                        self.complete = True
+                        break
+                    yield data
+        except (socket.error, ValueError):
+            # The stream has been closed.
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        """Close the stream, even while it is read from another thread."""
+        sock = self.__connection.sock
+        if sock:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        self.__connection.close()
+
+
+class _ProcessStream:
+    """
+    The output of a running process, as an iterable of lines.
+    """
+
+    def __init__(self, process):
+        """
+        :type process: subprocess.Popen
+        """
+        self.__process = process
 
-    result = requests.delete(
-        "%s/%s" % (config.docker_address, path),
-        params=query)
+    def __iter__(self):
+        return iter(self.__process.stdout.readline, '')
 
-    if result.status_code not in codes:
-        raise DockerException(result.status_code, result.text)
+    def close(self):
+        if self.__process.poll() is None:
+            self.__process.kill()
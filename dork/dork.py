@@ -1,6 +1,6 @@
 from config import ProjectConfig, config
 from git import Repository, Commit
-from docker import Container, Image, BaseImage, DockerException
+from docker import Container, Image, BaseImage, DockerException, labels
 from matcher import Role
 import dns
 import runner
@@ -11,7 +11,7 @@ import subprocess
 import colorclass
 import time
 import os
-import tempfile
+from collections import OrderedDict
 
 
 class State(Enum):
@@ -75,6 +75,7 @@ class Dork:
         """
         self.repository = repository
         self.conf = ProjectConfig(self.repository)
+        self.__closest_items = {}
         levels = {
             'error': logging.ERROR,
             'warn': logging.WARNING,
@@ -145,11 +146,9 @@ class Dork:
 
         :rtype: Container
         """
-        return self.__closest([
-            c for c in Container.list()
-            if c.project == self.project
-            and c.instance == self.instance
-        ])
+        registry = Container.registry(project=self.project)
+        return self.__closest(
+            registry.instance(self.project, self.instance), registry.version)
 
     @property
     def image(self):
@@ -158,10 +157,8 @@ class Dork:
 
         :rtype: Image
         """
-        return self.__closest([
-            i for i in Image.list()
-            if i.project == self.project
-        ])
+        registry = Image.registry(project=self.project)
+        return self.__closest(registry.project(self.project), registry.version)
 
     # ======================================================================
     # PROJECT & INSTANCE PROPERTIES
@@ -232,11 +229,10 @@ class Dork:
 
         :rtype: list[str]
         """
-        changes = self.repository.current_commit % Commit(self.container.hash, self.repository)
-        for name, role in self.roles.iteritems():
-            tags = role.update_triggers(changes)
-            for tag in tags:
-                yield tag
+        changes = self.repository.current_commit.changes(
+            Commit(self.container.hash, self.repository))
+        for tag in Role.update_tags(self.roles.values(), changes):
+            yield tag
 
     @property
     def triggers(self):
@@ -289,11 +285,7 @@ class Dork:
         self.info('No container found, creating a new one.')
 
         if startimage:
-            image = False
-            for i in Image.list():
-                if i.name == startimage:
-                    image = i
-                    break
+            image = Image.registry().find(startimage)
             if not image:
                 self.err('Image %s could not be found.', startimage)
                 return False
@@ -322,8 +314,15 @@ class Dork:
                         self.conf.root_branch, self.repository.branch)
                     return False
 
-        # Build correct container name.
+        # Build correct container name. Containers keep their name when they
+        # are updated, so an older one might still use it.
         container_name = "%s.%s.%s" % (self.project, self.instance, image.hash)
+        registry = Container.registry(project=self.project)
+        suffix = 1
+        while registry.find(container_name):
+            suffix += 1
+            container_name = "%s.%s.%s.%s" % (
+                self.project, self.instance, image.hash, suffix)
 
         # Define volume directories.
         host_src_dir = self.repository.directory
@@ -358,7 +357,9 @@ class Dork:
         else:
             domain = "%s.%s.dork" % (self.project, self.instance)
 
-        Container.create(container_name, image.name, container_volumes, domain)
+        Container.create(
+            container_name, image.name, container_volumes, domain,
+            labels(self.project, self.instance, image.hash))
         self.info("Successfully created %s from %s.", container_name, image.name)
         return True
 
@@ -386,8 +387,9 @@ class Dork:
             return True
 
         # Stop containers within the same instance
-        for c in Container.list():
-            if c.project == self.project and c.instance == self.instance and c.running:
+        for c in Container.registry(project=self.project).instance(
+                self.project, self.instance):
+            if c.running:
                 self.info("Stopping sibling %s.", c)
                 c.stop()
 
@@ -456,13 +458,9 @@ class Dork:
         tags = []
         if not self.status == Status.NEW:
             container_commit = Commit(self.container.hash, self.repository)
-            changes = self.repository.current_commit % container_commit
-            self.info("Found %s changed files.", len(changes))
-            for name, role in self.roles.iteritems():
-                matched = role.update_triggers(changes)
-                if matched:
-                    self.debug("Matched %s in %s.", matched, role.name)
-                    tags += matched
+            # Changed files are read only until all tags are triggered.
+            changes = self.repository.current_commit.changes(container_commit)
+            tags = Role.update_tags(self.roles.values(), changes)
             self.info("Applying %s to update.", tags)
         else:
             Role.clear(self.repository)
@@ -483,20 +481,9 @@ class Dork:
             self.warn("No tags found, update not necessary.")
 
         if current_hash != self.container.hash:
-            # Rename the container to the current commit hash.
-            self.info("Renaming to commit hash %s.", current_hash)
-            self.container.rename("%s.%s.%s" % (
-                self.project,
-                self.instance,
-                current_hash
-            ))
-
-            # Restart the container to ensure data docker metadata integrity.
-            # Necessary due to a docker bug.
-            self.info("Restarting container.")
-            self.container.stop()
-            self.container.start()
-            dns.refresh()
+            # Track the new commit hash, the container keeps running.
+            self.info("Updated to commit hash %s.", current_hash)
+            self.container.set_hash(current_hash)
 
             if self.repository.branch in self.conf.root_branch:
                 self.info('Branch %s updated. Squashing container.', self.repository.branch)
@@ -607,13 +594,12 @@ class Dork:
         # Select containers to operate on, based on current Mode.
         if self.mode == Mode.SERVER:
             self.info("Automatic server cleanup, using project scope.")
-            containers = [c for c in Container.list(True)
-                          if c.project == self.project]
+            containers = Container.registry(project=self.project).project(
+                self.project)
         else:
             self.info("Instance scope cleanup.")
-            containers = [c for c in Container.list(True)
-                          if c.project == self.project
-                          and c.instance == self.instance]
+            containers = Container.registry(project=self.project).instance(
+                self.project, self.instance)
 
         # Add containers to removable that are ancestors of other ones.
         removable_containers = [c for c in containers
@@ -639,12 +625,13 @@ class Dork:
                     self.debug("Removing directory %s.", remove.source)
                     shutil.rmtree(remove.source)
                 # Try to remove the image if in server mode.
-                for image in Image.list():
-                    if image.id == remove.image and image.name != self.conf.base_image:
-                        try:
-                            image.delete()
-                        except DockerException:
-                            pass
+                image = Image.registry(project=self.project).get(
+                    remove.image)
+                if image and image.name != self.conf.base_image:
+                    try:
+                        image.delete()
+                    except DockerException:
+                        pass
 
                 # Remove the build directory.
                 if os.path.exists(remove.build):
@@ -661,7 +648,7 @@ class Dork:
                         self.warn("Unable to remove logs directory %s.", remove.logs)
 
         # Remove images that are ancestors of other images.
-        images = [i for i in Image.list() if i.project == self.project]
+        images = Image.registry(project=self.project).project(self.project)
         removable_images = [i for i in images if self.__is_removable(i, images)]
 
         for remove in removable_images:
@@ -692,7 +679,8 @@ class Dork:
             return False
 
         image_name = '%s/%s' % (self.project, self.container.hash)
-        self.container.commit(image_name)
+        self.container.commit(
+            image_name, labels(self.project, commit_hash=self.container.hash))
         self.info("Successfully committed container to %s", image_name)
         return True
 
@@ -707,22 +695,22 @@ class Dork:
         # Remove containers.
         self.debug("Removing all containers.")
         container_count = 0
-        for c in Container.list():
-            if c.project == self.project and c.instance == self.instance:
-                c.remove()
-                container_count += 1
-                self.debug("Removed %s.", c)
+        for c in Container.registry(project=self.project).instance(
+                self.project, self.instance):
+            c.remove()
+            container_count += 1
+            self.debug("Removed %s.", c)
         self.info("Removed %s containers.", container_count)
 
         # Remove images if in workstation mode.
         if self.mode == Mode.WORKSTATION:
             image_count = 0
             self.warn("Workstation mode, removing all images.")
-            for i in Image.list():
-                if i.project == self.project:
-                    i.delete()
-                    image_count += 1
-                    self.debug("Removed %s.", i)
+            images = Image.registry(project=self.project).project(self.project)
+            for i in images:
+                i.delete()
+                image_count += 1
+                self.debug("Removed %s.", i)
             self.info("Removed %s images.", image_count)
 
         # Remove dangling images.
@@ -735,6 +723,31 @@ class Dork:
         self.info("Removed %s dangling images.", dangling_count)
         return True
 
+    def migrate(self):
+        """
+        Label this projects images that were created before dork labelled
+        them. Docker can't relabel containers, they are matched by name
+        until they are recreated.
+
+        :return: [True] if all images carry labels.
+        :rtype: bool
+        """
+        self.debug("Migrating unlabelled images.")
+        images = Image.registry(project=self.project).project(self.project)
+        legacy = [i for i in images if not i.labelled and i.hash]
+        for image in legacy:
+            self.debug("Labelling %s.", image)
+            image.relabel(labels(self.project, commit_hash=image.hash))
+        self.info("Labelled %s images.", len(legacy))
+
+        containers = Container.registry(project=self.project).project(
+            self.project)
+        unlabelled = [c for c in containers if not c.labelled]
+        if unlabelled:
+            self.warn("%s containers have no labels, recreate them to "
+                      "stop relying on their names.", len(unlabelled))
+        return True
+
     def squash(self):
         """
         Export and re-import to the current image name. Effectively
@@ -754,15 +767,35 @@ class Dork:
             self.err('Can not squash dirty container. Please update first.')
             return False
 
-        temp = tempfile.NamedTemporaryFile(delete=False)
-        container.export(temp.name)
-        self.info('Container exported. Stopping and removing current container.')
+        # Stop first, so the filesystem doesn't change while it's exported.
         self.stop()
-        self.remove()
+        commit_hash = self.repository.current_commit.hash
+        image_name = '%s/%s' % (self.project, commit_hash)
+        self.info('Streaming container into new image %s.', image_name)
+
+        def progress(transferred, seconds):
+            self.info('%.1f MiB transferred, %.1f MiB/s.',
+                      transferred / 1048576.0,
+                      transferred / 1048576.0 / max(seconds, 0.001))
+
+        container.squash(
+            image_name, labels(self.project, commit_hash=commit_hash),
+            progress)
+
+        # Never remove the containers without the image replacing them.
+        if not Image.registry(project=self.project).find(image_name):
+            self.err('Image %s has not been created, keeping the container.',
+                     image_name)
+            return False
+
+        self.info('Image created. Removing old containers and images.')
+        for c in Container.registry(project=self.project).instance(
+                self.project, self.instance):
+            c.remove()
         self.clean()
-        self.info('Importing new image %s/%s' % (self.project, self.repository.current_commit.hash))
-        Image.fromFile(temp.name, "%s/%s" % (self.project, self.repository.current_commit.hash))
-        os.unlink(temp.name)
+        for i in Image.dangling():
+            i.delete()
+
         self.info('Restarting container from new image.')
         self.create()
         self.start()
@@ -771,22 +804,25 @@ class Dork:
     # ======================================================================
     # PRIVATE HELPERS
     # ======================================================================
-    def __closest(self, items):
+    def __closest(self, items, version):
         """
-        Retrieve the closest among a list of items.
+        Retrieve the item built from the most recent commit in the history
+        of the current commit. Remembered until HEAD or the registry the
+        items are taken from change.
 
         :param items:
+        :param int version: The registries version.
         :rtype: object
         """
-        closest_object = None
-        closest_commit = None
-        for item in items:
-            commit = Commit(item.hash, self.repository)
-            if commit <= self.repository.current_commit:
-                if closest_object is None or closest_commit < commit:
-                    closest_commit = commit
-                    closest_object = item
-        return closest_object
+        key = (version, self.repository.current_commit.hash)
+        if key not in self.__closest_items:
+            by_hash = OrderedDict()
+            for item in items:
+                if item.hash and item.hash not in by_hash:
+                    by_hash[item.hash] = item
+            closest = self.repository.closest(by_hash.keys())
+            self.__closest_items[key] = by_hash[closest.hash] if closest else None
+        return self.__closest_items[key]
 
     def __is_removable(self, obj, siblings):
         commit = Commit(obj.hash, self.repository)
@@ -1,23 +1,23 @@
-from subprocess import call, check_output, PIPE
+from subprocess import call, check_output, Popen, PIPE, CalledProcessError
 from glob2 import glob, Globber
+from fnmatch import fnmatch
+import atexit
+import hashlib
+import mmap
 import os
 import re
+import stat
+import threading
 import config
+from cache import LRUCache, PersistentCache
 
-def _git_globber_listdir(path):
-    if os.path.exists(path + '/.git'):
-        return []
-    else:
-        return os.listdir(path)
-
-def _git_globber_islink(path):
-    return os.path.islink(path) and not os.path.isdir(path)
-
-class GitGlobber(Globber):
-    listdir = staticmethod(_git_globber_listdir)
-    islink = staticmethod(_git_globber_islink)
-
-git_globber = GitGlobber()
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 def _gitless_globber_listdir(path):
     return [d for d in os.listdir(path) if not d.endswith('.git')]
@@ -36,10 +36,8 @@ def get_repositories(directory):
     if _is_repository(directory):
         yield Repository(directory)
     else:
-        repositories = [subdir[:-5] for subdir in git_globber.glob(directory + '/**/.git')]
-        for d in repositories:
-            if not any([((r + '/') in d and d is not r) for r in repositories]):
-                yield Repository(d)
+        for d in _find_repositories(directory):
+            yield Repository(d)
 
 
 class Commit:
@@ -107,6 +105,19 @@ class Commit:
         """
         return _file_diff(self.__directory, self.__hash, other.__hash)
 
+    def changes(self, other, limit=None, status=False):
+        """
+        Iterate over the files changed between two commits, without waiting
+        for the complete list. See [Commit.__mod__].
+
+        :type other: Commit
+        :param int limit: Stop after this many files.
+        :param bool status: Yield (status, path, previous path) tuples.
+        :rtype: collections.Iterable[str|(str,str,str)]
+        """
+        return _file_changes(
+            self.__directory, self.__hash, other.__hash, limit, status)
+
     @property
     def hash(self):
         """:rtype: str"""
@@ -117,6 +128,200 @@ class Commit:
         """:rtype: str"""
         return _commit_message(self.__directory, self.__hash)
 
+    @property
+    def parents(self):
+        """:rtype: list[Commit]"""
+        return [Commit(parent, self.__repo) for parent
+                in _commit_parents(self.__directory, self.__hash)]
+
+    @property
+    def tree(self):
+        """:rtype: str"""
+        return _commit_tree(self.__directory, self.__hash)
+
+
+class CommitGraph:
+    """
+    The commit DAG of a repository, read once from "git rev-list" to answer
+    ancestry queries in memory.
+
+    Every commit gets a generation number: 1 for root commits, otherwise one
+    more than its highest parent. A commit can only be an ancestor of
+    commits with a higher generation number, which bounds the walks.
+    """
+    def __init__(self, lines):
+        """
+        :param list[str] lines: "git rev-list --topo-order --parents" output,
+            children before their parents.
+        """
+        self.__index = {}
+        self.__parents = []
+        self.__generations = []
+        for line in reversed(lines):
+            hashes = line.split()
+            if not hashes:
+                continue
+            # Parents missing from the output, like in shallow clones, are
+            # treated as unknown.
+            parents = tuple(self.__index[h] for h in hashes[1:]
+                            if h in self.__index)
+            self.__index[hashes[0]] = len(self.__parents)
+            self.__parents.append(parents)
+            self.__generations.append(1 + max(
+                [self.__generations[p] for p in parents] or [0]))
+
+    @classmethod
+    def load(cls, directory):
+        """
+        :type directory: str
+        :rtype: CommitGraph
+        """
+        return cls(check_output(
+            ['git', 'rev-list', '--topo-order', '--parents', '--all'],
+            cwd=directory).splitlines())
+
+    def __contains__(self, commit_hash):
+        return commit_hash in self.__index
+
+    def __len__(self):
+        return len(self.__parents)
+
+    def generation(self, commit_hash):
+        """
+        :type commit_hash: str
+        :rtype: int
+        """
+        return self.__generations[self.__index[commit_hash]]
+
+    def is_ancestor(self, ancestor, descendant):
+        """
+        Check if [ancestor] is reachable from [descendant]. Both commits have
+        to be part of the graph.
+
+        :type ancestor: str
+        :type descendant: str
+        :rtype: bool
+        """
+        target = self.__index[ancestor]
+        start = self.__index[descendant]
+        if target == start:
+            return True
+        generations = self.__generations
+        generation = generations[target]
+        if generations[start] <= generation:
+            return False
+        seen = set([start])
+        stack = [start]
+        while stack:
+            for parent in self.__parents[stack.pop()]:
+                if parent == target:
+                    return True
+                if parent not in seen and generations[parent] > generation:
+                    seen.add(parent)
+                    stack.append(parent)
+        return False
+
+
+class ObjectReader:
+    """
+    A long running "git cat-file --batch" process, reading objects of all
+    known repositories over one pipe.
+
+    Objects are addressed by their hash, so the object stores of all
+    repositories read from so far are passed to the process as alternates.
+    The process is only restarted when a repository that it doesn't know
+    about yet is read from.
+    """
+
+    def __init__(self):
+        self.__stores = []
+        self.__process = None
+        self.__serving = ()
+        self.__lock = threading.RLock()
+
+    def register(self, directory):
+        """
+        Make a repositories objects available to the next process started.
+
+        :type directory: str
+        """
+        if not directory or not os.path.isdir(directory + '/.git/objects'):
+            return
+        store = directory + '/.git/objects'
+        with self.__lock:
+            if store not in self.__stores:
+                self.__stores.append(store)
+
+    def read(self, directory, object_hash):
+        """
+        Read an object from a repository.
+
+        :type directory: str
+        :type object_hash: str
+        :return: The objects type and content, or None if it can't be read.
+        :rtype: (str, str)
+        """
+        if not directory:
+            return None
+        store = directory + '/.git/objects'
+        with self.__lock:
+            if store not in self.__serving:
+                if not os.path.isdir(store):
+                    return None
+                self.register(directory)
+                self.__start()
+                if store not in self.__serving:
+                    return None
+            try:
+                self.__process.stdin.write(object_hash + '\n')
+                self.__process.stdin.flush()
+                header = self.__process.stdout.readline().split()
+                if len(header) != 3:
+                    return None
+                data = self.__process.stdout.read(int(header[2]))
+                self.__process.stdout.read(1)
+                return header[1], data
+            except (IOError, ValueError):
+                self.close()
+                return None
+
+    def __start(self):
+        """
+        (Re)start the process serving all registered repositories.
+        """
+        self.close()
+        stores = [s for s in self.__stores if os.path.isdir(s)]
+        if not stores:
+            return
+        env = dict(os.environ)
+        env['GIT_DIR'] = os.path.dirname(stores[0])
+        env['GIT_ALTERNATE_OBJECT_DIRECTORIES'] = os.pathsep.join(stores[1:])
+        try:
+            self.__process = Popen(
+                ['git', 'cat-file', '--batch'], stdin=PIPE, stdout=PIPE,
+                stderr=open(os.devnull, 'w'), env=env)
+        except OSError:
+            return
+        self.__serving = tuple(stores)
+
+    def close(self):
+        """
+        Stop the process.
+        """
+        with self.__lock:
+            if self.__process is not None:
+                try:
+                    self.__process.stdin.close()
+                except IOError:
+                    pass
+                self.__process.wait()
+            self.__process = None
+            self.__serving = ()
+
+
+_objects = ObjectReader()
+atexit.register(_objects.close)
+
 
 class Repository:
     @property
@@ -156,6 +361,18 @@ class Repository:
     def get_commit(self, commit_hash):
         return Commit(commit_hash, self)
 
+    def closest(self, hashes):
+        """
+        Find the most recent commit in the history of the current commit
+        that is one of [hashes].
+
+        :type hashes: collections.Iterable[str]
+        :rtype: Commit
+        """
+        found = _closest_ancestor(
+            self.directory, self.current_commit.hash, set(hashes))
+        return Commit(found, self) if found else None
+
     @property
     def branch(self):
         """
@@ -182,28 +399,373 @@ class Repository:
         """
         sp = re.compile('^source:/')
         dp = re.compile('^data:/')
-        if sp.match(filepattern) or dp.match(filepattern):
-            data = '%s/%s' % (config.config.host_data_directory, self.project)
-            f = dp.sub(data, sp.sub(self.directory, filepattern))
-        else:
-            f = "%s/%s" % (self.directory, filepattern)
+        if not dp.match(filepattern):
+            pattern = sp.sub('', filepattern)
+            return self.search_files(
+                self.find_files([pattern])[pattern], contentpattern)
 
+        data = '%s/%s' % (config.config.host_data_directory, self.project)
+        f = dp.sub(data, filepattern)
         if contentpattern:
             matched_files = gitless_globber.glob(f) if '*' in f else [f]
-            expr = re.compile(contentpattern)
-            for f in matched_files:
-                if not os.path.isfile(f):
-                    continue
-                with open(f) as fp:
-                    if expr.search(fp.read()):
-                        return True
-            return False
+            return _files_contain(matched_files, contentpattern)
         else:
             if '*' in filepattern:
                 return len(gitless_globber.glob(f)) > 0
             else:
                 return os.path.exists(f)
 
+    def find_files(self, patterns):
+        """
+        Match glob patterns, relative to the repository root, against the
+        file index in a single pass. The index is only built if there is
+        anything to match.
+
+        :type patterns: collections.Iterable[str]
+        :rtype: dict[str, list[str]]
+        """
+        patterns = list(patterns)
+        if not patterns:
+            return {}
+        files, directories = _file_index(self.directory)
+        found = {}
+        globs = []
+        for pattern in patterns:
+            path = pattern.strip('/')
+            while path.startswith('./'):
+                path = path[2:].lstrip('/')
+            found[pattern] = []
+            if '*' in path:
+                globs.append((_glob_regex(path), found[pattern]))
+            elif path in files or path in directories:
+                found[pattern].append(path)
+
+        if globs:
+            for paths in (files, directories):
+                for path in paths:
+                    for expr, matched in globs:
+                        if expr.match(path):
+                            matched.append(path)
+        return found
+
+    def search_files(self, paths, contentpattern=None):
+        """
+        Check if any of the paths, as returned by [Repository.find_files],
+        is a file with content matching a regex. Without a regex, check if
+        there are any paths at all.
+
+        :type paths: list[str]
+        :type contentpattern: str
+        :rtype: bool
+        """
+        if not contentpattern:
+            return len(paths) > 0
+        return _files_contain(
+            ['%s/%s' % (self.directory, f) for f in paths], contentpattern)
+
+
+__content_expressions = LRUCache('content_expressions', 1000)
+__content_matches = PersistentCache('content')
+def _files_contain(paths, pattern):
+    """
+    Check if any of the regular files among [paths] contains a match for a
+    regex pattern. Binary files never match.
+
+    The result for the whole set of files is cached, one entry per content
+    trigger, until one of the files is added, removed or changes its
+    modification time or size.
+
+    :type paths: collections.Iterable[str]
+    :type pattern: str
+    :rtype: bool
+    """
+    files = []
+    for path in paths:
+        try:
+            info = os.stat(path)
+        except OSError:
+            continue
+        if stat.S_ISREG(info.st_mode):
+            files.append((path, info.st_mtime, info.st_size))
+    if not files:
+        return False
+
+    digest = hashlib.sha1(pattern)
+    for path, mtime, size in sorted(files):
+        digest.update('\0%s\0%r\0%s' % (path, mtime, size))
+    key = digest.hexdigest()
+    result = __content_matches.get(key)
+    if result is None:
+        expr = __content_expressions.get(pattern)
+        if expr is None:
+            expr = re.compile(pattern)
+            __content_expressions.set(pattern, expr)
+        result = False
+        for path, mtime, size in files:
+            try:
+                if _search_file(path, size, expr):
+                    result = True
+                    break
+            except (IOError, OSError):
+                # Vanished or unreadable, the next run tries again.
+                return False
+        __content_matches.set(key, result)
+    return result
+
+
+_binary_probe = 8000
+_chunk_size = 1 << 20
+_chunk_overlap = 1 << 12
+def _search_file(path, size, expr):
+    """
+    Search a file for a regex without reading it into memory. Files with a
+    NUL byte in the first 8000 bytes are considered binary and skipped,
+    like git does.
+
+    The file is memory mapped, so the search stops at the first match and
+    only touches the pages it scanned. If the file can't be mapped, it is
+    read in chunks, overlapping by [_chunk_overlap] bytes to find matches
+    crossing chunk boundaries.
+
+    :type path: str
+    :type size: int
+    :type expr: re.RegexObject
+    :rtype: bool
+    """
+    with open(path, 'rb') as fp:
+        head = fp.read(_binary_probe)
+        if '\0' in head:
+            return False
+        if size <= len(head):
+            return expr.search(head) is not None
+        try:
+            content = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (mmap.error, ValueError):
+            content = None
+        if content is not None:
+            try:
+                return expr.search(content) is not None
+            finally:
+                content.close()
+
+        fp.seek(0)
+        tail = ''
+        while True:
+            chunk = fp.read(_chunk_size)
+            if not chunk:
+                return False
+            if expr.search(tail + chunk):
+                return True
+            tail = chunk[-_chunk_overlap:]
+
+
+__file_indexes = LRUCache('file_indexes', 16)
+def _file_index(directory):
+    """
+    All files of the working tree, and the directories containing them,
+    collected in one traversal per commit. With [Config.trigger_files] set
+    to "tracked", only the files known to git are listed.
+
+    :type directory: str
+    :rtype: (set[str], set[str])
+    """
+    if config.config.trigger_files == 'tracked':
+        return _tracked_paths(directory)
+    head = _head(directory)
+    key = (directory, head and head[1])
+    index = __file_indexes.get(key)
+    if index is None:
+        index = _walk_files(directory)
+        __file_indexes.set(key, index)
+    return index
+
+
+def _walk_files(directory):
+    """
+    List the working tree below a directory, skipping git metadata.
+
+    :type directory: str
+    :rtype: (set[str], set[str])
+    """
+    files = set()
+    directories = set()
+    pending = ['']
+    while pending:
+        relative = pending.pop()
+        try:
+            names, subdirectories = _list_directory(
+                os.path.join(directory, relative))
+        except OSError:
+            continue
+        subdirectories = set(subdirectories)
+        for name in names:
+            if name.endswith('.git'):
+                continue
+            path = relative + '/' + name if relative else name
+            if name in subdirectories:
+                directories.add(path)
+                pending.append(path)
+            else:
+                files.add(path)
+    return files, directories
+
+
+__tracked_paths = LRUCache('tracked_paths', 16)
+def _tracked_paths(directory):
+    """
+    The files tracked by git, and the directories containing them, read
+    once per commit and index state.
+
+    :type directory: str
+    :rtype: (set[str], set[str])
+    """
+    head = _head(directory)
+    key = (directory, head and head[1], _stamp(directory + '/.git/index'))
+    paths = __tracked_paths.get(key)
+    if paths is None:
+        output = check_output(['git', 'ls-files', '-z'], cwd=directory)
+        files = set(f for f in output.split('\0') if f)
+        directories = set()
+        for f in files:
+            segments = f.split('/')[:-1]
+            for i in range(len(segments)):
+                directories.add('/'.join(segments[:i + 1]))
+        paths = (files, directories)
+        __tracked_paths.set(key, paths)
+    return paths
+
+
+__glob_expressions = LRUCache('glob_expressions')
+def _glob_regex(pattern):
+    """
+    Translate a glob pattern into a regular expression matching relative
+    paths. "*", "?" and "[...]" match within one path segment, "**" matches
+    any number of directories. Wildcards don't match names starting with a
+    dot, like in shell globbing.
+
+    :type pattern: str
+    :rtype: re.RegexObject
+    """
+    expr = __glob_expressions.get(pattern)
+    if expr is None:
+        segments = pattern.strip('/').split('/')
+        regex = ''
+        for i, segment in enumerate(segments):
+            last = i == len(segments) - 1
+            if segment == '**':
+                regex += '.*' if last else '(?:(?!\\.)[^/]+/)*'
+            else:
+                regex += _glob_segment(segment) + ('' if last else '/')
+        expr = re.compile(regex + '$')
+        __glob_expressions.set(pattern, expr)
+    return expr
+
+
+def _glob_segment(segment):
+    """
+    Translate a glob pattern for a single path segment.
+
+    :type segment: str
+    :rtype: str
+    """
+    regex = '(?!\\.)' if segment[:1] in ('*', '?', '[') else ''
+    i = 0
+    while i < len(segment):
+        char = segment[i]
+        i += 1
+        if char == '*':
+            regex += '[^/]*'
+        elif char == '?':
+            regex += '[^/]'
+        elif char == '[' and ']' in segment[i + 1:]:
+            end = segment.index(']', i + 1)
+            content = segment[i:end]
+            if content[:1] == '!':
+                content = '^' + content[1:]
+            regex += '[%s]' % content.replace('\\', '\\\\')
+            i = end + 1
+        else:
+            regex += re.escape(char)
+    return regex
+
+
+__repositories = PersistentCache('repositories')
+def _find_repositories(directory):
+    """
+    Find all repositories below a directory, up to [Config.scan_depth]
+    levels deep and skipping directories matching [Config.scan_exclude].
+    Repositories within repositories are ignored.
+
+    Results are kept in a persistent index and reused as long as none of
+    the scanned directories changed.
+
+    :type directory: str
+    :rtype: list[str]
+    """
+    directory = directory.rstrip('/') or '/'
+    depth = config.config.scan_depth
+    excludes = config.config.scan_exclude
+    key = '%s:%s:%s' % (directory, depth, ':'.join(excludes))
+
+    index = __repositories.get(key)
+    if index and all(_mtime(d) == mtime
+                     for d, mtime in index['directories'].iteritems()):
+        return index['repositories']
+
+    directories = {}
+    repositories = []
+    pending = [(directory, 0)]
+    while pending:
+        path, level = pending.pop()
+        try:
+            directories[path] = os.stat(path).st_mtime
+            names, subdirectories = _list_directory(path)
+        except OSError:
+            continue
+        if '.git' in names and path != directory:
+            # Don't descend into repositories.
+            repositories.append(path)
+            continue
+        if level >= depth:
+            continue
+        for name in subdirectories:
+            if name.startswith('.') or \
+                    any(fnmatch(name, pattern) for pattern in excludes):
+                continue
+            pending.append((os.path.join(path, name), level + 1))
+
+    repositories.sort()
+    __repositories.set(key, {
+        'directories': directories, 'repositories': repositories})
+    return repositories
+
+
+def _list_directory(path):
+    """
+    List all entries of a directory, and its subdirectories separately.
+    Symbolic links to directories are not followed, they could form a
+    loop.
+
+    :type path: str
+    :rtype: (list[str], list[str])
+    """
+    if scandir is not None:
+        entries = list(scandir(path))
+        return ([e.name for e in entries],
+                [e.name for e in entries if e.is_dir(follow_symlinks=False)])
+    names = os.listdir(path)
+    return names, [n for n in names
+                   if stat.S_ISDIR(os.lstat(os.path.join(path, n)).st_mode)]
+
+
+def _mtime(path):
+    """
+    :rtype: float
+    """
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
 
 
 def _is_repository(directory):
@@ -219,6 +781,9 @@ def _current_commit(directory):
     """
     :rtype: str
     """
+    head = _head(directory)
+    if head and head[1]:
+        return head[1]
     return check_output(
         ['git', '--no-pager', 'log', '-1', '--format=%H']
         , cwd=directory).strip()
@@ -228,10 +793,129 @@ def _current_branch(directory):
     """
     :rtype: str
     """
+    head = _head(directory)
+    if head and head[1]:
+        return head[0]
     return check_output(
         ['git', 'rev-parse', '--abbrev-ref', 'HEAD']
         , cwd=directory).strip()
-    pass
+
+
+def _stamp(path):
+    """
+    Identify a files current version without reading it.
+
+    :rtype: tuple
+    """
+    try:
+        info = os.stat(path)
+    except OSError:
+        return None
+    return info.st_mtime, info.st_ino, info.st_size
+
+
+def _read(path):
+    """
+    :rtype: str
+    """
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except IOError:
+        return None
+
+
+def _packed_refs(git_dir):
+    """
+    :rtype: dict[str,str]
+    """
+    refs = {}
+    for line in (_read(git_dir + '/packed-refs') or '').splitlines():
+        if line and line[0] not in '#^':
+            commit_hash, _, ref = line.partition(' ')
+            refs[ref] = commit_hash
+    return refs
+
+
+__hash_pattern = re.compile('^[0-9a-f]{40}([0-9a-f]{24})?$')
+__heads = LRUCache('heads')
+def _head(directory):
+    """
+    Resolve HEAD to the current branch and commit hash by reading the
+    repository files, without running git. Cached until HEAD, the branch
+    ref or packed-refs change.
+
+    The branch is "HEAD" if it is detached, like "git rev-parse
+    --abbrev-ref HEAD" reports it. Returns None for layouts that are left
+    to git: worktrees and submodules, where ".git" is a file, and the
+    reftable ref storage.
+
+    :type directory: str
+    :rtype: (str, str)
+    """
+    git_dir = directory + '/.git'
+    cached = __heads.get(directory)
+    if cached:
+        stamps, head = cached
+        if all(_stamp(path) == stamp for path, stamp in stamps):
+            return head
+
+    if not os.path.isdir(git_dir) or os.path.isdir(git_dir + '/reftable'):
+        return None
+    files = [git_dir + '/HEAD', git_dir + '/packed-refs']
+    stamps = [(path, _stamp(path)) for path in files]
+    content = _read(git_dir + '/HEAD')
+    if content is None:
+        return None
+
+    branch, commit_hash, packed = 'HEAD', content, None
+    # Follow symbolic refs, usually just HEAD pointing to a branch.
+    for _ in range(5):
+        if not commit_hash.startswith('ref: '):
+            break
+        ref = commit_hash[5:].strip()
+        if ref.startswith('refs/heads/') and branch == 'HEAD':
+            branch = ref[11:]
+        path = git_dir + '/' + ref
+        stamps.append((path, _stamp(path)))
+        commit_hash = _read(path)
+        if commit_hash is None:
+            if packed is None:
+                packed = _packed_refs(git_dir)
+            # An unborn branch has no commit yet.
+            commit_hash = packed.get(ref, '')
+    else:
+        return None
+    if commit_hash and not __hash_pattern.match(commit_hash):
+        return None
+
+    head = (branch, commit_hash or None)
+    __heads.set(directory, (stamps, head))
+    return head
+
+
+def _read_commit(directory, commit):
+    """
+    Read and parse a commit object.
+
+    :type directory: str
+    :type commit: str
+    :return: A dict with "tree", "parents" and "message", or None if the
+        commit can't be read.
+    :rtype: dict
+    """
+    result = _objects.read(directory, commit)
+    if result is None or result[0] != 'commit':
+        return None
+    headers, _, message = result[1].partition('\n\n')
+    parsed = {'tree': None, 'parents': [], 'message': message.strip()}
+    for line in headers.splitlines():
+        key, _, value = line.partition(' ')
+        if key == 'tree':
+            parsed['tree'] = value
+        elif key == 'parent':
+            parsed['parents'].append(value)
+    return parsed
 
 
 def _commit_message(directory, commit):
@@ -240,12 +924,106 @@ def _commit_message(directory, commit):
     :type commit: str
     :rtype: str
     """
+    parsed = _read_commit(directory, commit)
+    if parsed is not None:
+        return parsed['message']
     return check_output(
         ['git', 'log', '--format=%B', '-n', '1', commit]
         , cwd=directory).strip()
 
 
-__ancestors = {}
+def _commit_parents(directory, commit):
+    """
+    :type directory: str
+    :type commit: str
+    :rtype: list[str]
+    """
+    parsed = _read_commit(directory, commit)
+    if parsed is not None:
+        return parsed['parents']
+    return check_output(
+        ['git', 'rev-list', '--parents', '-n', '1', commit],
+        cwd=directory).split()[1:]
+
+
+def _commit_tree(directory, commit):
+    """
+    :type directory: str
+    :type commit: str
+    :rtype: str
+    """
+    parsed = _read_commit(directory, commit)
+    if parsed is not None:
+        return parsed['tree']
+    return check_output(
+        ['git', 'rev-parse', commit + '^{tree}'], cwd=directory).strip()
+
+
+def _closest_ancestor(directory, commit, hashes):
+    """
+    Walk the history of [commit], newest first, and stop at the first
+    commit in [hashes]. Unlike --topo-order, which has to read the whole
+    history before printing anything when there is no commit-graph file,
+    the default order is streamed, so only the history back to that commit
+    is read.
+
+    Commit dates can be out of order, so a commit listed later might still
+    be closer. Those can only be in the history between the found commit
+    and [commit], which is listed once more in topological order.
+
+    :type directory: str
+    :type commit: str
+    :type hashes: set[str]
+    :rtype: str
+    """
+    if not hashes:
+        return None
+    if commit in hashes:
+        return commit
+    key = 'closest:' + hashlib.sha1(
+        commit + ':' + ','.join(sorted(hashes))).hexdigest()
+    cached = __persistent.get(key)
+    if cached is not None:
+        return cached or None
+
+    found = _first_listed(directory, ['git', 'rev-list', commit], hashes)
+    if found:
+        found = _first_listed(directory, [
+            'git', 'rev-list', '--topo-order', '^' + found, commit
+        ], hashes) or found
+    __persistent.set(key, found or '')
+    return found
+
+
+def _first_listed(directory, command, hashes):
+    """
+    Run a git command listing commits, and stop it as soon as one of
+    [hashes] is listed.
+
+    :type directory: str
+    :type command: list[str]
+    :type hashes: set[str]
+    :rtype: str
+    """
+    process = Popen(command, cwd=directory, stdout=PIPE,
+                    stderr=open(os.devnull, 'w'))
+    try:
+        for line in iter(process.stdout.readline, ''):
+            if line.strip() in hashes:
+                return line.strip()
+    finally:
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+    return None
+
+
+# Relations between commits never change, so results are kept across
+# dork invocations.
+__persistent = PersistentCache('git')
+
+
+__ancestors = LRUCache('ancestors')
 def _is_ancestor(directory, ancestor, descendant):
     """
     :type directory: str
@@ -255,22 +1033,55 @@ def _is_ancestor(directory, ancestor, descendant):
     """
     key = '%s:%s:%s' %(directory, ancestor, descendant)
 
-    global __ancestors
-    if key not in __ancestors:
+    result = __ancestors.get(key)
+    if result is None:
         if ancestor == descendant:
             return False
         elif ancestor == "new":
             return True
         elif descendant == "new":
             return False
-        else:
-            __ancestors[key] = call(
-                ['git', 'merge-base', '--is-ancestor', ancestor, descendant],
-                cwd=directory, stdout=PIPE, stderr=PIPE) is 0
-    return __ancestors[key]
+        result = __persistent.get('ancestor:' + key)
+        if result is None:
+            graph = _commit_graph(directory)
+            if graph and ancestor in graph and descendant in graph:
+                result = graph.is_ancestor(ancestor, descendant)
+            else:
+                # Commits that are not reachable from any ref.
+                code = call(
+                    ['git', 'merge-base', '--is-ancestor', ancestor, descendant],
+                    cwd=directory, stdout=PIPE, stderr=PIPE)
+                if code not in (0, 1):
+                    # One of the commits is unknown, it might be fetched
+                    # later. Don't remember the answer.
+                    return False
+                result = code == 0
+            __persistent.set('ancestor:' + key, result)
+        __ancestors.set(key, result)
+    return result
 
 
-__commit_diffs = {}
+# Graphs of large repositories are big, only a few are kept.
+__commit_graphs = LRUCache('commit_graphs', 4)
+def _commit_graph(directory):
+    """
+    The commit graph of a repository, loaded on first use. None if it can't
+    be read.
+
+    :type directory: str
+    :rtype: CommitGraph
+    """
+    graph = __commit_graphs.get(directory)
+    if graph is None:
+        try:
+            graph = CommitGraph.load(directory)
+        except (CalledProcessError, OSError):
+            graph = False
+        __commit_graphs.set(directory, graph)
+    return graph or None
+
+
+__commit_diffs = LRUCache('commit_diffs')
 def _commit_diff(directory, a, b):
     """
     :type directory: str
@@ -279,15 +1090,18 @@ def _commit_diff(directory, a, b):
     :rtype: list
     """
     key = '%s:%s:%s' % (directory, a, b)
-    global __commit_diffs
-    if key not in __commit_diffs:
-        __commit_diffs[key] = check_output(
-            ['git', '--no-pager', 'log', '--format=%H',
-             a + '...' + b], cwd=directory).splitlines()
-    return __commit_diffs[key]
+    result = __commit_diffs.get(key)
+    if result is None:
+        result = __persistent.get('commits:' + key)
+        if result is None:
+            result = check_output(
+                ['git', '--no-pager', 'log', '--format=%H',
+                 a + '...' + b], cwd=directory).splitlines()
+            __persistent.set('commits:' + key, result)
+        __commit_diffs.set(key, result)
+    return result
 
 
-__file_diffs = {}
 def _file_diff(directory, a, b):
     """
     :type directory: str
@@ -295,10 +1109,84 @@ def _file_diff(directory, a, b):
     :type b: str
     :rtype: list
     """
+    return list(_file_changes(directory, a, b))
+
+
+__file_diffs = LRUCache('file_diffs')
+def _file_changes(directory, a, b, limit=None, status=False):
+    """
+    Iterate over the files changed between two commits, as git reports
+    them. Paths are read NUL separated, so they are passed on exactly, and
+    one by one: git is stopped as soon as the caller stops iterating.
+
+    Complete lists of paths are cached. Paths are byte strings, they are
+    persisted as latin-1 text, which maps every byte to one character and
+    back.
+
+    :type directory: str
+    :type a: str
+    :type b: str
+    :param int limit: Stop after this many files.
+    :param bool status: Yield (status, path, previous path) tuples instead
+        of paths. The previous path is only set for renames and copies.
+    :rtype: collections.Iterable[str|(str,str,str)]
+    """
     key = '%s:%s:%s' % (directory, a, b)
-    global __file_diffs
-    if key not in __file_diffs:
-        __file_diffs[key] = check_output(
-            ['git', 'diff', '--name-only', a, b],
-            cwd=directory).splitlines()
-    return __file_diffs[key]
+    if not status:
+        cached = __file_diffs.get(key)
+        if cached is None:
+            cached = __persistent.get('paths:' + key)
+            if cached is not None:
+                cached = [path.encode('latin-1') for path in cached]
+                __file_diffs.set(key, cached)
+        if cached is not None:
+            for path in cached[:limit]:
+                yield path
+            return
+
+    cmd = ['git', 'diff', '-z', '--no-color', '--no-ext-diff']
+    cmd += ['--name-status', '--find-renames'] if status else ['--name-only']
+    process = Popen(cmd + [a, b], cwd=directory, stdout=PIPE)
+    records = _nul_records(process.stdout)
+    paths = []
+    try:
+        for record in records:
+            if limit is not None and len(paths) >= limit:
+                return
+            if status:
+                previous = None
+                if record[0] in 'RC':
+                    previous = next(records)
+                change = (record[0], next(records), previous)
+                paths.append(change)
+                yield change
+            else:
+                paths.append(record)
+                yield record
+    finally:
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+    if process.returncode != 0:
+        raise CalledProcessError(process.returncode, cmd)
+    if not status:
+        __file_diffs.set(key, paths)
+        __persistent.set('paths:' + key,
+                         [path.decode('latin-1') for path in paths])
+
+
+def _nul_records(stream, block_size=65536):
+    """
+    Split a stream into NUL terminated records.
+
+    :type stream: file
+    :rtype: collections.Iterable[str]
+    """
+    buffered = ''
+    for block in iter(lambda: stream.read(block_size), ''):
+        records = (buffered + block).split('\0')
+        buffered = records.pop()
+        for record in records:
+            yield record
+    if buffered:
+        yield buffered
@@ -1,8 +1,11 @@
 import config
 from git import Repository
+import json
 import os
+import re
 import yaml
-from fnmatch import fnmatch
+from cache import LRUCache, PersistentCache
+from fnmatch import translate
 
 class Role:
     @classmethod
@@ -13,23 +16,25 @@ class Role:
     def clear(cls, repository):
         return RoleFactory(repository).clear()
 
-    def __init__(self, name, meta, repository):
+    def __init__(self, name, meta, repository, matcher=None):
         """
         :type name: str
         :type meta: dict
         :type repository: Repository
+        :type matcher: PatternMatcher
         :return:
         """
         self.repo = repository
         self.name = name
         self.factory = RoleFactory(repository)
+        self.__matcher = matcher or PatternMatcher(repository)
 
+        # The metadata is shared by all repositories, never modify it.
         self.__meta = meta
-        if 'dork' not in self.__meta:
-            self.__meta['dork'] = {}
+        self.__dork = meta.get('dork') or {}
 
         self.__dependencies = []
-        self.__services = meta['dork']['services'] if 'services' in meta['dork'] else {}
+        self.__services = self.__dork.get('services', {})
 
         if 'dependencies' in self.__meta and isinstance(self.__meta['dependencies'], list):
             for dep in self.__meta['dependencies']:
@@ -38,8 +43,8 @@ class Role:
                 if isinstance(dep, dict) and 'role' in dep:
                     self.__dependencies.append(dep['role'])
 
-        if 'build_triggers' in self.__meta['dork']:
-            self.__triggers = self.__meta['dork']['build_triggers']
+        if 'build_triggers' in self.__dork:
+            self.__triggers = self.__dork['build_triggers']
 
             # if matches is a simple list, create a default pattern
             if not isinstance(self.__triggers, dict):
@@ -47,34 +52,55 @@ class Role:
         else:
             self.__triggers = {}
 
-        self.__matched_triggers = []
+        self.__matched_triggers = None
+        self.__resolved = {}
         self.__enabled_triggers = []
         self.__disabled_triggers = []
 
+        # Only register the patterns, so the matcher can test the patterns
+        # of all roles in one batch when the first role is asked.
         for trigger, patterns in self.__triggers.iteritems():
             if isinstance(patterns, list):
-                # If filepatterns is a list, check them all.
-                fits = len(patterns) > 0
                 for pattern in patterns:
                     # If it's a dictionary, use key as filepattern and
                     # value as content regex.
                     if isinstance(pattern, dict):
-                        fits = fits and all([repository.contains_file(gp, cp)
-                                             for gp, cp in pattern.iteritems()])
+                        for gp, cp in pattern.iteritems():
+                            self.__matcher.add(gp, cp)
                     elif isinstance(pattern, str):
-                        fits = fits and repository.contains_file(pattern)
-                if fits:
-                    self.__matched_triggers.append(trigger)
+                        self.__matcher.add(pattern)
 
             elif isinstance(patterns, bool):
                 # If filepatterns is a boolean value, match the pattern accordingly.
-                if patterns and trigger == 'global':
-                    self.__matched_triggers.append(trigger)
-                elif patterns:
+                if patterns and trigger != 'global':
                     self.__enabled_triggers.append(trigger)
-                else:
+                elif not patterns:
                     self.__disabled_triggers.append(trigger)
 
+    @property
+    def matched_triggers(self):
+        """
+        Get the triggers whose patterns match the repository.
+        :rtype: list[str]
+        """
+        if self.__matched_triggers is None:
+            matched = []
+            for trigger, patterns in self.__triggers.iteritems():
+                if isinstance(patterns, list):
+                    # If filepatterns is a list, check them all.
+                    fits = len(patterns) > 0
+                    for pattern in patterns:
+                        if isinstance(pattern, dict):
+                            fits = fits and all([self.__matcher.matches(gp, cp)
+                                                 for gp, cp in pattern.iteritems()])
+                        elif isinstance(pattern, str):
+                            fits = fits and self.__matcher.matches(pattern)
+                    if fits:
+                        matched.append(trigger)
+                elif patterns is True and trigger == 'global':
+                    matched.append(trigger)
+            self.__matched_triggers = matched
+        return self.__matched_triggers
 
     @property
     def dependencies(self):
@@ -89,7 +115,19 @@ class Role:
         :type name:
         :rtype: bool
         """
-        return name in self.__dependencies or any([self.factory.get(dep).includes(name) for dep in self.__dependencies])
+        return self.factory.graph.includes(self, name)
+
+    def __resolve(self, key, combine):
+        """
+        Combine the values of all dependencies and this role, once. The
+        dependency graph is checked for cycles before, and each dependency
+        resolves its own value only once, so shared dependencies are not
+        visited again.
+        """
+        if key not in self.__resolved:
+            self.__resolved[key] = combine(
+                self.factory.graph.dependencies(self))
+        return self.__resolved[key]
 
     @property
     def services(self):
@@ -97,26 +135,29 @@ class Role:
         Recursively get all fixed ports.
         :return: dict
         """
-        ports = {}
-        for dep in self.__dependencies:
-            ports.update(self.factory.get(dep).services)
-        ports.update(self.__services)
-        return ports
+        def combine(dependencies):
+            ports = {}
+            for dep in dependencies:
+                ports.update(dep.services)
+            ports.update(self.__services)
+            return ports
+        return dict(self.__resolve('services', combine))
 
     def triggers(self):
         """
         Recursively get all defined triggers.
         :return:
         """
-        triggers = self.__triggers
-        for dep in self.__dependencies:
-            role = self.factory.get(dep)
-            triggers.update(role.triggers())
-        return triggers
+        def combine(dependencies):
+            triggers = dict(self.__triggers)
+            for dep in dependencies:
+                triggers.update(dep.triggers())
+            return triggers
+        return dict(self.__resolve('triggers', combine))
 
     @property
     def triggered(self):
-        return len(self.__matched_triggers) > 0
+        return len(self.matched_triggers) > 0
 
     @property
     def active_triggers(self):
@@ -124,51 +165,318 @@ class Role:
         Get a list of triggers that are active for this repository.
         :rtype: list[str]
         """
-        if len(self.__matched_triggers) == 0:
-            triggers = []
-        else:
-            triggers = self.__matched_triggers + self.__enabled_triggers
+        def combine(dependencies):
+            if len(self.matched_triggers) == 0:
+                triggers = []
+            else:
+                triggers = self.matched_triggers + self.__enabled_triggers
+
+            for dep in dependencies:
+                triggers += dep.active_triggers
+            return list(set(triggers) - set(self.__disabled_triggers))
+        return list(self.__resolve('active_triggers', combine))
+
+    def update_patterns(self):
+        """
+        Recursively get all update trigger patterns and the tags they
+        trigger.
+        :rtype: list[(str, list[str])]
+        """
+        def combine(dependencies):
+            patterns = []
+            for tagpattern in self.__dork.get('update_triggers', []):
+                patterns += tagpattern.items()
 
-        for dep in self.__dependencies:
-            role = self.factory.get(dep)
-            triggers += role.active_triggers
-        return list(set(triggers) - set(self.__disabled_triggers))
+            for dep in dependencies:
+                patterns += dep.update_patterns()
+            return patterns
+        return list(self.__resolve('update_patterns', combine))
 
     def update_triggers(self, changeset):
         """
         Get a list of required update triggers.
-        :type changeset: list[str]
+        :type changeset: collections.Iterable[str]
         :rtype: list[str]
         """
-        # skip if there are no tags patterns defined
-        tags = []
-        if 'update_triggers' not in self.__meta['dork']:
-            self.__meta['dork']['update_triggers'] = []
-        for tagpattern in self.__meta['dork']['update_triggers']:
-            for pattern, taglist in tagpattern.iteritems():
-                for changed_file in changeset:
-                    if fnmatch(changed_file, pattern):
-                        tags += taglist
+        return Role.update_tags([self], changeset)
 
-        for dep in self.__dependencies:
-            role = self.factory.get(dep)
-            tags += role.update_triggers(changeset)
-
-        return list(set(tags))
+    @classmethod
+    def update_tags(cls, roles, changeset):
+        """
+        Get the update triggers required by any of the roles. The changeset
+        is iterated once and only until all tags are triggered, so it can
+        be a lazy sequence of changed files.
+        :type roles: list[Role]
+        :type changeset: collections.Iterable[str]
+        :rtype: list[str]
+        """
+        patterns = []
+        for role in roles:
+            patterns += role.update_patterns()
+        return TagMatcher(patterns).match(changeset)
 
     @property
     def settings(self):
-        settings = {}
-        for dep in self.dependencies:
-            settings.update(self.factory.get(dep).settings)
-        if 'settings' in self.__meta['dork']:
-            settings.update(self.__meta['dork']['settings'])
-        return settings
+        def combine(dependencies):
+            settings = {}
+            for dep in dependencies:
+                settings.update(dep.settings)
+            if 'settings' in self.__dork:
+                settings.update(self.__dork['settings'])
+            return settings
+        return dict(self.__resolve('settings', combine))
+
+
+class RoleGraph:
+    """
+    The dependency graph of all roles known to a factory, resolved once:
+    the roles in topological order, dependencies first, and the
+    transitive dependencies of each role.
+    """
+
+    def __init__(self, roles):
+        """
+        :type roles: dict[str, Role]
+        :raises RoleCycleException: if roles depend on each other.
+        """
+        self.__roles = roles
+        self.__order = []
+        self.__closures = {}
+
+        # Depth first search without recursion, dependency chains can be
+        # long. A role is added to the order after all its dependencies.
+        visiting = set()
+        for name in sorted(roles):
+            if name in self.__closures:
+                continue
+            path = [(name, iter(self.__names(roles[name])))]
+            visiting.add(name)
+            while path:
+                current, pending = path[-1]
+                dep = next(pending, None)
+                if dep is None:
+                    path.pop()
+                    visiting.discard(current)
+                    closure = set()
+                    for d in self.__names(roles[current]):
+                        closure.add(d)
+                        closure.update(self.__closures[d])
+                    self.__closures[current] = frozenset(closure)
+                    self.__order.append(roles[current])
+                elif dep in visiting:
+                    cycle = [n for n, _ in path]
+                    raise RoleCycleException(cycle[cycle.index(dep):] + [dep])
+                elif dep not in self.__closures:
+                    visiting.add(dep)
+                    path.append((dep, iter(self.__names(roles[dep]))))
+
+    def __names(self, role):
+        """
+        The dependencies of a role that are known to the graph.
+        :type role: Role
+        :rtype: list[str]
+        """
+        return [dep for dep in role.dependencies if dep in self.__roles]
 
+    @property
+    def order(self):
+        """
+        All roles, every role after its dependencies.
+        :rtype: list[Role]
+        """
+        return list(self.__order)
+
+    def dependencies(self, role):
+        """
+        The direct dependencies of a role.
+        :type role: Role
+        :rtype: list[Role]
+        """
+        return [self.__roles[dep] for dep in self.__names(role)]
+
+    def closure(self, role):
+        """
+        The names of all direct and indirect dependencies of a role.
+        :type role: Role
+        :rtype: frozenset[str]
+        """
+        if self.__roles.get(role.name) is role:
+            return self.__closures[role.name]
+        closure = set()
+        for dep in self.__names(role):
+            closure.add(dep)
+            closure.update(self.__closures[dep])
+        return frozenset(closure)
+
+    def includes(self, role, name):
+        """
+        Check if a role depends on another one, directly or indirectly.
+        :type role: Role
+        :type name: str
+        :rtype: bool
+        """
+        return name in self.closure(role)
+
+    def tree(self):
+        """
+        The triggered roles that are not included by other triggered roles.
+        :rtype: list[Role]
+        """
+        matching_roles = [role for role in self.__order if role.triggered]
+        included_roles = set()
+        for role in matching_roles:
+            included_roles.update(self.__closures[role.name])
+        return [r for r in matching_roles if r.name not in included_roles]
+
+
+class RoleCycleException(Exception):
+    def __init__(self, cycle):
+        super(RoleCycleException, self).__init__(
+            'Circular role dependency: %s' % ' -> '.join(cycle))
+        self.cycle = cycle
+
+
+class TagMatcher:
+    """
+    Matches changed files against the update trigger patterns of a role
+    tree. All patterns are combined into one regular expression, so each
+    changed file is tested once; only files matching it are tested against
+    the single patterns to find the tags they trigger.
+    """
+
+    def __init__(self, patterns):
+        """
+        :type patterns: list[(str, list[str])]
+        """
+        # Reverse index of the tags each pattern triggers, patterns shared
+        # by several roles are only tested once.
+        self.__tags = {}
+        for pattern, taglist in patterns:
+            self.__tags.setdefault(pattern, set()).update(taglist)
+
+    def match(self, changeset):
+        """
+        Get the union of the tags triggered by any changed file. The
+        changeset is iterated once and only until all tags are triggered,
+        so it can be a lazy sequence of changed files.
+        :type changeset: collections.Iterable[str]
+        :rtype: list[str]
+        """
+        possible = set()
+        for taglist in self.__tags.itervalues():
+            possible.update(taglist)
+        pending = sorted(self.__tags)
+        tags = set()
+        if not possible:
+            return []
+
+        combined = _combined_expression(pending)
+        for changed_file in changeset:
+            if not combined.match(changed_file):
+                continue
+            for pattern in pending:
+                if _pattern_expression(pattern).match(changed_file):
+                    tags.update(self.__tags[pattern])
+            if tags >= possible:
+                break
+            # Patterns that can't add new tags don't need to be tested.
+            remaining = [p for p in pending if not tags >= self.__tags[p]]
+            if len(remaining) < len(pending):
+                pending = remaining
+                combined = _combined_expression(pending)
+
+        return list(tags)
+
+
+__pattern_expressions = LRUCache('update_patterns')
+def _pattern_expression(pattern):
+    """
+    Compile a glob pattern, with the same semantics as fnmatch.
+    :type pattern: str
+    :rtype: re.RegexObject
+    """
+    expr = __pattern_expressions.get(pattern)
+    if expr is None:
+        expr = re.compile(translate(pattern))
+        __pattern_expressions.set(pattern, expr)
+    return expr
+
+
+__combined_expressions = LRUCache('update_pattern_sets', 100)
+def _combined_expression(patterns):
+    """
+    Compile glob patterns into one expression matching any of them.
+    :type patterns: list[str]
+    :rtype: re.RegexObject
+    """
+    key = tuple(patterns)
+    expr = __combined_expressions.get(key)
+    if expr is None:
+        # fnmatch.translate appends the flags to each pattern, set them
+        # once for the combined expression.
+        expressions = [translate(p) for p in patterns]
+        expr = re.compile('(?ms)' + '|'.join(
+            '(?:%s)' % (e[:-len('(?ms)')] if e.endswith('(?ms)') else e)
+            for e in expressions))
+        __combined_expressions.set(key, expr)
+    return expr
+
+
+class PatternMatcher:
+    """
+    Collects the build trigger patterns of all roles and tests them against
+    a repository together: source patterns are matched in one pass over the
+    repository's file index instead of one glob walk per pattern.
+    """
+
+    def __init__(self, repository):
+        """
+        :type repository: Repository
+        """
+        self.__repo = repository
+        self.__pending = set()
+        self.__results = {}
+
+    def add(self, filepattern, contentpattern=None):
+        """
+        Register a pattern to be tested with the next batch.
+        :type filepattern: str
+        :type contentpattern: str
+        """
+        if (filepattern, contentpattern) not in self.__results:
+            self.__pending.add((filepattern, contentpattern))
+
+    def matches(self, filepattern, contentpattern=None):
+        """
+        Check if the repository contains a file matching the pattern, like
+        [Repository.contains_file] does. Tests all pending patterns at once.
+        :type filepattern: str
+        :type contentpattern: str
+        :rtype: bool
+        """
+        self.add(filepattern, contentpattern)
+        if self.__pending:
+            self.__match()
+        return self.__results[(filepattern, contentpattern)]
+
+    def __match(self):
+        pending, self.__pending = self.__pending, set()
+        sp = re.compile('^source:/')
+        dp = re.compile('^data:/')
+        source = set(sp.sub('', fp) for fp, cp in pending if not dp.match(fp))
+        found = self.__repo.find_files(source) if source else {}
+        for fp, cp in pending:
+            if dp.match(fp):
+                # Data files don't live in the repository.
+                result = self.__repo.contains_file(fp, cp)
+            else:
+                result = self.__repo.search_files(found[sp.sub('', fp)], cp)
+            self.__results[(fp, cp)] = result
 
 
 class RoleFactory:
     __roles = {}
+    __graphs = {}
 
     def __init__(self, repository):
         self.__repo = repository
@@ -177,36 +485,25 @@ class RoleFactory:
     def clear(self):
         if self.__dir in RoleFactory.__roles:
             del RoleFactory.__roles[self.__dir]
+        if self.__dir in RoleFactory.__graphs:
+            del RoleFactory.__graphs[self.__dir]
 
     def list(self):
         if self.__dir not in RoleFactory.__roles:
             roles = {}
+            matcher = PatternMatcher(self.__repo)
 
-            role_directories = config.config.ansible_roles_path
+            role_directories = list(config.config.ansible_roles_path)
             project_role_path = self.__dir + '/.dork'
             if os.path.isdir(project_role_path):
                 role_directories.append(project_role_path)
 
             for roles_dir in role_directories:
-                for role in os.listdir(roles_dir):
-                    meta_file = "%s/%s/meta/main.yml" % (roles_dir, role)
-                    dork_file = "%s/%s/meta/dork.yml" % (roles_dir, role)
-
-                    # Skip if name starts with a . or meta file doesn't exist.
-                    if role.startswith('.') or not os.path.isfile(meta_file):
-                        continue
-                    meta = yaml.load(open(meta_file, 'r'))
-
-                    if os.path.isfile(dork_file):
-                        meta['dork'] = yaml.load(open(dork_file, 'r'))
+                for role, meta in _role_metadata(roles_dir).iteritems():
                     if roles_dir == project_role_path:
-                        if 'dork' not in meta:
-                            meta['dork'] = {}
-                        if 'build_triggers' not in meta['dork']:
-                            meta['dork']['build_triggers'] = {}
-                        meta['dork']['build_triggers']['global'] = True
-                    # Write metadata back into the cache
-                    roles[role] = Role(role, meta, repository=self.__repo)
+                        meta = _project_role(meta)
+                    roles[role] = Role(role, meta, repository=self.__repo,
+                                       matcher=matcher)
             RoleFactory.__roles[self.__dir] = roles
         return RoleFactory.__roles[self.__dir]
 
@@ -215,15 +512,159 @@ class RoleFactory:
         if name in roles:
             return roles[name]
 
-    def tree(self):
-        matching_roles = []
-        for name, role in self.list().iteritems():
-            if role.triggered:
-                matching_roles.append(role)
-
-        included_roles = []
-        for role in matching_roles:
-            if any([r.includes(role.name) for r in matching_roles]):
-                included_roles.append(role.name)
+    @property
+    def graph(self):
+        """
+        :rtype: RoleGraph
+        """
+        graph = RoleFactory.__graphs.get(self.__dir)
+        if graph is None:
+            graph = RoleGraph(self.list())
+            RoleFactory.__graphs[self.__dir] = graph
+        return graph
 
-        return [r for r in matching_roles if r.name not in included_roles]
+    def tree(self):
+        return self.graph.tree()
+
+
+__listings = LRUCache('role_directories', 100)
+__metadata = LRUCache('role_metadata')
+def _role_metadata(roles_dir):
+    """
+    The parsed metadata of all roles in a directory. Shared by all
+    repositories and only parsed again when a meta file changed.
+
+    :type roles_dir: str
+    :rtype: dict[str, dict]
+    """
+    cached = __listings.get(roles_dir)
+    if cached and cached[0] == _mtime(roles_dir):
+        names = cached[1]
+    else:
+        mtime = _mtime(roles_dir)
+        names = [role for role in os.listdir(roles_dir)
+                 if not role.startswith('.')]
+        __listings.set(roles_dir, (mtime, names))
+
+    roles = {}
+    for role in names:
+        meta = _read_role("%s/%s/meta" % (roles_dir, role))
+        # Skip if the meta file doesn't exist.
+        if meta is not None:
+            roles[role] = meta
+    return roles
+
+
+# Use the libyaml parser if PyYAML has been built with it.
+_yaml_loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+__compiled = PersistentCache('roles')
+def _read_role(meta_dir):
+    """
+    Parse a role's main.yml and dork.yml. Parsed metadata is kept in memory
+    and in the persistent cache, as long as path, modification time and
+    size of both files stay the same.
+
+    :type meta_dir: str
+    :rtype: dict
+    """
+    meta_file = meta_dir + '/main.yml'
+    dork_file = meta_dir + '/dork.yml'
+    stamps = [_stamp(meta_file), _stamp(dork_file)]
+    if stamps[0] is None:
+        return None
+
+    cached = __metadata.get(meta_file)
+    if cached and cached[0] == stamps:
+        return cached[1]
+
+    key = json.dumps([meta_file, stamps])
+    meta = _native(__compiled.get(key))
+    if meta is None:
+        with open(meta_file, 'r') as fp:
+            meta = yaml.load(fp, Loader=_yaml_loader) or {}
+        if stamps[1] is not None:
+            with open(dork_file, 'r') as fp:
+                meta['dork'] = yaml.load(fp, Loader=_yaml_loader)
+        # Only persist metadata that survives the trip through JSON, YAML
+        # allows keys and values JSON doesn't.
+        try:
+            persistent = json.loads(json.dumps(meta)) == meta
+        except (TypeError, ValueError):
+            persistent = False
+        if persistent:
+            __compiled.set(key, meta)
+    __metadata.set(meta_file, (stamps, meta))
+    return meta
+
+
+def rebuild(directories):
+    """
+    Parse the metadata of all roles in [directories] again and replace the
+    persistent cache.
+
+    :type directories: list[str]
+    :rtype: int
+    """
+    __compiled.clear()
+    __metadata.clear()
+    __listings.clear()
+    return sum(len(_role_metadata(d)) for d in directories
+               if os.path.isdir(d))
+
+
+def _project_role(meta):
+    """
+    Roles in the project's .dork directory always apply. Add the global
+    trigger to a copy of the shared metadata.
+
+    :type meta: dict
+    :rtype: dict
+    """
+    meta = dict(meta)
+    meta['dork'] = dict(meta.get('dork') or {})
+    triggers = meta['dork'].get('build_triggers') or {}
+    if isinstance(triggers, dict):
+        triggers = dict(triggers)
+    else:
+        triggers = {'default': triggers}
+    triggers['global'] = True
+    meta['dork']['build_triggers'] = triggers
+    return meta
+
+
+def _mtime(path):
+    """
+    :rtype: float
+    """
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def _native(value):
+    """
+    Turn unicode strings from JSON back into byte strings where possible,
+    the way PyYAML loads them.
+    """
+    if isinstance(value, unicode):
+        try:
+            return value.encode('ascii')
+        except UnicodeEncodeError:
+            return value
+    if isinstance(value, list):
+        return [_native(item) for item in value]
+    if isinstance(value, dict):
+        return dict((_native(k), _native(v)) for k, v in value.iteritems())
+    return value
+
+
+def _stamp(path):
+    """
+    :rtype: list
+    """
+    try:
+        info = os.stat(path)
+    except OSError:
+        return None
+    return [info.st_mtime, info.st_size]
@@ -25,12 +25,29 @@ def __resolve(domain):
 def __refresh(*args):
     global registry
     registry = {}
-    for container in Container.list(True):
+    for container in Container.list():
         if container.running:
             registry[container.domain] = '127.0.0.1'
             registry[container.domain + '.host'] = container.address
 
 
+def __update(event):
+    """
+    Update the registry for a single container event.
+
+    :type event: dork.docker.Event
+    """
+    container = event.container
+    if container is None or event.action == 'rename':
+        __refresh()
+    elif container.running:
+        registry[container.domain] = '127.0.0.1'
+        registry[container.domain + '.host'] = container.address
+    else:
+        registry.pop(container.domain, None)
+        registry.pop(container.domain + '.host', None)
+
+
 class DorkResolver(BaseResolver):
     def resolve(self, request, handler):
         reply = request.reply()
@@ -68,9 +85,6 @@ def server(conf, eventstream, killsignal):
     killsignal.subscribe(lambda v: dnsserver.stop())
 
     try:
-        eventstream\
-            .filter(lambda e: 'container' in e)\
-            .filter(lambda e: e['event'] in ['start', 'stop'])\
-            .subscribe(__refresh)
+        eventstream.subscribe(__update)
     except Exception as exc:
         dnsserver.stop()
@@ -14,11 +14,26 @@ address = urlparse(config.docker_address).hostname
 def refresh(*args):
     global registry
     registry = {}
-    for container in containers(True):
+    for container in containers():
         if container.running:
             registry[container.domain] = container.hostPort(80)
 
 
+def update(event):
+    """
+    Update the registry for a single container event.
+
+    :type event: dork.docker.Event
+    """
+    container = event.container
+    if container is None or event.action == 'rename':
+        refresh()
+    elif container.running:
+        registry[container.domain] = container.hostPort(80)
+    else:
+        registry.pop(container.domain, None)
+
+
 class DorkMaster(controller.Master):
     def __init__(self, server):
         controller.Master.__init__(self, server)
@@ -51,10 +66,7 @@ def server(config, eventstream, killsignal):
     thread.start()
     killsignal.subscribe(lambda v: p.shutdown())
     try:
-        (eventstream
-            .filter(lambda e: 'container' in e)
-            .filter(lambda e: e['event'] in ['start', 'stop'])
-            .subscribe(refresh))
+        eventstream.subscribe(update)
     except Exception as exc:
         p.shutdown()
 
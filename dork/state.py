@@ -0,0 +1,139 @@
+"""
+Persistent dork state, shared between dork processes.
+
+Stored in a SQLite database inside [Config.state_directory].
+"""
+import config
+import os
+import sqlite3
+import threading
+
+__connection = None
+__writable = False
+__lock = threading.RLock()
+__hashes = None
+__version = None
+__schema = [
+    'CREATE TABLE IF NOT EXISTS container_hash '
+    '(id TEXT PRIMARY KEY, hash TEXT NOT NULL)',
+]
+
+
+def path(name='state.db'):
+    """:rtype: str"""
+    return os.path.join(config.config.state_directory, name)
+
+
+def connect(name='state.db', schema=__schema):
+    """
+    Open a connection to a database in the state directory, creating it
+    if necessary. Concurrent dork processes are serialized by SQLite's
+    locking, waiting for each other instead of failing.
+
+    :param list[str] schema: Statements creating the databases tables.
+        Without, an existing database is opened for reading only and
+        nothing is written.
+    :rtype: sqlite3.Connection
+    """
+    if schema is None:
+        return sqlite3.connect(path(name), timeout=30, check_same_thread=False)
+    directory = config.config.state_directory
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    connection = sqlite3.connect(
+        path(name), timeout=30, check_same_thread=False)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    for statement in schema:
+        connection.execute(statement)
+    connection.commit()
+    return connection
+
+
+def __db(create=True):
+    """
+    The shared connection. Without [create], None is returned as long as
+    no state has been recorded yet, and the database is not written to,
+    so listing containers doesn't need write access to the state.
+
+    :rtype: sqlite3.Connection
+    """
+    global __connection, __writable
+    if __connection is None or (create and not __writable):
+        if not create and not os.path.exists(path()):
+            return None
+        if __connection is not None:
+            __connection.close()
+            __connection = None
+        __connection = connect() if create else connect(schema=None)
+        __writable = create
+    return __connection
+
+
+def container_hash(cid):
+    """
+    The commit a container was last updated to, if dork recorded one.
+
+    Hashes are kept in memory and only reloaded after another process
+    changed the database. If the state can't be read, there is no
+    recorded hash.
+
+    :rtype: str
+    """
+    global __hashes, __version
+    with __lock:
+        try:
+            db = __db(create=False)
+            if db is None:
+                return None
+            version = db.execute('PRAGMA data_version').fetchone()[0]
+            if __hashes is None or version != __version:
+                __hashes = dict(
+                    db.execute('SELECT id, hash FROM container_hash'))
+                __version = version
+        except (sqlite3.Error, OSError):
+            return None
+        return __hashes.get(cid)
+
+
+def set_container_hash(cid, commit_hash):
+    """
+    Record the commit a container has been updated to.
+    """
+    with __lock:
+        db = __db()
+        with db:
+            db.execute('INSERT OR REPLACE INTO container_hash VALUES (?, ?)',
+                       (cid, commit_hash))
+        if __hashes is not None:
+            __hashes[cid] = commit_hash
+
+
+def forget_container(cid):
+    """
+    Drop everything recorded about a container.
+    """
+    with __lock:
+        if __hashes is not None:
+            __hashes.pop(cid, None)
+        try:
+            db = __db(create=False)
+            if db is None:
+                return
+            with db:
+                db.execute('DELETE FROM container_hash WHERE id = ?', (cid,))
+        except (sqlite3.Error, OSError):
+            # Nothing recorded that could be dropped.
+            pass
+
+
+def close():
+    """
+    Close the state database, it's reopened on the next access.
+    """
+    global __connection, __writable, __hashes, __version
+    with __lock:
+        if __connection is not None:
+            __connection.close()
+        __connection, __hashes, __version = None, None, None
+        __writable = False
@@ -82,6 +82,7 @@ setup(
     extras_require={
         'dev': ['check-manifest'],
         'test': ['mock', 'unittest', 'requests-mock'],
+        'scan': ['scandir'],
     },
 
     # To provide executable scripts, use entry points in preference to the
@@ -0,0 +1,100 @@
+import unittest
+from mock import patch, MagicMock
+import shutil
+import sqlite3
+import tempfile
+from dork.config import config
+from dork.cache import LRUCache, PersistentCache, statistics
+
+
+class TestPersistentCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.patcher = patch.object(config, 'state_directory', self.directory)
+        self.patcher.start()
+        self.cache = PersistentCache('test', capacity=10)
+
+    def tearDown(self):
+        self.cache.close()
+        self.patcher.stop()
+        shutil.rmtree(self.directory)
+
+    def test_values(self):
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.set('a', ['b', 'c'])
+        self.cache.set('d', False)
+        self.assertEqual(['b', 'c'], self.cache.get('a'))
+        self.assertEqual(False, self.cache.get('d'))
+
+    def test_shared(self):
+        self.cache.set('a', True)
+        other = PersistentCache('test')
+        self.assertTrue(other.get('a'))
+        self.assertIsNone(PersistentCache('other').get('a'))
+        other.close()
+
+    @patch.object(PersistentCache, 'check_interval', 1)
+    def test_eviction(self):
+        for i in range(10):
+            self.cache.set(str(i), i)
+        self.cache.get('0')
+        self.cache.set('10', 10)
+        self.assertEqual(0, self.cache.get('0'))
+        self.assertIsNone(self.cache.get('1'))
+        self.assertEqual(10, self.cache.get('10'))
+
+    def test_clear(self):
+        self.cache.set('a', True)
+        self.cache.clear()
+        self.assertIsNone(self.cache.get('a'))
+
+    def test_unavailable(self):
+        self.cache.close()
+        with open(self.directory + '/file', 'w'):
+            pass
+        with patch.object(config, 'state_directory', self.directory + '/file/dork'):
+            self.cache.set('a', True)
+            self.assertIsNone(self.cache.get('a'))
+
+
+    def test_locked(self):
+        self.cache.close()
+        db = MagicMock()
+        db.execute.side_effect = sqlite3.OperationalError('database is locked')
+        db.executemany.side_effect = sqlite3.OperationalError('database is locked')
+        with patch('dork.cache.state.connect', return_value=db):
+            self.cache.set('a', True)
+            self.assertIsNone(self.cache.get('a'))
+            self.cache.evict()
+            self.cache.clear()
+            self.assertEqual(0, self.cache.statistics()[1])
+            self.cache.close()
+
+class TestLRUCache(unittest.TestCase):
+    def test_eviction(self):
+        cache = LRUCache('test', capacity=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(1, cache.get('a'))
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(3, cache.get('c'))
+        self.assertEqual(('test', 2, 2, 3, 1, 1), cache.statistics())
+
+    @patch.object(config, 'memory_cache_capacity')
+    def test_capacity(self, capacity):
+        capacity.return_value = 5
+        self.assertEqual(5, LRUCache('configured').capacity)
+        capacity.assert_called_with('configured', None)
+
+    def test_configured_default(self):
+        with patch.object(config, 'get_value', side_effect=lambda key, default:
+                          7 if key == 'memory_cache_graphs' else default):
+            self.assertEqual(7, LRUCache('graphs', capacity=4).capacity)
+            self.assertEqual(4, LRUCache('other', capacity=4).capacity)
+            self.assertEqual(10000, LRUCache('unset').capacity)
+
+    def test_statistics(self):
+        cache = LRUCache('listed', capacity=1)
+        self.assertIn(('listed', 0, 1, 0, 0, 0), statistics())
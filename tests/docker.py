@@ -1,8 +1,15 @@
 import unittest
-from mock import patch
+from mock import patch, MagicMock
 import requests_mock
 import json
+import os
+import shutil
+import tempfile
+import threading
+import BaseHTTPServer
+import SocketServer
 from dork.docker import *
+import dork.docker
 from config import config
 
 _containers = [{
@@ -50,6 +57,18 @@ _containers = [{
     }
 }]
 
+_events = [{
+    "Type": "container",
+    "Action": "start",
+    "Actor": {"ID": "1", "Attributes": {"name": "test.a.1", "image": "test/1"}},
+    "time": 1433152800,
+}, {
+    "Type": "container",
+    "Action": "die",
+    "Actor": {"ID": "1", "Attributes": {"name": "test.a.1", "image": "test/1"}},
+    "time": 1433152801,
+}]
+
 _images = [{
     "Id": "1",
     "RepoTags": ["test/1"]
@@ -115,7 +134,7 @@ class TestContainer(unittest.TestCase):
         c = containers().next()
         self.assertEqual('1', c.id)
         self.assertEqual('1', c.image)
-        self.assertEqual('test.a.1', c.name)
+        self.assertEqual('/test.a.1', c.name)
         self.assertEqual('test', c.project)
         self.assertEqual('a', c.instance)
         self.assertEqual('1', c.hash)
@@ -189,3 +208,467 @@ class TestImage(unittest.TestCase):
         i = images().next()
         rm.delete('/images/1', status_code=200)
         i.delete()
+
+
+@patch('dork.docker._backend', CliBackend)
+@patch('dork.docker.check_output')
+class TestBatchInspect(unittest.TestCase):
+    def test_containers(self, co):
+        co.side_effect = ['1\n2\n3\n', json.dumps(_containers)]
+        self.assertEqual(3, len(containers(True)))
+        co.assert_called_with(['docker', 'inspect', '--type=container', '1', '2', '3'])
+
+    def test_images(self, co):
+        co.side_effect = ['1\n2\n2\n', json.dumps(_images)]
+        self.assertEqual(2, len(images(True)))
+        co.assert_called_with(['docker', 'inspect', '--type=image', '1', '2'])
+
+    @patch('dork.docker.CliBackend.inspect_batch_size', 2)
+    def test_batches(self, co):
+        co.side_effect = ['1\n2\n3\n', json.dumps(_containers[:2]), json.dumps(_containers[2:])]
+        self.assertEqual(3, len(containers(True)))
+        self.assertEqual(3, co.call_count)
+
+
+class _EngineHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    connections = []
+    exported = ['a' * 100, 'b' * 100, 'c' * 100]
+    imported = []
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.connections.append(self.connection)
+
+    def address_string(self):
+        return 'unix'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.startswith('/events?'):
+            self.send_response(200)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for event in _events:
+                data = json.dumps(event) + '\n'
+                self.wfile.write('%x\r\n%s\r\n' % (len(data), data))
+            self.wfile.write('0\r\n\r\n')
+            return
+        if self.path == '/containers/1/export':
+            self.send_response(200)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for data in self.exported:
+                self.wfile.write('%x\r\n%s\r\n' % (len(data), data))
+            self.wfile.write('0\r\n\r\n')
+            return
+        self.requested.append(self.path)
+        if self.path == '/containers/json?all=1':
+            body = json.dumps([{
+                'Id': '1',
+                'Names': ['/other/a', '/test.a.1'],
+                'ImageID': '1',
+                'Created': 1367931102,
+                'State': 'running',
+                'Labels': None,
+                'Ports': [{'PrivatePort': 80, 'PublicPort': 32768,
+                           'Type': 'tcp', 'IP': '0.0.0.0'},
+                          {'PrivatePort': 22, 'Type': 'tcp'}],
+                'NetworkSettings': {
+                    'Networks': {'bridge': {'IPAddress': '172.17.0.1'}}},
+                'Mounts': [
+                    {'Type': 'bind', 'Source': '/var/source/test/a',
+                     'Destination': '/var/source'},
+                    {'Type': 'volume', 'Name': 'cache', 'Source': '/x',
+                     'Destination': '/var/build'}],
+            }])
+        elif self.path == '/images/json':
+            body = json.dumps([{
+                'Id': 'sha256:1', 'RepoTags': ['test/1:latest'],
+                'Created': 1367931102, 'Labels': {}}, {
+                'Id': 'sha256:2', 'RepoTags': ['<none>:<none>'],
+                'Created': 1367931102, 'Labels': None}])
+        elif self.path == '/containers/1/json':
+            body = json.dumps(_containers[0])
+        else:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path.startswith('/images/create?'):
+            body = ''
+            while True:
+                size = int(self.rfile.readline(), 16)
+                body += self.rfile.read(size)
+                self.rfile.readline()
+                if not size:
+                    break
+            self.imported.append((self.path, body))
+            response = '' if body else \
+                '{"status":"Importing"}\r\n{"error":"archive/tar: invalid tar header"}\r\n'
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+            return
+        self.send_response(204)
+        self.end_headers()
+
+
+class _EngineServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class TestApiBackend(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.socket = os.path.join(self.directory, 'docker.sock')
+        self.server = _EngineServer(self.socket, _EngineHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        _EngineHandler.connections = []
+        _EngineHandler.requested = []
+        self.backend = ApiBackend('unix://' + self.socket)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def test_containers(self):
+        result = [Container(data) for data in self.backend.containers()]
+        self.assertEqual(['/containers/json?all=1'], _EngineHandler.requested)
+        c = result[0]
+        self.assertEqual('/test.a.1', c.name)
+        self.assertTrue(c.running)
+        self.assertEqual('172.17.0.1', c.address)
+        self.assertEqual('/var/source/test/a', c.source)
+        self.assertIsNone(c.build)
+        self.assertEqual('32768', c.hostPort(80))
+        self.assertIsNone(c.hostPort(22))
+        self.assertEqual(7, c.time_created.day)
+
+    def test_times(self):
+        c = Container(self.backend.containers()[0])
+        with patch('dork.docker._backend', return_value=self.backend):
+            c.time_started
+            c.time_started
+        self.assertEqual(['/containers/json?all=1', '/containers/1/json'],
+                         _EngineHandler.requested)
+
+    def test_images(self):
+        result = [Image(data) for data in self.backend.images()]
+        self.assertEqual(['/images/json'], _EngineHandler.requested)
+        self.assertEqual(['test/1', None], [i.name for i in result])
+        self.assertEqual('test', result[0].project)
+        self.assertEqual(7, result[0].time_created.day)
+
+    def test_keep_alive(self):
+        self.backend.containers()
+        self.backend.start('1')
+        self.backend.stop('1')
+        self.assertEqual(1, len(_EngineHandler.connections))
+
+    def test_error(self):
+        self.assertRaises(DockerException, self.backend.remove, '1')
+
+    def test_squash(self):
+        _EngineHandler.imported = []
+        self.backend.import_image(
+            self.backend.export('1'), 'test/2', labels('test', commit_hash='2'))
+        path, body = _EngineHandler.imported[0]
+        self.assertEqual(''.join(_EngineHandler.exported), body)
+        self.assertIn('repo=test%2F2', path)
+        self.assertIn('changes=LABEL+dork.hash%3D%222%22+dork.project%3D%22test%22', path)
+
+    def test_failed_import(self):
+        _EngineHandler.imported = []
+        self.assertRaises(DockerException, self.backend.import_image,
+                          iter([]), 'test/2', {})
+
+    def test_events(self):
+        stream = self.backend.events({'type': ['container']})
+        result = [Event(data) for data in dork.docker._json_lines(stream)]
+        self.assertEqual(['start', 'die'], [e.action for e in result])
+        self.assertEqual(['test.a.1', 'test.a.1'], [e.name for e in result])
+
+
+class TestBackendSelection(unittest.TestCase):
+    def setUp(self):
+        setattr(dork.docker, '__backend', None)
+        self.addCleanup(setattr, dork.docker, '__backend', None)
+
+    @patch.object(config, 'docker_backend', 'api')
+    @patch.object(config, 'docker_address', 'tcp://192.168.99.100:2376')
+    def test_tcp(self):
+        with patch.dict('os.environ', {'DOCKER_TLS_VERIFY': ''}):
+            self.assertIsInstance(dork.docker._backend(), ApiBackend)
+
+    @patch.object(config, 'docker_backend', 'api')
+    @patch.object(config, 'docker_address', 'https://192.168.99.100:2376')
+    def test_https(self):
+        with patch.dict('os.environ', {'DOCKER_TLS_VERIFY': ''}):
+            self.assertIsInstance(dork.docker._backend(), CliBackend)
+
+    @patch.object(config, 'docker_backend', 'api')
+    @patch.object(config, 'docker_address', 'tcp://192.168.99.100:2376')
+    def test_tls(self):
+        with patch.dict('os.environ', {'DOCKER_TLS_VERIFY': '1'}):
+            self.assertIsInstance(dork.docker._backend(), CliBackend)
+
+
+class TestSplitTag(unittest.TestCase):
+    def test_split(self):
+        split = dork.docker._split_tag
+        self.assertEqual(('test/1', 'latest'), split('test/1'))
+        self.assertEqual(('test/1', 'v2'), split('test/1:v2'))
+        self.assertEqual(('registry:5000/test/1', 'latest'),
+                         split('registry:5000/test/1'))
+        self.assertEqual(('registry:5000/test/1', 'v2'),
+                         split('registry:5000/test/1:v2'))
+
+
+class TestTransfer(unittest.TestCase):
+    def test_progress(self):
+        progress = MagicMock()
+        blocks = list(dork.docker._transfer(iter(['ab', 'cde']), progress))
+        self.assertEqual(['ab', 'cde'], blocks)
+        self.assertEqual(5, progress.call_args[0][0])
+
+    @patch('dork.docker.Popen')
+    def test_interrupted_import(self, popen):
+        def blocks():
+            yield 'ab'
+            raise DockerException('Export interrupted.', 0)
+        popen.return_value.wait.return_value = -9
+        self.assertRaises(DockerException, CliBackend().import_image, blocks(), 'test/2', {})
+        popen.return_value.kill.assert_called_with()
+        self.assertFalse(popen.return_value.stdin.close.called)
+
+
+class TestEvent(unittest.TestCase):
+    def test_properties(self):
+        event = Event(_events[0])
+        self.assertEqual('container', event.type)
+        self.assertEqual('start', event.action)
+        self.assertEqual('1', event.id)
+        self.assertEqual('test.a.1', event.name)
+        self.assertEqual('test/1', event.attributes['image'])
+
+    def test_legacy(self):
+        event = Event({'status': 'stop', 'id': '1', 'from': 'test/1'})
+        self.assertEqual('container', event.type)
+        self.assertEqual('stop', event.action)
+        self.assertEqual('1', event.id)
+
+    def test_json_lines(self):
+        lines = dork.docker._json_lines(['{"a": 1}\n{"b"', ': 2}\n', '\n'])
+        self.assertEqual([{'a': 1}, {'b': 2}], list(lines))
+
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.backend = MagicMock()
+        self.backend.containers.return_value = _containers
+        self.backend.images.return_value = _images
+        patcher = patch('dork.docker._backend', return_value=self.backend)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        containers(True)
+        images(True)
+
+    def test_start(self):
+        started = dict(_containers[1], State={'Running': True})
+        self.backend.inspect_container.return_value = started
+        Container(_containers[1]).start()
+        self.assertTrue([c for c in containers() if c.id == '2'][0].running)
+        self.assertEqual(1, self.backend.containers.call_count)
+
+    def test_remove(self):
+        self.backend.inspect_container.return_value = None
+        Container(_containers[0]).remove()
+        self.assertEqual(['2', '3'], [c.id for c in containers()])
+        self.assertEqual(1, self.backend.containers.call_count)
+
+    def test_commit(self):
+        self.backend.inspect_image.side_effect = [
+            {"Id": "3", "RepoTags": ["test/1"]},
+            {"Id": "1", "RepoTags": []},
+        ]
+        Container(_containers[0]).commit('test/1')
+        self.assertEqual(['2', '3'], [i.id for i in images()])
+        self.assertEqual(1, self.backend.images.call_count)
+
+    def test_event(self):
+        self.backend.inspect_container.return_value = None
+        dork.docker._apply_event(Event({
+            'Type': 'container', 'Action': 'destroy', 'Actor': {'ID': '3'}}))
+        self.assertEqual(['1', '2'], [c.id for c in containers()])
+
+    def test_event_object(self):
+        enrich = getattr(dork.docker, '__event_object')
+        event = enrich(Event({
+            'Type': 'container', 'Action': 'exec_start: ls', 'Actor': {'ID': '2'}}))
+        self.assertEqual('2', event.container.id)
+        self.assertFalse(self.backend.inspect_container.called)
+        self.assertEqual(1, self.backend.containers.call_count)
+
+    def test_event_object_miss(self):
+        self.backend.inspect_container.return_value = dict(_containers[0], Id='4')
+        enrich = getattr(dork.docker, '__event_object')
+        event = enrich(Event({
+            'Type': 'container', 'Action': 'start', 'Actor': {'ID': '4'}}))
+        self.assertEqual('4', event.container.id)
+        self.backend.inspect_container.assert_called_once_with('4')
+        self.assertEqual(1, self.backend.containers.call_count)
+
+
+class TestRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = Registry(Container(c) for c in _containers)
+
+    def test_indexes(self):
+        self.assertEqual(['1', '3'], [c.id for c in self.registry.instance('test', 'a')])
+        self.assertEqual(['1', '2', '3'], [c.id for c in self.registry.project('test')])
+        self.assertEqual(['2'], [c.id for c in self.registry.hash('2')])
+        self.assertEqual([], self.registry.project('other'))
+        self.assertEqual('2', self.registry.get('2').id)
+        self.assertEqual('1', self.registry.find('test.a.1').id)
+
+    def test_replace(self):
+        version = self.registry.version
+        self.registry.add(Container(dict(_containers[0], Name='test.c.4')))
+        self.assertEqual(['3'], [c.id for c in self.registry.instance('test', 'a')])
+        self.assertEqual(['1'], [c.id for c in self.registry.instance('test', 'c')])
+        self.assertEqual([], self.registry.hash('1'))
+        self.assertGreater(self.registry.version, version)
+
+    def test_remove(self):
+        self.registry.remove('3')
+        self.assertEqual(['1'], [c.id for c in self.registry.instance('test', 'a')])
+        self.assertEqual(2, len(self.registry))
+
+    def test_images(self):
+        registry = Registry(Image(i) for i in _images)
+        self.assertEqual(['1', '2'], [i.id for i in registry.project('test')])
+        self.assertEqual(['2'], [i.id for i in registry.hash('2')])
+
+    def test_foreign_names(self):
+        container = Container(dict(_containers[0], Name='/elasticsearch'))
+        self.assertEqual('elasticsearch', container.project)
+        self.assertIsNone(container.instance)
+        self.assertIsNone(container.hash)
+
+
+class TestRecord(unittest.TestCase):
+    def test_container(self):
+        c = Container(dict(_containers[0], NetworkSettings={
+            'IPAddress': '172.17.0.1',
+            'Ports': {'80/tcp': [{'HostIp': '0.0.0.0', 'HostPort': '32768'}]},
+        }))
+        self.assertEqual('/var/source/test/a', c.source)
+        self.assertEqual('/var/build/test/a', c.build)
+        self.assertIsNone(c.logs)
+        self.assertEqual('172.17.0.1', c.address)
+        self.assertEqual('32768', c.hostPort(80))
+        self.assertIsNone(c.hostPort(22))
+        self.assertEqual(7, c.time_created.day)
+        self.assertFalse(hasattr(c, '__dict__'))
+
+    def test_times(self):
+        c = Container(dict(_containers[1], State={
+            'Running': False,
+            'StartedAt': '2015-06-01T10:00:00.123456789Z',
+            'FinishedAt': '2015-06-01T11:00:00Z',
+        }))
+        self.assertIsNone(c.time_started)
+        self.assertEqual(11, c.time_stopped.hour)
+        self.assertEqual(parse_date('2015-06-01T11:00:00Z'), c.time_stopped)
+
+    def test_image(self):
+        i = Image({'Id': '1', 'RepoTags': ['test/1:latest'],
+                   'Created': '2015-05-07T14:51:42.041847+02:00'})
+        self.assertEqual('test/1', i.name)
+        self.assertEqual('test', i.project)
+        self.assertEqual('1', i.hash)
+        self.assertEqual(7, i.time_created.day)
+        self.assertFalse(hasattr(i, '__dict__'))
+
+
+class TestLabels(unittest.TestCase):
+    def test_container(self):
+        c = Container(dict(_containers[0], Name='/renamed', Config={
+            'Labels': labels('test', 'a', '1')}))
+        self.assertTrue(c.labelled)
+        self.assertEqual('test', c.project)
+        self.assertEqual('a', c.instance)
+        self.assertEqual('1', c.hash)
+
+    def test_image(self):
+        i = Image({'Id': '1', 'RepoTags': ['other/2:latest'],
+                   'Config': {'Labels': labels('test', commit_hash='1')}})
+        self.assertTrue(i.labelled)
+        self.assertEqual('test', i.project)
+        self.assertEqual('1', i.hash)
+
+    def test_legacy(self):
+        c = Container(_containers[0])
+        self.assertFalse(c.labelled)
+        self.assertEqual('test', c.project)
+
+    @patch('dork.docker._backend', CliBackend)
+    @patch('dork.docker.check_output')
+    def test_project_registry(self, co):
+        co.side_effect = ['1\n', '1\n2\n', json.dumps(_containers[:2])]
+        registry = container_registry(True, 'test')
+        self.assertEqual(2, len(registry))
+        co.assert_any_call(['docker', 'ps', '-aq', '--filter', 'label=dork.project=test'])
+        co.assert_any_call(['docker', 'ps', '-aq', '--filter', 'name=^/test\\.'])
+        co.assert_called_with(['docker', 'inspect', '--type=container', '1', '2'])
+        # The project is loaded only once.
+        container_registry(project='test')
+        self.assertEqual(3, co.call_count)
+
+    @patch('dork.docker._backend', CliBackend)
+    @patch('dork.docker.check_output')
+    @patch.object(config, 'docker_name_fallback', 'no')
+    def test_no_fallback(self, co):
+        co.return_value = ''
+        image_registry(True, 'test')
+        co.assert_called_once_with(['docker', 'images', '-q', '--filter', 'label=dork.project=test'])
+
+    @patch('dork.docker._backend', CliBackend)
+    @patch('dork.docker.check_output')
+    def test_create(self, co):
+        co.return_value = '[]'
+        create('test.a.1', 'test/1', {}, 'a.test.dork', labels('test', 'a', '1'))
+        self.assertEqual(
+            ['docker', 'create', '--name=test.a.1', '-h', 'a.test.dork', '-P',
+             '--label', 'dork.hash=1', '--label', 'dork.instance=a',
+             '--label', 'dork.project=test', 'test/1'],
+            co.call_args_list[0][0][0][:13])
+
+    @patch('dork.docker.state.container_hash')
+    def test_tracked_hash(self, container_hash):
+        container_hash.return_value = '2'
+        c = Container(dict(_containers[0], Config={
+            'Labels': labels('test', 'a', '1')}))
+        self.assertEqual('2', c.hash)
+        container_hash.assert_called_with('1')
+
+    @patch('dork.docker._backend', CliBackend)
+    @patch('dork.docker.check_output')
+    def test_commit(self, co):
+        co.return_value = '[]'
+        dork.docker._container_commit('1', 'test/1', labels('test', commit_hash='1'))
+        co.assert_any_call(['docker', 'commit', '--change',
+                            'LABEL dork.hash="1" dork.project="test"', '1', 'test/1'])
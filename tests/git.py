@@ -1,6 +1,26 @@
-from dork.git import get_repositories, Commit, Repository
+from dork.git import get_repositories, Commit, CommitGraph, Repository
+from dork.config import config
 from mock import patch
+import dork.git
+import os
+import shutil
+import subprocess
+import tempfile
 import unittest
+from io import BytesIO
+
+
+def setUpModule():
+    global _state, _patcher
+    _state = tempfile.mkdtemp()
+    _patcher = patch.object(config, 'state_directory', _state)
+    _patcher.start()
+
+
+def tearDownModule():
+    getattr(dork.git, '__persistent').close()
+    _patcher.stop()
+    shutil.rmtree(_state)
 
 
 class TestRepositoryScan(unittest.TestCase):
@@ -79,6 +99,495 @@ class TestCommit(unittest.TestCase):
         self.assertEqual(self.commit_a - self.commit_d, ['2'])
         self.assertEqual(self.commit_a - self.commit_c, [])
 
-    @patch('dork.git.check_output', side_effect=['a\nb\nc\n'])
-    def test_diff_files(self, *args):
+    @patch('dork.git.Popen')
+    def test_diff_files(self, popen):
+        popen.return_value.stdout = BytesIO('a\0b\0c\0')
+        popen.return_value.wait.return_value = 0
+        popen.return_value.returncode = 0
         self.assertEqual(self.commit_a % self.commit_b, ['a', 'b', 'c'])
+
+
+class TestCommitGraph(unittest.TestCase):
+    # 5 merges 3 and 4, which both branch off 2.
+    def setUp(self):
+        self.graph = CommitGraph(['5 3 4', '4 2', '3 2', '2 1', '1'])
+
+    def test_generations(self):
+        self.assertEqual(1, self.graph.generation('1'))
+        self.assertEqual(3, self.graph.generation('4'))
+        self.assertEqual(4, self.graph.generation('5'))
+
+    def test_ancestors(self):
+        self.assertTrue(self.graph.is_ancestor('1', '5'))
+        self.assertTrue(self.graph.is_ancestor('4', '5'))
+        self.assertFalse(self.graph.is_ancestor('3', '4'))
+        self.assertFalse(self.graph.is_ancestor('5', '1'))
+
+    @patch('dork.git.call')
+    @patch('dork.git.check_output', side_effect=['2 1\n1\n'])
+    def test_commit(self, co, call):
+        repository = Repository('/var/source/graph')
+        self.assertTrue(Commit('1', repository) < Commit('2', repository))
+        self.assertFalse(Commit('2', repository) < Commit('1', repository))
+        self.assertEqual(1, co.call_count)
+        self.assertFalse(call.called)
+
+    @patch('dork.git.call', side_effect=[0])
+    @patch('dork.git.check_output', side_effect=['2 1\n1\n'])
+    def test_unknown_commit(self, co, call):
+        repository = Repository('/var/source/unknown')
+        self.assertTrue(Commit('1', repository) < Commit('3', repository))
+        self.assertTrue(call.called)
+
+
+class TestPersistentCache(unittest.TestCase):
+    @patch('dork.git.Popen')
+    @patch('dork.git.check_output', side_effect=['2 1\n1\n'])
+    def test_restart(self, co, popen):
+        popen.return_value.stdout = BytesIO('a\0b\0')
+        popen.return_value.returncode = 0
+        repository = Repository('/var/source/persistent')
+        self.assertTrue(Commit('1', repository) < Commit('2', repository))
+        self.assertEqual(['a', 'b'], Commit('1', repository) % Commit('2', repository))
+        # A new process only has the persistent cache.
+        getattr(dork.git, '__ancestors').clear()
+        getattr(dork.git, '__file_diffs').clear()
+        getattr(dork.git, '__commit_graphs').clear()
+        self.assertTrue(Commit('1', repository) < Commit('2', repository))
+        self.assertEqual(['a', 'b'], Commit('1', repository) % Commit('2', repository))
+        self.assertEqual(1, co.call_count)
+        self.assertEqual(1, popen.call_count)
+
+    @patch('dork.git._commit_graph', return_value=None)
+    @patch('dork.git.call', side_effect=[128, 0])
+    def test_unknown_commit(self, call, graph):
+        repository = Repository('/var/source/unknown')
+        # The descendant hasn't been fetched yet.
+        self.assertFalse(Commit('1', repository) < Commit('2', repository))
+        getattr(dork.git, '__ancestors').clear()
+        self.assertTrue(Commit('1', repository) < Commit('2', repository))
+        getattr(dork.git, '__ancestors').clear()
+        self.assertTrue(Commit('1', repository) < Commit('2', repository))
+        self.assertEqual(2, call.call_count)
+
+
+class TestHead(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.git = self.directory + '/.git'
+        os.makedirs(self.git + '/refs/heads')
+        self.write('HEAD', 'ref: refs/heads/master\n')
+        self.write('refs/heads/master', 'a' * 40 + '\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, content):
+        with open(self.git + '/' + name, 'w') as f:
+            f.write(content)
+        # Make sure the change is visible, even on coarse timestamps.
+        stat = os.stat(self.git + '/' + name)
+        os.utime(self.git + '/' + name, (stat.st_atime, stat.st_mtime + 1))
+
+    @patch('dork.git.check_output')
+    def test_branch(self, co):
+        repository = Repository(self.directory)
+        self.assertEqual('master', repository.branch)
+        self.assertEqual('a' * 40, repository.current_commit.hash)
+        self.assertFalse(co.called)
+
+    @patch('dork.git.check_output')
+    def test_changed(self, co):
+        repository = Repository(self.directory)
+        self.assertEqual('master', repository.branch)
+        self.write('HEAD', 'ref: refs/heads/feature\n')
+        self.write('packed-refs', '# pack-refs with: peeled\n%s refs/heads/feature\n' % ('b' * 40))
+        self.assertEqual('feature', repository.branch)
+        self.assertEqual('b' * 40, Repository(self.directory).current_commit.hash)
+        self.write('HEAD', 'c' * 40 + '\n')
+        self.assertEqual('HEAD', repository.branch)
+        self.assertFalse(co.called)
+
+    @patch('dork.git.check_output', side_effect=['master\n'])
+    def test_worktree(self, co):
+        shutil.rmtree(self.git)
+        with open(self.git, 'w') as f:
+            f.write('gitdir: /elsewhere\n')
+        self.assertEqual('master', Repository(self.directory).branch)
+        self.assertTrue(co.called)
+
+
+class TestScan(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for path in ['a', 'a/nested', 'b/c', 'node_modules/x', '.hidden/y']:
+            os.makedirs(self.directory + '/' + path + '/.git')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def scan(self):
+        return [r.directory[len(self.directory) + 1:]
+                for r in get_repositories(self.directory)]
+
+    def test_scan(self):
+        self.assertEqual(['a', 'b/c'], self.scan())
+
+    def test_index(self):
+        self.scan()
+        with patch('dork.git._list_directory') as list_directory:
+            self.assertEqual(['a', 'b/c'], self.scan())
+            self.assertFalse(list_directory.called)
+        os.makedirs(self.directory + '/b/d/.git')
+        self.assertEqual(['a', 'b/c', 'b/d'], self.scan())
+
+    @patch.object(config, 'scan_depth', 1)
+    def test_depth(self):
+        self.assertEqual(['a'], self.scan())
+
+    @patch('dork.git.scandir', None)
+    def test_listdir(self):
+        self.assertEqual(['a', 'b/c'], self.scan())
+
+
+class TestObjectReader(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.repositories = []
+        for name in ['a', 'b']:
+            path = self.directory + '/' + name
+            for cmd in [['git', 'init', '-q', path],
+                        ['git', '-c', 'user.name=Dork', '-c', 'user.email=dork@example.com',
+                         'commit', '-q', '--allow-empty', '-m', 'Commit in ' + name],
+                        ['git', '-c', 'user.name=Dork', '-c', 'user.email=dork@example.com',
+                         'commit', '-q', '--allow-empty', '-m', 'Second in ' + name]]:
+                subprocess.check_call(cmd, cwd=self.directory if cmd[1] == 'init' else path)
+            self.repositories.append(Repository(path))
+
+    def tearDown(self):
+        dork.git._objects.close()
+        shutil.rmtree(self.directory)
+
+    def test_read(self):
+        with patch('dork.git.Popen', wraps=dork.git.Popen) as popen, \
+                patch('dork.git.check_output', wraps=dork.git.check_output) as co:
+            for repository in self.repositories:
+                commit = repository.current_commit
+                self.assertTrue(commit.message.startswith('Second in'))
+                parent = commit.parents[0]
+                self.assertTrue(parent.message.startswith('Commit in'))
+                self.assertEqual([], parent.parents)
+                self.assertEqual(40, len(parent.tree))
+            # Restarted once, to add the second repository.
+            self.assertEqual(2, popen.call_count)
+            for repository in self.repositories:
+                self.assertEqual(1, len(repository.current_commit.parents))
+            self.assertEqual(2, popen.call_count)
+            self.assertFalse(co.called)
+
+    def test_no_directory(self):
+        self.assertIsNone(Repository(None).directory)
+        self.assertIsNone(dork.git._objects.read(None, 'a' * 40))
+
+
+class TestClosest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        subprocess.check_call(['git', 'init', '-q', self.directory])
+        self.hashes = []
+        for i in range(3):
+            subprocess.check_call(
+                ['git', '-c', 'user.name=Dork', '-c', 'user.email=dork@example.com',
+                 'commit', '-q', '--allow-empty', '-m', str(i)], cwd=self.directory)
+            self.hashes.append(subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'], cwd=self.directory).strip())
+        self.repository = Repository(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_closest(self):
+        self.assertEqual(self.hashes[1], self.repository.closest(self.hashes[:2]).hash)
+        self.assertEqual(self.hashes[0], self.repository.closest(self.hashes[:1] + ['x']).hash)
+        self.assertEqual(self.hashes[2], self.repository.closest(self.hashes).hash)
+
+    def commit(self, date, *parents):
+        env = dict(os.environ, GIT_AUTHOR_DATE=date, GIT_COMMITTER_DATE=date,
+                   GIT_AUTHOR_NAME='Dork', GIT_AUTHOR_EMAIL='dork@example.com',
+                   GIT_COMMITTER_NAME='Dork', GIT_COMMITTER_EMAIL='dork@example.com')
+        tree = subprocess.check_output(
+            ['git', 'write-tree'], cwd=self.directory).strip()
+        cmd = ['git', 'commit-tree', tree, '-m', date]
+        for parent in parents:
+            cmd += ['-p', parent]
+        return subprocess.check_output(cmd, cwd=self.directory, env=env).strip()
+
+    def test_skewed_dates(self):
+        # The closer candidate is older than its own parent, so it is
+        # listed after it.
+        first = self.commit('2020-01-01T00:00:00', self.hashes[2])
+        second = self.commit('1990-01-01T00:00:00', first)
+        other = self.commit('2020-06-01T00:00:00', first)
+        merge = self.commit('2021-01-01T00:00:00', other, second)
+        subprocess.check_call(['git', 'reset', '-q', '--hard', merge],
+                              cwd=self.directory)
+        repository = Repository(self.directory)
+        self.assertEqual(second, repository.closest([first, second]).hash)
+
+    def test_cached(self):
+        self.assertEqual(self.hashes[1], self.repository.closest(self.hashes[:2]).hash)
+        self.assertIsNone(self.repository.closest(['x']))
+        with patch('dork.git.Popen') as popen:
+            self.assertEqual(self.hashes[1], self.repository.closest(self.hashes[:2]).hash)
+            self.assertIsNone(self.repository.closest(['x']))
+            self.assertFalse(popen.called)
+
+    @patch('dork.git.Popen')
+    def test_none(self, popen):
+        self.assertIsNone(self.repository.closest([]))
+        self.assertFalse(popen.called)
+
+
+class TestChanges(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        subprocess.check_call(['git', 'init', '-q', self.directory])
+        self.commit('first', {'a.txt': 'a', 'old.txt': 'x' * 100})
+        self.first = Repository(self.directory).current_commit
+        os.rename(self.directory + '/old.txt', self.directory + '/new.txt')
+        self.commit('second', {'with\nnewline.txt': 'b', 'b.txt': 'b', 'a.txt': 'c'})
+        self.second = Repository(self.directory).current_commit
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def commit(self, message, files):
+        for name, content in files.items():
+            with open(os.path.join(self.directory, name), 'w') as f:
+                f.write(content)
+        subprocess.check_call(['git', 'add', '-A'], cwd=self.directory)
+        subprocess.check_call(
+            ['git', '-c', 'user.name=Dork', '-c', 'user.email=dork@example.com',
+             'commit', '-q', '-m', message], cwd=self.directory)
+
+    def test_paths(self):
+        changes = list(self.first.changes(self.second))
+        for path in ['a.txt', 'b.txt', 'new.txt', 'with\nnewline.txt']:
+            self.assertIn(path, changes)
+
+    def test_limit(self):
+        self.assertEqual(2, len(list(self.first.changes(self.second, limit=2))))
+
+    def test_binary_path(self):
+        self.commit('third', {'b\xff': 'b', 'caf\xc3\xa9': 'c'})
+        third = Repository(self.directory).current_commit
+        self.assertItemsEqual(['b\xff', 'caf\xc3\xa9'], self.second % third)
+        # A new process reads the same paths from the persistent cache.
+        getattr(dork.git, '__file_diffs').clear()
+        with patch('dork.git.Popen') as popen:
+            changes = self.second % third
+            self.assertFalse(popen.called)
+        self.assertItemsEqual(['b\xff', 'caf\xc3\xa9'], changes)
+        self.assertTrue(all(type(path) is str for path in changes))
+
+    def test_status(self):
+        changes = list(self.first.changes(self.second, status=True))
+        self.assertIn(('M', 'a.txt', None), changes)
+        self.assertIn(('R', 'new.txt', 'old.txt'), changes)
+
+    @patch('dork.git.Popen')
+    def test_early_stop(self, popen):
+        popen.return_value.stdout = BytesIO('a.txt\0b.txt\0c.txt\0')
+        popen.return_value.poll.return_value = None
+        repository = Repository('/var/source/stop')
+        changes = Commit('x', repository).changes(Commit('y', repository))
+        self.assertEqual('a.txt', next(changes))
+        changes.close()
+        popen.return_value.kill.assert_called_with()
+
+
+class TestTrackedFiles(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        subprocess.check_call(['git', 'init', '-q', self.directory])
+        self.write('composer.json', '{"require": {"drupal/core": "8"}}')
+        self.write('src/Module/module.info', 'core = 8.x')
+        self.write('.hidden/file.txt', 'hidden')
+        subprocess.check_call(['git', 'add', '-A'], cwd=self.directory)
+        subprocess.check_call(
+            ['git', '-c', 'user.name=Dork', '-c', 'user.email=dork@example.com',
+             'commit', '-q', '-m', 'initial'], cwd=self.directory)
+        self.write('vendor/autoload.php', '<?php')
+        self.repository = Repository(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, content):
+        path = os.path.join(self.directory, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def contains(self, pattern, content=None):
+        with patch.object(config, 'trigger_files', 'tracked'):
+            return self.repository.contains_file(pattern, content)
+
+    def test_paths(self):
+        self.assertTrue(self.contains('composer.json'))
+        self.assertTrue(self.contains('source:/src/Module'))
+        self.assertFalse(self.contains('vendor/autoload.php'))
+
+    def test_glob(self):
+        self.assertTrue(self.contains('*.json'))
+        self.assertTrue(self.contains('src/*/*.info'))
+        self.assertTrue(self.contains('**/*.info'))
+        self.assertFalse(self.contains('*.info'))
+        self.assertFalse(self.contains('vendor/*'))
+        self.assertFalse(self.contains('*/file.txt'))
+
+    def test_content(self):
+        self.assertTrue(self.contains('composer.json', 'drupal/core'))
+        self.assertTrue(self.contains('**/*.info', 'core = 8'))
+        self.assertFalse(self.contains('composer.json', 'symfony'))
+
+    def test_read_once(self):
+        self.contains('composer.json')
+        with patch('dork.git.check_output') as co:
+            self.contains('*.json')
+            self.assertFalse(co.called)
+
+    def test_glob_regex(self):
+        regex = getattr(dork.git, '_glob_regex')
+        self.assertTrue(regex('a/[!b]c').match('a/xc'))
+        self.assertFalse(regex('a/[!b]c').match('a/bc'))
+        self.assertTrue(regex('a/**').match('a/b/c'))
+        self.assertTrue(regex('**/c').match('c'))
+        self.assertFalse(regex('a?c').match('a/c'))
+
+
+class TestFileIndex(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        subprocess.check_call(['git', 'init', '-q', self.directory])
+        for name in ['index.php', 'sites/all/modules/a/a.info', '.htaccess']:
+            path = os.path.join(self.directory, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write('core = 7.x\n')
+        self.repository = Repository(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_find_files(self):
+        found = self.repository.find_files(
+            ['index.php', 'sites/all', '**/*.info', '*.txt', '*', '.git/HEAD'])
+        self.assertEqual(['index.php'], found['index.php'])
+        self.assertEqual(['sites/all'], found['sites/all'])
+        self.assertEqual(['sites/all/modules/a/a.info'], found['**/*.info'])
+        self.assertEqual([], found['*.txt'])
+        self.assertItemsEqual(['index.php', 'sites'], found['*'])
+        self.assertEqual([], found['.git/HEAD'])
+
+    def test_relative(self):
+        found = self.repository.find_files(['./index.php', './**/*.info'])
+        self.assertEqual(['index.php'], found['./index.php'])
+        self.assertEqual(['sites/all/modules/a/a.info'], found['./**/*.info'])
+        self.assertTrue(self.repository.contains_file('source:/./index.php'))
+
+    def test_no_patterns(self):
+        with patch('dork.git._file_index') as index:
+            self.assertEqual({}, self.repository.find_files([]))
+            self.assertFalse(self.repository.contains_file('data:/missing'))
+            self.assertFalse(index.called)
+
+    def test_contains_file(self):
+        self.assertTrue(self.repository.contains_file('source:/index.php'))
+        self.assertTrue(self.repository.contains_file('**/*.info', 'core\s*=\s*7'))
+        self.assertFalse(self.repository.contains_file('**/*.info', 'core\s*=\s*8'))
+        self.assertFalse(self.repository.contains_file('sites', 'core'))
+
+    def test_one_walk(self):
+        self.repository.find_files(['index.php'])
+        with patch('dork.git._list_directory') as listing:
+            self.repository.find_files(['*.php', '**/*.info'])
+            self.assertFalse(listing.called)
+
+    def test_symlink_loop(self):
+        os.symlink('..', os.path.join(self.directory, 'sites/all/loop'))
+        walk = getattr(dork.git, '_walk_files')
+        for listing in [dork.git.scandir, None]:
+            with patch('dork.git.scandir', listing):
+                files, directories = walk(self.directory)
+            self.assertIn('sites/all/loop', files)
+            self.assertEqual(set(['sites', 'sites/all', 'sites/all/modules',
+                                  'sites/all/modules/a']), directories)
+
+
+class TestContentSearch(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def file_contains(self, path, pattern):
+        return getattr(dork.git, '_files_contain')([path], pattern)
+
+    def test_match(self):
+        path = self.write('a.info', 'name = A\ncore = 7.x\n')
+        self.assertTrue(self.file_contains(path, 'core\s*=\s*7'))
+        self.assertFalse(self.file_contains(path, 'core\s*=\s*8'))
+        self.assertFalse(self.file_contains(self.directory, 'core'))
+        self.assertFalse(self.file_contains(path + '.missing', 'core'))
+
+    def test_large(self):
+        path = self.write('dump.sql', 'INSERT INTO x;\n' * 100000 + 'DROP TABLE y;\n')
+        self.assertTrue(self.file_contains(path, 'DROP TABLE'))
+
+    def test_binary(self):
+        path = self.write('image.png', '\x89PNG\0\0core = 7.x')
+        self.assertFalse(self.file_contains(path, 'core'))
+
+    @patch('dork.git.mmap.mmap', side_effect=ValueError)
+    @patch('dork.git._chunk_size', 16)
+    @patch('dork.git._chunk_overlap', 8)
+    def test_chunks(self, mapped):
+        path = self.write('chunks.txt', 'x' * 8010 + 'needle' + 'x' * 100)
+        self.assertTrue(self.file_contains(path, 'needle'))
+        self.assertTrue(mapped.called)
+
+    def test_cached(self):
+        path = self.write('a.txt', 'first')
+        self.assertTrue(self.file_contains(path, 'first'))
+        with patch('dork.git._search_file') as search:
+            self.assertTrue(self.file_contains(path, 'first'))
+            self.assertFalse(search.called)
+        os.utime(path, (0, 0))
+        self.write('a.txt', 'second')
+        os.utime(path, (1, 1))
+        self.assertFalse(self.file_contains(path, 'first'))
+
+    def test_one_entry(self):
+        paths = [self.write('%d.php' % i, '<?php') for i in range(50)]
+        files_contain = getattr(dork.git, '_files_contain')
+        cache = getattr(dork.git, '__content_matches')
+        with patch.object(cache, 'set', wraps=cache.set) as cached:
+            self.assertFalse(files_contain(paths, 'drupal'))
+            self.assertEqual(1, cached.call_count)
+        with patch('dork.git._search_file') as search:
+            self.assertFalse(files_contain(list(reversed(paths)), 'drupal'))
+            self.assertFalse(search.called)
+        os.remove(paths[0])
+        with patch('dork.git._search_file', return_value=False) as search:
+            self.assertFalse(files_contain(paths, 'drupal'))
+            self.assertEqual(49, search.call_count)
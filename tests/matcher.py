@@ -1,52 +1,29 @@
 import unittest
 import mock
-from dork.matcher import get_roles_metadata, Role
-from io import BytesIO
+from fnmatch import fnmatch
+from dork.matcher import PatternMatcher, Role, \
+    RoleCycleException, RoleFactory, TagMatcher
 import re
 import dork.config as config
-import dork.git
+import dork.matcher
+import os
+import shutil
+import tempfile
 import yaml
 
-_meta = dict()
-
-_meta['nodorkrole'] = """
-dependencies: []
-"""
-
-_meta['dorkrole'] = """
-dependencies: []
-dork: {}
-"""
-
-
-def mock_is_file(path):
-    for name in _meta.keys():
-        p = "/etc/ansible/roles/%s/meta/main.yml" % name
-        if path == p:
-            return True
-    return False
 
+def setUpModule():
+    global _state, _patcher
+    _state = tempfile.mkdtemp()
+    _patcher = mock.patch.object(config.config, 'state_directory', _state)
+    _patcher.start()
 
-def mock_open(path, *args):
-    expr = re.compile('/etc/ansible/roles/(.+?)/meta/main.yml')
-    found = expr.findall(path)
-    return BytesIO(_meta[found[0]])
 
+def tearDownModule():
+    getattr(dork.matcher, '__compiled').close()
+    _patcher.stop()
+    shutil.rmtree(_state)
 
-@mock.patch('dork.matcher.config.config', side_effect=[config.Config()])
-@mock.patch('dork.matcher.os.path.isfile', mock_is_file)
-@mock.patch('__builtin__.open', side_effect=mock_open)
-class TestRoleScan(unittest.TestCase):
-
-    @mock.patch('dork.matcher.os.listdir', side_effect=[[
-        '.hidden',
-        'nometafile',
-        'nodorkrole',
-        'dorkrole',
-    ]])
-    def test_get_roles(self, *args):
-        roles = [role for role in get_roles_metadata()]
-        self.assertEqual(len(roles), 1)
 
 _roles_simple = yaml.load("""
 dependencies:
@@ -81,74 +58,302 @@ dork:
 """)
 
 
-
 class TestRole(unittest.TestCase):
+    def repository(self, files):
+        """
+        A repository containing [files], a dict of paths and contents.
+        """
+        repo = mock.Mock()
+        repo.find_files.side_effect = lambda patterns: dict(
+            (p, [f for f in files if fnmatch(f, p)]) for p in patterns)
+        repo.search_files.side_effect = lambda paths, cp=None: any(
+            re.search(cp, files[f]) if cp else True for f in paths)
+        return repo
+
+    def role(self, meta, files=None):
+        return Role('test', yaml.load(yaml.dump(meta)),
+                    self.repository(files or {}))
+
     def test_includes(self):
-        role = Role(_roles_simple)
+        role = self.role(_roles_simple)
         self.assertItemsEqual(role.dependencies, ['dep_a', 'dep_b'])
 
-    @mock.patch('dork.matcher.os.path.exists', side_effect=[True])
-    def test_match_default(self, m):
-        role = Role(_roles_simple)
-        repo = dork.git.Repository('/var/source/test')
-        self.assertEqual(['default'], role.matching_pattern(repo))
-
-    @mock.patch('dork.matcher.os.path.exists', side_effect=[False])
-    def test_match_none(self, m):
-        role = Role(_roles_simple)
-        repo = dork.git.Repository('/var/source/test')
-        self.assertItemsEqual([], role.matching_pattern(repo))
-
-    @mock.patch('dork.matcher.os.path.exists', side_effect=[True, False])
-    @mock.patch('dork.matcher.glob', side_effect=[[], ['foo']])
-    def test_match_complex_none(self, *args):
-        role = Role(_roles_complex)
-        repo = dork.git.Repository('/var/source/test')
-        self.assertItemsEqual([], role.matching_pattern(repo))
-
-    @mock.patch('dork.matcher.os.path.exists', side_effect=[True, True])
-    @mock.patch('dork.matcher.glob', side_effect=[['foo'], []])
-    def test_match_complex_match_first(self, *args):
-        role = Role(_roles_complex)
-        repo = dork.git.Repository('/var/source/test')
-        self.assertItemsEqual(['pattern_a'], role.matching_pattern(repo))
-
-    @mock.patch('dork.matcher.os.path.exists', side_effect=[False, True])
-    @mock.patch('dork.matcher.glob', side_effect=[['foo'], ['bar']])
-    def test_match_complex_match_second(self, *args):
-        role = Role(_roles_complex)
-        repo = dork.git.Repository('/var/source/test')
-        self.assertEqual(['pattern_b'], role.matching_pattern(repo))
-
-    @mock.patch('dork.matcher.os.path.exists', side_effect=[True, True])
-    @mock.patch('dork.matcher.glob', side_effect=[['foo'], ['bar']])
-    def test_match_complex_match_both(self, *args):
-        role = Role(_roles_complex)
-        repo = dork.git.Repository('/var/source/test')
-        self.assertItemsEqual(['pattern_a', 'pattern_b'], role.matching_pattern(repo))
-
-    def test_tag_matches(self):
-        role = Role(_roles_complex)
+    def test_match_default(self):
+        role = self.role(_roles_simple, {'index.php': ''})
+        self.assertEqual(['default'], role.matched_triggers)
+
+    def test_match_none(self):
+        role = self.role(_roles_simple)
+        self.assertItemsEqual([], role.matched_triggers)
+
+    def test_match_complex_none(self):
+        role = self.role(_roles_complex, {'index.php': ''})
+        self.assertItemsEqual([], role.matched_triggers)
+
+    def test_match_complex_match_first(self):
+        role = self.role(_roles_complex, {'index.php': '', 'test.php': ''})
+        self.assertItemsEqual(['pattern_a'], role.matched_triggers)
+
+    def test_match_complex_match_second(self):
+        role = self.role(_roles_complex, {'index.php': '', 'foo.txt': '',
+                                          'bar.php': ''})
+        self.assertItemsEqual(['pattern_b'], role.matched_triggers)
+
+    def test_match_complex_match_both(self):
+        role = self.role(_roles_complex, {'index.php': '', 'test.php': '',
+                                          'foo.txt': ''})
+        self.assertItemsEqual(['pattern_a', 'pattern_b'], role.matched_triggers)
+
+    @mock.patch.object(RoleFactory, 'graph')
+    def test_tag_matches(self, graph):
+        graph.dependencies.return_value = []
+        role = self.role(_roles_complex)
         self.assertItemsEqual(['a', 'b', 'c'], role.update_triggers(['test/a/b/c.txt']))
 
-    def test_tag_matches_not(self):
-        role = Role(_roles_complex)
+    @mock.patch.object(RoleFactory, 'graph')
+    def test_tag_matches_not(self, graph):
+        graph.dependencies.return_value = []
+        role = self.role(_roles_complex)
         self.assertItemsEqual([], role.update_triggers(['foo.txt']))
 
-    def test_tag_matches_some(self):
-        role = Role(_roles_complex)
+    @mock.patch.object(RoleFactory, 'graph')
+    def test_tag_matches_some(self, graph):
+        graph.dependencies.return_value = []
+        role = self.role(_roles_complex)
         self.assertItemsEqual(['c'], role.update_triggers(['test/foo.txt']))
 
-    @mock.patch('dork.matcher.glob', side_effect=[['foo']])
-    @mock.patch('__builtin__.open', side_effect=lambda f: BytesIO('name = test\ncore=7.x\n'))
-    def test_match_by_content(self, *args):
-        role = Role(_roles_content)
-        repo = dork.git.Repository('/var/source/test')
-        self.assertEquals(['drupal_7'], role.matching_pattern(repo))
+    def test_match_by_content(self):
+        role = self.role(_roles_content, {'test.info': 'name = test\ncore=7.x\n'})
+        self.assertEquals(['drupal_7'], role.matched_triggers)
 
-    @mock.patch('dork.matcher.glob', side_effect=[['foo']])
-    @mock.patch('__builtin__.open', side_effect=lambda f: BytesIO('name: test\ncore: 7.x\n'))
     def test_match_not_by_content(self):
-        role = Role(_roles_content)
-        repo = dork.git.Repository('/var/source/test')
-        self.assertEquals([], role.matching_pattern(repo))
+        role = self.role(_roles_content, {'test.info': 'name: test\ncore: 7.x\n'})
+        self.assertEquals([], role.matched_triggers)
+
+
+class TestPatternMatcher(unittest.TestCase):
+    def setUp(self):
+        self.repo = mock.Mock()
+        self.repo.find_files.side_effect = lambda patterns: dict(
+            (p, [f for f in ['index.php', 'a.txt'] if fnmatch(f, p)])
+            for p in patterns)
+        self.repo.search_files.side_effect = lambda paths, cp=None: len(paths) > 0
+        self.matcher = PatternMatcher(self.repo)
+
+    def test_batch(self):
+        self.matcher.add('index.php')
+        self.matcher.add('source:/*.php')
+        self.matcher.add('test.php')
+        self.assertTrue(self.matcher.matches('index.php'))
+        self.assertTrue(self.matcher.matches('source:/*.php'))
+        self.assertFalse(self.matcher.matches('test.php'))
+        self.repo.find_files.assert_called_once_with(
+            set(['index.php', '*.php', 'test.php']))
+
+    def test_data(self):
+        self.repo.contains_file.return_value = True
+        self.assertTrue(self.matcher.matches('data:/dump.sql'))
+        self.repo.contains_file.assert_called_once_with('data:/dump.sql', None)
+        self.assertFalse(self.repo.find_files.called)
+
+    def test_roles(self):
+        roles = [Role(name, meta, self.repo, self.matcher) for name, meta in [
+            ('simple', yaml.load(yaml.dump(_roles_simple))),
+            ('complex', yaml.load(yaml.dump(_roles_complex))),
+        ]]
+        self.assertTrue(roles[0].triggered)
+        self.assertItemsEqual(['pattern_b'], roles[1].matched_triggers)
+        self.assertEqual(1, self.repo.find_files.call_count)
+
+
+class TestRoleMetadata(unittest.TestCase):
+    def setUp(self):
+        self.roles = tempfile.mkdtemp()
+        self.sources = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+        self.write(self.roles + '/base/meta/main.yml', 'dependencies: []\n')
+        self.write(self.roles + '/base/meta/dork.yml',
+                   'build_triggers:\n  - index.php\n')
+        self.write(self.sources[1] + '/.dork/local/meta/main.yml',
+                   'dependencies: [base]\n')
+        os.mkdir(self.roles + '/.hidden')
+        os.mkdir(self.roles + '/nometa')
+        self.patcher = mock.patch.object(
+            config.config, 'ansible_roles_path', [self.roles])
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        for directory in [self.roles] + self.sources:
+            shutil.rmtree(directory)
+
+    def write(self, path, content):
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def factory(self, directory):
+        repository = mock.Mock()
+        repository.directory = directory
+        factory = RoleFactory(repository)
+        factory.clear()
+        return factory
+
+    def test_parsed_once(self):
+        with mock.patch('dork.matcher.yaml.load', wraps=yaml.load) as load:
+            roles = [self.factory(d).list() for d in self.sources]
+            self.assertEqual(3, load.call_count)
+        self.assertEqual(['base'], roles[0].keys())
+        self.assertItemsEqual(['base', 'local'], roles[1].keys())
+
+    def test_changed(self):
+        self.factory(self.sources[0]).list()
+        self.write(self.roles + '/base/meta/dork.yml', 'settings: {a: 1}\n')
+        os.utime(self.roles + '/base/meta/dork.yml', (1, 1))
+        role = self.factory(self.sources[0]).get('base')
+        self.assertEqual({'a': 1}, role.settings)
+
+    def test_project_roles(self):
+        local = self.factory(self.sources[1]).get('local')
+        self.assertTrue(local.triggered)
+        meta = getattr(dork.matcher, '_role_metadata')(self.sources[1] + '/.dork')
+        self.assertNotIn('dork', meta['local'])
+
+    def test_persistent(self):
+        self.factory(self.sources[0]).list()
+        getattr(dork.matcher, '__metadata').clear()
+        with mock.patch('dork.matcher.yaml.load') as load:
+            role = self.factory(self.sources[0]).get('base')
+            self.assertFalse(load.called)
+        self.assertEqual(['index.php'], role.triggers()['default'])
+        self.assertIsInstance(role.triggers()['default'][0], str)
+
+    def test_not_json(self):
+        self.write(self.roles + '/base/meta/main.yml',
+                   'released: 2015-01-01\ndependencies: []\n')
+        role = self.factory(self.sources[0]).get('base')
+        self.assertEqual([], role.dependencies)
+
+    def test_rebuild(self):
+        self.factory(self.sources[0]).list()
+        with mock.patch('dork.matcher.yaml.load', wraps=yaml.load) as load:
+            self.assertEqual(1, dork.matcher.rebuild([self.roles, '/nonexistent']))
+            self.assertEqual(2, load.call_count)
+
+
+class TestRoleGraph(unittest.TestCase):
+    def setUp(self):
+        self.roles = tempfile.mkdtemp()
+        self.source = tempfile.mkdtemp()
+        # A diamond: top -> left, right -> base
+        self.role('base', [], {'services': {'http': 80, 'db': 3306},
+                               'settings': {'a': 1, 'b': 1},
+                               'build_triggers': ['index.php']})
+        self.role('left', ['base'], {'settings': {'b': 2}})
+        self.role('right', ['base'], {'services': {'db': 5432},
+                                      'build_triggers': ['*.php']})
+        self.role('top', ['left', {'role': 'right'}, 'missing'],
+                  {'update_triggers': [{'*.php': ['php']}],
+                   'build_triggers': ['*.php']})
+        self.role('other', [], {'build_triggers': ['*.txt']})
+        self.patcher = mock.patch.object(
+            config.config, 'ansible_roles_path', [self.roles])
+        self.patcher.start()
+        repository = mock.Mock()
+        repository.directory = self.source
+        repository.find_files.side_effect = lambda patterns: dict(
+            (p, [f for f in ['index.php'] if fnmatch(f, p)]) for p in patterns)
+        repository.search_files.side_effect = lambda paths, cp=None: len(paths) > 0
+        self.factory = RoleFactory(repository)
+        self.factory.clear()
+
+    def tearDown(self):
+        self.factory.clear()
+        self.patcher.stop()
+        shutil.rmtree(self.roles)
+        shutil.rmtree(self.source)
+
+    def role(self, name, dependencies, dork_meta):
+        os.makedirs('%s/%s/meta' % (self.roles, name))
+        with open('%s/%s/meta/main.yml' % (self.roles, name), 'w') as f:
+            f.write(yaml.safe_dump({'dependencies': dependencies}))
+        with open('%s/%s/meta/dork.yml' % (self.roles, name), 'w') as f:
+            f.write(yaml.safe_dump(dork_meta))
+
+    def test_order(self):
+        order = [r.name for r in self.factory.graph.order]
+        for dep, role in [('base', 'left'), ('base', 'right'),
+                          ('left', 'top'), ('right', 'top')]:
+            self.assertLess(order.index(dep), order.index(role))
+
+    def test_resolved(self):
+        top = self.factory.get('top')
+        self.assertTrue(top.includes('base'))
+        self.assertFalse(top.includes('other'))
+        self.assertEqual({'http': 80, 'db': 5432}, top.services)
+        self.assertEqual({'a': 1, 'b': 1}, top.settings)
+        self.assertEqual([('*.php', ['php'])], top.update_patterns())
+        self.assertItemsEqual(['default'], top.active_triggers)
+
+    def test_resolved_once(self):
+        base = self.factory.get('base')
+        with mock.patch.object(self.factory.graph, 'dependencies',
+                               wraps=self.factory.graph.dependencies) as deps:
+            self.factory.get('top').settings
+            self.factory.get('left').settings
+            self.assertEqual(4, deps.call_count)
+        self.assertEqual({'a': 1, 'b': 1}, base.settings)
+
+    def test_tree(self):
+        self.assertEqual(['top'], [r.name for r in self.factory.tree()])
+
+    def test_cycle(self):
+        self.role('first', ['second'], {})
+        self.role('second', ['third'], {})
+        self.role('third', ['first'], {})
+        self.factory.clear()
+        with self.assertRaises(RoleCycleException) as context:
+            self.factory.tree()
+        cycle = context.exception.cycle
+        self.assertEqual(cycle[0], cycle[-1])
+        self.assertItemsEqual(['first', 'second', 'third'], cycle[1:])
+
+
+class TestTagMatcher(unittest.TestCase):
+    patterns = [
+        ('test/**/*.txt', ['a', 'b']),
+        ('test/**', ['c']),
+        ('*.php', ['php']),
+        ('*.php', ['php', 'code']),
+        ('composer.[jl]*', ['composer']),
+        ('docs/?.md', ['docs']),
+    ]
+
+    def naive(self, changeset):
+        return set(tag for f in changeset for p, tags in self.patterns
+                   if fnmatch(f, p) for tag in tags)
+
+    def test_union(self):
+        changesets = [
+            ['test/a/b/c.txt'], ['test/foo.txt'], ['foo.txt'], [],
+            ['index.php', 'docs/a.md', 'docs/ab.md'],
+            ['composer.lock', 'src/x.php', 'test/x'],
+        ]
+        for changeset in changesets:
+            self.assertItemsEqual(self.naive(changeset),
+                                  TagMatcher(self.patterns).match(changeset))
+
+    def test_early_stop(self):
+        changeset = iter(['index.php', 'test/a/b.txt', 'composer.json',
+                          'docs/x.md', 'unread.txt'])
+        tags = TagMatcher(self.patterns).match(changeset)
+        self.assertItemsEqual(
+            ['a', 'b', 'c', 'php', 'code', 'composer', 'docs'], tags)
+        self.assertEqual(['unread.txt'], list(changeset))
+
+    def test_roles(self):
+        role = Role('complex', yaml.load(yaml.dump(_roles_complex)), mock.Mock())
+        with mock.patch.object(RoleFactory, 'graph') as graph:
+            graph.dependencies.return_value = []
+            self.assertItemsEqual(['a', 'b', 'c'],
+                                  Role.update_tags([role, role], ['test/a/b/c.txt']))
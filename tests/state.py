@@ -0,0 +1,59 @@
+import sqlite3
+import unittest
+from mock import patch
+import shutil
+import tempfile
+from dork.config import config
+import dork.state as state
+
+
+class TestContainerHash(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.patcher = patch.object(config, 'state_directory', self.directory)
+        self.patcher.start()
+        state.close()
+
+    def tearDown(self):
+        state.close()
+        self.patcher.stop()
+        shutil.rmtree(self.directory)
+
+    def test_empty(self):
+        self.assertIsNone(state.container_hash('1'))
+        state.forget_container('1')
+
+    def test_set(self):
+        state.set_container_hash('1', 'abc')
+        self.assertEqual('abc', state.container_hash('1'))
+        state.set_container_hash('1', 'def')
+        self.assertEqual('def', state.container_hash('1'))
+        state.forget_container('1')
+        self.assertIsNone(state.container_hash('1'))
+
+    def test_other_process(self):
+        self.assertIsNone(state.container_hash('1'))
+        state.set_container_hash('2', 'abc')
+        other = state.connect()
+        with other:
+            other.execute('INSERT INTO container_hash VALUES (?, ?)', ('1', 'def'))
+        other.close()
+        self.assertEqual('def', state.container_hash('1'))
+
+    def test_read_only(self):
+        # Reading doesn't create tables, an unknown layout is no state.
+        sqlite3.connect(state.path()).close()
+        self.assertIsNone(state.container_hash('1'))
+        state.forget_container('1')
+        db = sqlite3.connect(state.path())
+        self.assertEqual([], db.execute(
+            'SELECT name FROM sqlite_master').fetchall())
+        db.close()
+        state.set_container_hash('1', 'abc')
+        self.assertEqual('abc', state.container_hash('1'))
+
+    def test_broken(self):
+        with open(state.path(), 'w') as f:
+            f.write('no database' * 100)
+        self.assertIsNone(state.container_hash('1'))
+        state.forget_container('1')